@@ -0,0 +1,317 @@
+from decimal import Decimal
+
+from django_redis import get_redis_connection
+
+from apps.goods.catalog import get_sku_summaries
+from apps.goods.stock import SKU_STOCK_KEY, SKU_ONLINE_KEY, load_sku_stock, \
+    load_sku_stocks
+from utils.lua import LuaScript
+
+# 未登录用户的购物车保存7天
+ANON_CART_TIMEOUT = 60 * 60 * 24 * 7
+
+# 修改购物车的结果: 成功, 库存不足, 商品已下架, Redis中没有商品的库存
+CART_OK = 0
+CART_NO_STOCK = 1
+CART_OFFLINE = 2
+CART_UNKNOWN_SKU = 3
+
+# 购物车中商品的总数量不存在时(以前添加的购物车), 先累加购物车中所有商品的数量
+ENSURE_COUNT = """
+if redis.call('exists', KEYS[2]) == 0 then
+    local total = 0
+    for _, count in ipairs(redis.call('hvals', KEYS[1])) do
+        total = total + tonumber(count)
+    end
+    redis.call('set', KEYS[2], total)
+end
+"""
+
+# 添加或修改购物车中商品的数量, 同时修改商品的总数量
+# 库存和上架状态从Redis中读取, 不需要查询MySQL
+# KEYS: 购物车, 商品总数量, 商品库存, 上架的商品; ARGV: 商品id, 数量, 1为增加数量/0为修改数量
+# 返回: {结果, 商品总数量}
+SET_ITEM = LuaScript(ENSURE_COUNT + """
+local stock = redis.call('hget', KEYS[3], ARGV[1])
+if not stock then
+    return {3, 0}
+end
+if redis.call('sismember', KEYS[4], ARGV[1]) == 0 then
+    return {2, 0}
+end
+local old = tonumber(redis.call('hget', KEYS[1], ARGV[1]) or 0)
+local count = tonumber(ARGV[2])
+if ARGV[3] == '1' then
+    count = old + count
+end
+if count > tonumber(stock) then
+    return {1, tonumber(redis.call('get', KEYS[2]))}
+end
+redis.call('hset', KEYS[1], ARGV[1], count)
+return {0, redis.call('incrby', KEYS[2], count - old)}
+""")
+
+# 删除购物车中的商品, 同时减少商品的总数量
+# KEYS: 购物车, 商品总数量; ARGV: 商品id, ...; 返回: 商品总数量
+REMOVE_ITEMS = LuaScript(ENSURE_COUNT + """
+local removed = 0
+for _, sku_id in ipairs(ARGV) do
+    local count = redis.call('hget', KEYS[1], sku_id)
+    if count then
+        removed = removed + tonumber(count)
+        redis.call('hdel', KEYS[1], sku_id)
+    end
+end
+return redis.call('incrby', KEYS[2], -removed)
+""")
+
+# 批量修改购物车: 先校验所有的操作, 全部通过后再修改, 最后重新计算商品的总数量
+# KEYS: 购物车, 商品总数量, 商品库存, 上架的商品
+# ARGV: 操作(add/update/delete), 商品id, 数量, 操作, 商品id, 数量, ...
+# 返回: {0, 商品总数量, {商品id, 数量, ...}}; 失败时返回{结果, 商品id}或{3, {商品id, ...}}
+BATCH_ITEMS = LuaScript("""
+local counts = {}
+local missing = {}
+for i = 1, #ARGV, 3 do
+    local op, sku_id, count = ARGV[i], ARGV[i + 1], tonumber(ARGV[i + 2])
+    if counts[sku_id] == nil then
+        counts[sku_id] = tonumber(redis.call('hget', KEYS[1], sku_id) or 0)
+    end
+    if op == 'delete' then
+        counts[sku_id] = 0
+    else
+        local stock = redis.call('hget', KEYS[3], sku_id)
+        if not stock then
+            table.insert(missing, sku_id)
+        elseif redis.call('sismember', KEYS[4], sku_id) == 0 then
+            return {2, sku_id}
+        else
+            if op == 'add' then
+                count = counts[sku_id] + count
+            end
+            if count > tonumber(stock) then
+                return {1, sku_id}
+            end
+            counts[sku_id] = count
+        end
+    end
+end
+if #missing > 0 then
+    return {3, missing}
+end
+
+for sku_id, count in pairs(counts) do
+    if count > 0 then
+        redis.call('hset', KEYS[1], sku_id, count)
+    else
+        redis.call('hdel', KEYS[1], sku_id)
+    end
+end
+local cart = redis.call('hgetall', KEYS[1])
+local total = 0
+for i = 2, #cart, 2 do
+    total = total + tonumber(cart[i])
+end
+redis.call('set', KEYS[2], total)
+return {0, total, cart}
+""")
+
+# 登录时把未登录时的购物车合并到用户的购物车: 数量相加, 不超过库存, 不合并已下架的商品
+# KEYS: 未登录的购物车, 商品总数量, 用户的购物车, 商品总数量, 商品库存, 上架的商品
+# ARGV: 1为检查Redis中是否有商品的库存
+# 返回: {0, 用户购物车的商品总数量}; Redis中没有商品的库存时返回{3, {商品id, ...}}
+MERGE_ITEMS = LuaScript("""
+local anon = redis.call('hgetall', KEYS[1])
+if ARGV[1] == '1' then
+    local missing = {}
+    for i = 1, #anon, 2 do
+        if redis.call('hexists', KEYS[5], anon[i]) == 0 then
+            table.insert(missing, anon[i])
+        end
+    end
+    if #missing > 0 then
+        return {3, missing}
+    end
+end
+for i = 1, #anon, 2 do
+    local sku_id = anon[i]
+    local stock = tonumber(redis.call('hget', KEYS[5], sku_id) or 0)
+    if stock > 0 and redis.call('sismember', KEYS[6], sku_id) == 1 then
+        local count = tonumber(redis.call('hget', KEYS[3], sku_id) or 0)
+        count = math.min(count + tonumber(anon[i + 1]), stock)
+        redis.call('hset', KEYS[3], sku_id, count)
+    end
+end
+local total = 0
+for _, count in ipairs(redis.call('hvals', KEYS[3])) do
+    total = total + tonumber(count)
+end
+redis.call('set', KEYS[4], total)
+redis.call('del', KEYS[1], KEYS[2])
+return {0, total}
+""")
+
+# 读取商品的总数量
+GET_COUNT = LuaScript(ENSURE_COUNT + """
+return tonumber(redis.call('get', KEYS[2]))
+""")
+
+
+def cart_owner(request, create=True):
+    """
+    购物车的所有者: 登录用户为用户id, 未登录用户为'anon_' + session的键
+    :param create: 未登录用户还没有session时是否创建
+    :return: 未登录用户没有session并且不创建时返回None
+    """
+    if request.user.is_authenticated():
+        return request.user.id
+    if not request.session.session_key:
+        if not create:
+            return None
+        request.session.save()
+        # 响应时设置session的cookie
+        request.session.modified = True
+    return 'anon_%s' % request.session.session_key
+
+
+def is_anonymous(owner):
+    return str(owner).startswith('anon_')
+
+
+def cart_keys(owner):
+    """
+    购物车的键: 购物车(hash: {商品id: 数量}), 商品总数量
+    登录用户: cart_用户id; 未登录用户: cart_anon_session的键
+    """
+    return 'cart_%s' % owner, 'cart_count_%s' % owner
+
+
+def touch_cart(owner):
+    """未登录用户的购物车修改后重新设置有效期"""
+    if is_anonymous(owner):
+        pipeline = get_redis_connection().pipeline()
+        for key in cart_keys(owner):
+            pipeline.expire(key, ANON_CART_TIMEOUT)
+        pipeline.execute()
+
+
+def set_item(owner, sku_id, count, add):
+    keys = cart_keys(owner) + (SKU_STOCK_KEY, SKU_ONLINE_KEY)
+    args = [sku_id, count, 1 if add else 0]
+    code, total = SET_ITEM(keys, args)
+    if code == CART_UNKNOWN_SKU and load_sku_stock(sku_id):
+        # Redis中还没有商品的库存: 从数据库读取后再执行一次
+        code, total = SET_ITEM(keys, args)
+    if code == CART_OK:
+        touch_cart(owner)
+    return code, total
+
+
+def add_cart_item(owner, sku_id, count):
+    """
+    增加购物车中商品的数量
+    :return: (结果, 商品总数量), 不成功时不修改
+    """
+    return set_item(owner, sku_id, count, True)
+
+
+def set_cart_item(owner, sku_id, count):
+    """
+    修改购物车中商品的数量
+    :return: (结果, 商品总数量), 不成功时不修改
+    """
+    return set_item(owner, sku_id, count, False)
+
+
+def batch_cart_items(owner, ops):
+    """
+    批量修改购物车: 只执行一次Lua脚本, 任何一个操作不成功时都不修改
+    :param ops: [(操作(add/update/delete), 商品id, 数量), ...]
+    :return: 成功时返回(CART_OK, (商品总数量, {商品id: 数量})),
+             不成功时返回(结果, 商品id)
+    """
+    keys = cart_keys(owner) + (SKU_STOCK_KEY, SKU_ONLINE_KEY)
+    args = [value for op in ops for value in op]
+    result = BATCH_ITEMS(keys, args)
+    if result[0] == CART_UNKNOWN_SKU:
+        # Redis中还没有这些商品的库存: 一次查询数据库后再执行一次
+        missing = [int(sku_id) for sku_id in result[1]]
+        found = load_sku_stocks(missing)
+        if len(found) < len(set(missing)):
+            return CART_UNKNOWN_SKU, min(set(missing) - found)
+        result = BATCH_ITEMS(keys, args)
+    if result[0] != CART_OK:
+        return result[0], int(result[1])
+    touch_cart(owner)
+    _, total, cart = result
+    items = {int(cart[i]): int(cart[i + 1]) for i in range(0, len(cart), 2)}
+    return CART_OK, (total, items)
+
+
+def remove_cart_items(owner, sku_ids, client=None):
+    """
+    删除购物车中的商品
+    :return: 商品总数量
+    """
+    if not sku_ids:
+        return get_cart_count(owner)
+    total = REMOVE_ITEMS(cart_keys(owner), sku_ids, client)
+    touch_cart(owner)
+    return total
+
+
+def merge_cart_items(anon_owner, user_id):
+    """
+    登录时合并未登录时的购物车: 只执行一次Lua脚本, 不会每个商品查询一次数据库
+    :return: 用户购物车的商品总数量
+    """
+    keys = cart_keys(anon_owner) + cart_keys(user_id) + (
+        SKU_STOCK_KEY, SKU_ONLINE_KEY)
+    code, result = MERGE_ITEMS(keys, [1])
+    if code == CART_UNKNOWN_SKU:
+        # Redis中还没有这些商品的库存: 一次查询数据库后再合并(不存在的商品不合并)
+        load_sku_stocks(result)
+        code, result = MERGE_ITEMS(keys, [0])
+    return result
+
+
+def get_cart_count(owner):
+    """购物车中商品的总数量: 只读取一个键"""
+    count = get_redis_connection().get(cart_keys(owner)[1])
+    if count is None:
+        if is_anonymous(owner):
+            # 未登录用户的购物车都有商品总数量: 没有时购物车为空
+            return 0
+        # 以前添加的购物车还没有商品总数量
+        return GET_COUNT(cart_keys(owner))
+    return int(count)
+
+
+def get_cart_skus(owner, sku_ids=None):
+    """
+    查询购物车中的商品: 商品数据从缓存中批量读取, 缓存中没有的一次查询数据库,
+    同时计算小计金额、总数量和总金额
+    :param sku_ids: 需要查询的商品id列表, 为None时查询购物车中的所有商品
+    :return: (商品列表, 总数量, 总金额), 商品为摘要字典, 增加了count和amount;
+             不包含购物车中没有的商品和已删除的商品
+    """
+    key = cart_keys(owner)[0]
+    redis_conn = get_redis_connection()
+    if sku_ids is None:
+        cart_dict = redis_conn.hgetall(key)
+    else:
+        # 只读取需要的商品
+        cart_dict = dict(zip(sku_ids, redis_conn.hmget(key, sku_ids)))
+    counts = {int(sku_id): int(count)
+              for sku_id, count in cart_dict.items() if count}
+
+    skus = []
+    total_count = 0
+    total_amount = Decimal('0')
+    for summary in get_sku_summaries(list(counts)):
+        count = counts[summary['id']]
+        amount = Decimal(summary['price']) * count
+        skus.append(dict(summary, count=count, amount=amount))
+        total_count += count
+        total_amount += amount
+    return skus, total_count, total_amount
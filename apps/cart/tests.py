@@ -1,3 +1,132 @@
+import json
+from decimal import Decimal
+
 from django.test import TestCase
 
-# Create your tests here.
+from apps.cart.cart import get_cart_skus, cart_keys, batch_cart_items, CART_OK, \
+    CART_NO_STOCK, CART_OFFLINE, CART_UNKNOWN_SKU
+from apps.goods.models import GoodsCategory, GoodsSPU, GoodsSKU
+from utils.testing import RedisTestMixin
+
+
+class CartSkusQueryTest(RedisTestMixin, TestCase):
+    """购物车商品的查询次数与商品数量无关"""
+
+    user_id = 10 ** 8
+
+    def setUp(self):
+        super().setUp()
+        category = GoodsCategory.objects.create(
+            name='水果', logo='fruit', image='category/fruit.jpg')
+        spu = GoodsSPU.objects.create(name='草莓')
+        self.skus = [GoodsSKU.objects.create(
+            name='商品%s' % i, title='简介', unit='500g', price=i + 1,
+            stock=100, default_image='goods/goods001.jpg',
+            category=category, spu=spu) for i in range(30)]
+        self.redis_conn.hmset(cart_keys(self.user_id)[0],
+                              {sku.id: 2 for sku in self.skus})
+
+    def test_cart_skus(self):
+        # 缓存中没有商品数据时只查询一次数据库
+        with self.assertNumQueries(1):
+            skus, total_count, total_amount = get_cart_skus(self.user_id)
+        self.assertEqual(len(skus), 30)
+        self.assertEqual(total_count, 60)
+        self.assertEqual(total_amount, Decimal(sum(range(1, 31)) * 2))
+
+        # 商品数据已缓存: 不查询数据库
+        sku_ids = [str(sku.id) for sku in self.skus[:5]]
+        with self.assertNumQueries(0):
+            skus, total_count, total_amount = get_cart_skus(self.user_id, sku_ids)
+        self.assertEqual([sku['id'] for sku in skus],
+                         [sku.id for sku in self.skus[:5]])
+        self.assertEqual(skus[0]['amount'], Decimal(2))
+        self.assertEqual(total_count, 10)
+
+
+class CartBatchTest(RedisTestMixin, TestCase):
+    """批量修改购物车: 一次执行所有的操作, 任何一个操作不成功时都不修改"""
+
+    user_id = 10 ** 8 + 1
+
+    def setUp(self):
+        super().setUp()
+        category = GoodsCategory.objects.create(
+            name='水果', logo='fruit', image='category/fruit.jpg')
+        spu = GoodsSPU.objects.create(name='草莓')
+        self.skus = [GoodsSKU.objects.create(
+            name='商品%s' % i, title='简介', unit='500g', price=10,
+            stock=10, status=i < 2, default_image='goods/goods001.jpg',
+            category=category, spu=spu) for i in range(3)]
+        self.sku1, self.sku2, self.offline = self.skus
+
+    def get_cart(self):
+        cart_key, count_key = cart_keys(self.user_id)
+        cart = {int(sku_id): int(count)
+                for sku_id, count in self.redis_conn.hgetall(cart_key).items()}
+        return cart, int(self.redis_conn.get(count_key) or 0)
+
+    def test_batch_items(self):
+        self.redis_conn.hset(cart_keys(self.user_id)[0], self.sku1.id, 1)
+        # 以前的购物车没有商品总数量: 修改后重新计算
+        result = batch_cart_items(self.user_id, [
+            ('add', self.sku1.id, 2), ('add', self.sku2.id, 3), ('add', self.sku2.id, 1)])
+        self.assertEqual(result, (CART_OK, (7, {self.sku1.id: 3, self.sku2.id: 4})))
+        self.assertEqual(self.get_cart(), ({self.sku1.id: 3, self.sku2.id: 4}, 7))
+
+        # 同一批中的修改按顺序执行: 删除后再添加
+        result = batch_cart_items(self.user_id, [
+            ('update', self.sku1.id, 5), ('delete', self.sku2.id, 0),
+            ('add', self.sku1.id, 1), ('delete', self.sku1.id, 0), ('add', self.sku1.id, 2)])
+        self.assertEqual(result, (CART_OK, (2, {self.sku1.id: 2})))
+        self.assertEqual(self.get_cart(), ({self.sku1.id: 2}, 2))
+
+    def test_batch_failed(self):
+        batch_cart_items(self.user_id, [('add', self.sku1.id, 2)])
+        for ops, expected in [
+                ([('add', self.sku2.id, 1), ('add', self.sku1.id, 9)],
+                 (CART_NO_STOCK, self.sku1.id)),
+                ([('delete', self.sku1.id, 0), ('update', self.offline.id, 1)],
+                 (CART_OFFLINE, self.offline.id)),
+                ([('add', self.sku2.id, 1), ('add', 10 ** 9, 1)],
+                 (CART_UNKNOWN_SKU, 10 ** 9))]:
+            self.assertEqual(batch_cart_items(self.user_id, ops), expected)
+            # 前面的操作也没有执行
+            self.assertEqual(self.get_cart(), ({self.sku1.id: 2}, 2))
+
+    def post(self, body):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        response = self.client.post('/cart/batch', body, content_type='application/json')
+        return json.loads(response.content.decode())
+
+    def test_batch_view(self):
+        data = self.post({'ops': [
+            {'op': 'add', 'sku_id': self.sku1.id, 'count': 2},
+            {'op': 'update', 'sku_id': self.sku2.id, 'count': '3'}]})
+        self.assertEqual(data['code'], 0)
+        self.assertEqual(data['cart_count'], 5)
+        self.assertEqual(data['cart'], {str(self.sku1.id): 2, str(self.sku2.id): 3})
+
+        data = self.post({'ops': [{'op': 'delete', 'sku_id': self.sku2.id},
+                                  {'op': 'add', 'sku_id': self.sku1.id, 'count': 1}]})
+        self.assertEqual((data['code'], data['cart_count']), (0, 3))
+        self.assertEqual(data['cart'], {str(self.sku1.id): 3})
+
+        # 不成功时返回不能修改的商品
+        data = self.post({'ops': [{'op': 'update', 'sku_id': self.sku1.id, 'count': 11}]})
+        self.assertEqual((data['code'], data['sku_id']), (5, self.sku1.id))
+        data = self.post({'ops': [{'op': 'add', 'sku_id': self.offline.id, 'count': 1}]})
+        self.assertEqual((data['code'], data['sku_id']), (4, self.offline.id))
+
+    def test_batch_view_params(self):
+        for body, code in [
+                ('not json', 2),
+                ({}, 2),
+                ({'ops': []}, 2),
+                ({'ops': [{'op': 'clear', 'sku_id': self.sku1.id}]}, 2),
+                ({'ops': [{'op': 'add', 'sku_id': 'x', 'count': 1}]}, 2),
+                ({'ops': [{'op': 'add', 'sku_id': self.sku1.id, 'count': 'x'}]}, 3),
+                ({'ops': [{'op': 'update', 'sku_id': self.sku1.id, 'count': 0}]}, 3),
+                ({'ops': [{'op': 'add', 'sku_id': self.sku1.id}]}, 3)]:
+            self.assertEqual(self.post(body)['code'], code, body)
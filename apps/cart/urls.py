@@ -6,5 +6,6 @@ urlpatterns = [
     url(r'^add$', views.CartAddView.as_view(), name='add'),
     url(r'^$', views.CartInfoView.as_view(), name='info'),
     url(r'^update$', views.UpdateCartView.as_view(), name='update'),
-    url(r'^delete$', views.CartDeleteView.as_view(), name='delete')
+    url(r'^delete$', views.CartDeleteView.as_view(), name='delete'),
+    url(r'^batch$', views.CartBatchView.as_view(), name='batch'),
 ]
@@ -1,10 +1,11 @@
+import json
+
 from django.http import JsonResponse
 from django.shortcuts import render
 from django.views.generic import View
-from django_redis import get_redis_connection
 
-from apps.goods.models import GoodsSKU
-from utils.LoginRequiredMixin import LoginRequiredMixin
+from apps.cart.cart import add_cart_item, set_cart_item, remove_cart_items, \
+    get_cart_skus, cart_owner, batch_cart_items, CART_NO_STOCK, CART_OFFLINE, CART_UNKNOWN_SKU
 
 
 class CartAddView(View):
@@ -16,12 +17,10 @@ class CartAddView(View):
         :param request:
         :return:
         """
-        # 判断用户是否有登录
-        if not request.user.is_authenticated():
-            return JsonResponse({'code': 1, 'errmsg': '请先登录'})
+        # 未登录的用户也可以添加商品到购物车: 保存在session对应的购物车中, 登录时合并
+        owner = cart_owner(request)
 
         # 获取用户提交的参数
-        user_id = request.user.id
         sku_id = request.POST.get('sku_id')
         count = request.POST.get('count')
 
@@ -33,72 +32,37 @@ class CartAddView(View):
             count = int(count)
         except:
             return JsonResponse({'code': 3, 'errmsg': '购买数量格式不正确'})
-        # 校验商品是否存在
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
-            return JsonResponse({'code': 4, 'errmsg': '商品不存在'})
-
         # todo: 业务处理: 添加商品到Redis数据库中
-        # 尝试获取redis中商品的购买数量
-        # cart_1: {'1':'2', '2':'2'}
-        strict_redis = get_redis_connection()
-        key = 'cart_%s' % user_id
-        # 获取不到会返回None
-        val = strict_redis.hget(key, sku_id)
-        if val:
-            count += int(val)
+        # 使用Lua脚本: 校验商品和库存、增加商品数量和计算购物车中商品的总数量原子执行,
+        # 同时添加同一商品时不会互相覆盖; 库存从Redis中读取, 不查询MySQL
+        # cart_1: {'1':'2', '2':'2'}, cart_count_1: 4
+        result, cart_count = add_cart_item(owner, sku_id, count)
 
+        # 校验商品是否存在
+        if result in (CART_OFFLINE, CART_UNKNOWN_SKU):
+            return JsonResponse({'code': 4, 'errmsg': '商品不存在'})
         # 校验库存是否充足
-        if count > sku.stock:
+        if result == CART_NO_STOCK:
             return JsonResponse({'code': 5, 'errmsg': '库存不足'})
 
-        # 更新商品数量
-        strict_redis.hset(key, sku_id, count)
-
-        # todo: 计算购物车中商品的总数量
-        cart_count = 0
-        vals = strict_redis.hvals(key)
-        for val in vals:  # 累加商品数量
-            cart_count += int(val)
         # 响应json数据
         return JsonResponse({'code': 0, 'message': '添加到购物车成功',
                              'cart_count': cart_count})
 
 
-class CartInfoView(LoginRequiredMixin, View):
-    """购物车显示界面: 需要先登录才能访问"""
+class CartInfoView(View):
+    """购物车显示界面: 未登录时显示session对应的购物车"""
 
     def get(self, request):
         # 查询当前登录用户添加到购物车中的所有的商品
         # cart_1 = { '1': '2', '2': '2'}
-        sr = get_redis_connection()
-        key = 'cart_%s' % request.user.id
-        # 获取购物车中所有的商品
-        # {'1': '2', '2': '2'}
-        my_dict = sr.hgetall(key)
-
-        # 保存购物车中所有的商品对象
-        skus = []
-        # 商品总数量
-        total_count = 0
-        # 商品总金额
-        total_amount = 0
-
-        for sku_id, count in my_dict.items():
-            # 根据商品id,查询商品对象
-            sku = GoodsSKU.objects.get(id=sku_id)
-            # sku对象新增一个实例属性: count
-            sku.count = int(count)
-            # sku对象新增一个实例属性: amount
-            sku.amount = sku.price * int(count)
-
-            # 累加总数量和总金额
-            total_count += sku.count
-            total_amount += sku.amount
-
-            # 列表中新增一个商品对象
-            skus.append(sku)
+        # 商品数据批量读取(缓存), 不会每个商品查询一次数据库;
+        # 每个商品增加count(数量)和amount(小计金额)
+        owner = cart_owner(request, create=False)
+        if owner is None:
+            skus, total_count, total_amount = [], 0, 0
+        else:
+            skus, total_count, total_amount = get_cart_skus(owner)
 
         # 定义模板显示的数据
         data = {
@@ -116,9 +80,8 @@ class UpdateCartView(View):
     def post(self, request):
         """修改商品购买数量"""
 
-        # 判断用户是否有登录
-        if not request.user.is_authenticated():
-            return JsonResponse({'code': 1, 'errmsg': '请先登录'})
+        # 购物车的所有者: 登录用户或session, 未登录用户没有session时购物车为空
+        owner = cart_owner(request, create=False)
 
         # 获取用户提交的参数
         sku_id = request.POST.get('sku_id')
@@ -134,28 +97,22 @@ class UpdateCartView(View):
         except Exception:
             return JsonResponse({'code': 3, 'errmsg': '购买数量格式不正确'})
 
-        # 校验商品是否存在
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
-            return JsonResponse({'code': 4, 'errmsg': '商品不存在'})
-
-        # 库存判断
-        if count > sku.stock:
-            return JsonResponse({'code': 5, 'errmsg': '库存不足'})
+        # 购物车为空: 不为修改请求创建session
+        if owner is None:
+            return JsonResponse({'code': 0, 'message': '修改商品数量成功',
+                                 'cart_count': 0})
 
         # todo: 业务处理: 修改redis数据库中商品的购买数量
+        # 使用Lua脚本: 校验商品和库存、修改商品数量和计算商品的总数量原子执行
         # cart_1 = {'1': '2', '2': '2'}
-        strict_redis = get_redis_connection()
-        key = 'cart_%s' % request.user.id
-        # 修改hash类型中字段的值
-        strict_redis.hset(key, sku_id, count)
+        result, cart_count = set_cart_item(owner, sku_id, count)
 
-        # todo: 计算购物车中商品的总数量
-        cart_count = 0
-        vals = strict_redis.hvals(key)
-        for val in vals:  # 累加商品数量
-            cart_count += int(val)
+        # 校验商品是否存在
+        if result in (CART_OFFLINE, CART_UNKNOWN_SKU):
+            return JsonResponse({'code': 4, 'errmsg': '商品不存在'})
+        # 库存判断
+        if result == CART_NO_STOCK:
+            return JsonResponse({'code': 5, 'errmsg': '库存不足'})
 
         # 响应请求: 返回json数据
         return JsonResponse({'code': 0, 'message': '修改商品数量成功',
@@ -167,9 +124,8 @@ class CartDeleteView(View):
     def post(self, request):
         """删除购物车中的商品"""
 
-        # 判断用户是否有登录
-        if not request.user.is_authenticated():
-            return JsonResponse({'code': 1, 'errmsg': '请先登录'})
+        # 购物车的所有者: 登录用户或session, 未登录用户没有session时购物车为空
+        owner = cart_owner(request, create=False)
 
         # 获取用户提交的参数
         sku_id = request.POST.get('sku_id')
@@ -178,12 +134,57 @@ class CartDeleteView(View):
         if not sku_id:
             return JsonResponse({'code': 2, 'errmsg': '商品id不能为空'})
 
-        # 业务处理: 删除redis中对应的商品
+        # 业务处理: 删除redis中对应的商品, 同时减少商品的总数量
         # cart_1: {'1': '2', '2': '2'}
-        sr = get_redis_connection()
-        key = 'cart_%s' % request.user.id
-        # 删除hash中的一个字段和值: hdel
-        sr.hdel(key, sku_id)
+        if owner is not None:
+            remove_cart_items(owner, [sku_id])
 
         # 响应请求,返回json数据
         return JsonResponse({'code': 0, 'message': '删除商品成功'})
+
+
+class CartBatchView(View):
+    # /cart/batch
+    def post(self, request):
+        """
+        批量修改购物车: 多次修改数量或删除商品只发送一次请求
+        请求体为json数据: {"ops": [{"op": "add"|"update"|"delete", "sku_id": 1, "count": 2}, ...]}
+        所有操作一起执行, 任何一个操作不成功时都不修改购物车
+        """
+
+        # 购物车的所有者: 登录用户或session
+        owner = cart_owner(request)
+
+        # 获取用户提交的参数
+        try:
+            ops = json.loads(request.body.decode())['ops']
+            ops = [(op['op'], int(op['sku_id']), op.get('count', 0))
+                   for op in ops]
+        except Exception:
+            return JsonResponse({'code': 2, 'errmsg': '请求参数不正确'})
+        if not ops or any(op not in ('add', 'update', 'delete')
+                          for op, _, _ in ops):
+            return JsonResponse({'code': 2, 'errmsg': '请求参数不正确'})
+
+        # 检验购买数量的合法性
+        try:
+            ops = [(op, sku_id, int(count)) for op, sku_id, count in ops]
+        except (TypeError, ValueError):
+            return JsonResponse({'code': 3, 'errmsg': '购买数量格式不正确'})
+        if any(count <= 0 for op, _, count in ops if op != 'delete'):
+            return JsonResponse({'code': 3, 'errmsg': '购买数量格式不正确'})
+
+        # 业务处理: 执行一次Lua脚本, 校验商品和库存(Redis中的库存)并修改购物车
+        result, data = batch_cart_items(owner, ops)
+
+        # 校验商品是否存在
+        if result in (CART_OFFLINE, CART_UNKNOWN_SKU):
+            return JsonResponse({'code': 4, 'errmsg': '商品不存在', 'sku_id': data})
+        # 库存判断
+        if result == CART_NO_STOCK:
+            return JsonResponse({'code': 5, 'errmsg': '库存不足', 'sku_id': data})
+
+        # 响应请求: 返回修改后的购物车 {商品id: 数量}
+        cart_count, cart = data
+        return JsonResponse({'code': 0, 'message': '修改购物车成功',
+                             'cart_count': cart_count, 'cart': cart})
@@ -1,5 +1,4 @@
 from django.contrib import admin
-from django.core.cache import cache
 
 from apps.goods.models import *
 from celery_tasks.tasks import *
@@ -17,8 +16,7 @@ class BaseAdmin(admin.ModelAdmin):
         generate_static_index_page.delay()
         # generate_static_index_html.delay()
         print('save_model: %s' % obj)
-        # 修改了数据库数据就需要删除缓存
-        cache.delete('index_page_date')
+        # 首页缓存由模型的保存和删除信号使其失效(apps/goods/signals.py)
 
     def delete_model(self, request, obj):
         """管理后台删除一条数据时调用"""
@@ -27,8 +25,7 @@ class BaseAdmin(admin.ModelAdmin):
         generate_static_index_page.delay()
         # generate_static_index_html.delay()
         print('delete_model: %s' % obj)
-        # 修改了数据库数据就需要删除缓存
-        cache.delete('index_page_date')
+        # 首页缓存由模型的保存和删除信号使其失效(apps/goods/signals.py)
 
 
 class GoodsCategoryAdmin(BaseAdmin):
@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class GoodsConfig(AppConfig):
+    """商品模块"""
+    name = 'apps.goods'
+
+    def ready(self):
+        # 注册商品数据修改的信号处理函数
+        from apps.goods import signals  # noqa
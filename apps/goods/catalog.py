@@ -0,0 +1,108 @@
+from apps.goods.index_page import image_url
+from apps.goods.models import GoodsCategory, GoodsSKU
+from utils.cache import TwoTierCache
+
+# 商品类别缓存: 类别很少修改, 进程内缓存较长时间
+category_cache = TwoTierCache('categories', maxsize=1, local_timeout=60 * 5)
+# 商品SKU摘要缓存: {商品id: 摘要字典}
+sku_cache = TwoTierCache('sku_summary', maxsize=10000, local_timeout=60)
+# 商品详情页数据缓存: {商品id: 详情数据}, 不包含用户相关的购物车和浏览记录
+detail_cache = TwoTierCache('sku_detail', maxsize=2000, local_timeout=60)
+# 每个类别的商品数量缓存: {类别id: 数量}, 用于列表页计算页数
+sku_count_cache = TwoTierCache('category_sku_count', maxsize=1000,
+                               local_timeout=60)
+
+
+def load_categories():
+    """从数据库查询所有的商品类别"""
+    return [{
+        'id': category.id,
+        'name': category.name,
+        'logo': category.logo,
+        'image_url': image_url(category.image),
+    } for category in GoodsCategory.objects.all()]
+
+
+def get_categories():
+    """读取所有的商品类别, 返回普通字典数据的列表"""
+    return category_cache.get('all', load_categories)
+
+
+def get_category(category_id):
+    """根据id读取商品类别, 不存在时返回None"""
+    for category in get_categories():
+        if category['id'] == int(category_id):
+            return category
+    return None
+
+
+def get_category_sku_count(category_id):
+    """读取类别中的商品数量(缓存), 不需要每次请求都执行COUNT查询"""
+    return sku_count_cache.get(int(category_id), lambda: GoodsSKU.objects.filter(
+        category_id=category_id).count())
+
+
+def sku_summary(sku):
+    """商品SKU转换为页面显示需要的摘要数据(不包含经常变化的库存和销量)"""
+    return {
+        'id': sku.id,
+        'name': sku.name,
+        'title': sku.title,
+        'unit': sku.unit,
+        'price': str(sku.price),
+        'image_url': image_url(sku.default_image),
+        'status': sku.status,
+        'category_id': sku.category_id,
+        'spu_id': sku.spu_id,
+    }
+
+
+def load_sku_summaries(sku_ids):
+    """从数据库批量查询商品SKU摘要"""
+    skus = GoodsSKU.objects.only(
+        'id', 'name', 'title', 'unit', 'price', 'default_image', 'status',
+        'category', 'spu').in_bulk(sku_ids)
+    return {sku_id: sku_summary(sku) for sku_id, sku in skus.items()}
+
+
+def get_sku_summaries(sku_ids):
+    """
+    批量读取商品SKU摘要
+    :param sku_ids: 商品id列表
+    :return: 按sku_ids顺序排列的摘要列表, 不包含不存在的商品
+    """
+    sku_ids = [int(sku_id) for sku_id in sku_ids]
+    summaries = sku_cache.get_many(sku_ids, load_sku_summaries)
+    return [summaries[sku_id] for sku_id in sku_ids if sku_id in summaries]
+
+
+def load_sku_detail(sku_id):
+    """从数据库查询商品详情页数据, 商品不存在时返回None"""
+    try:
+        sku = GoodsSKU.objects.select_related('spu').get(id=sku_id)
+    except GoodsSKU.DoesNotExist:
+        return None
+    # 查询其它规格的商品
+    other_skus = GoodsSKU.objects.filter(spu_id=sku.spu_id).exclude(id=sku.id)
+    return {
+        'sku': sku_summary(sku),
+        'spu_desc': sku.spu.desc,
+        'other_skus': [sku_summary(other) for other in other_skus],
+    }
+
+
+def get_sku_detail(sku_id):
+    """
+    读取商品详情页数据(缓存)
+    :return: {'sku': 商品摘要, 'spu_desc': 商品描述, 'other_skus': 其它规格的商品摘要},
+        商品不存在时返回None
+    """
+    return detail_cache.get(int(sku_id), lambda: load_sku_detail(sku_id))
+
+
+def delete_spu_details(spu_ids):
+    """删除商品SPU下所有商品SKU的详情页缓存(其它规格的商品也显示在详情页中)"""
+    sku_ids = list(GoodsSKU.objects.filter(spu_id__in=spu_ids).values_list(
+        'id', flat=True))
+    if sku_ids:
+        detail_cache.delete(*sku_ids)
@@ -0,0 +1,181 @@
+import json
+import time
+import zlib
+from collections import defaultdict
+
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from redis.exceptions import LockError
+
+from apps.goods.models import GoodsCategory, IndexSlideGoods, IndexPromotion, IndexCategoryGoods
+from utils.cache import TwoTierCache
+
+
+def image_url(image):
+    """图片字段对应的url地址, 没有图片时返回空字符串"""
+    return image.url if image else ''
+
+
+def sku_data(goods):
+    """类别商品转换为模板需要的普通字典数据"""
+    sku = goods.sku
+    return {
+        'sku_id': sku.id,
+        'name': sku.name,
+        'price': str(sku.price),
+        'image_url': image_url(sku.default_image),
+    }
+
+
+def get_index_page_data():
+    """
+    查询首页显示需要的数据, 首页视图和生成静态首页的celery任务共用
+    类别商品通过一次关联查询获取, 再在Python中按类别分组,
+    查询次数与类别的数量无关
+    返回的数据只包含字典、列表和字符串等普通数据, 模板渲染时不会再查询数据库
+    :return: 模板数据字典(不包含购物车数量)
+    """
+    # 查询商品类别数据
+    categories = GoodsCategory.objects.all()
+
+    # 查询商品轮播轮数据
+    # index为表示显示先后顺序的一个字段，值小的会在前面
+    slide_skus = IndexSlideGoods.objects.all().order_by('index')
+
+    # 查询商品促销活动数据
+    promotions = IndexPromotion.objects.all().order_by('index')
+
+    # 查询所有类别商品数据, 同时关联查询出商品SKU
+    category_goods = IndexCategoryGoods.objects.select_related(
+        'sku').order_by('index')
+
+    # 按类别分组: {类别id: [类别商品, ...]}
+    text_skus = defaultdict(list)  # 文字类别商品
+    img_skus = defaultdict(list)  # 图片类别商品
+    for goods in category_goods:
+        if goods.display_type == 0:
+            text_skus[goods.category_id].append(sku_data(goods))
+        else:
+            img_skus[goods.category_id].append(sku_data(goods))
+
+    return {
+        'categories': [{
+            'id': category.id,
+            'name': category.name,
+            'logo': category.logo,
+            'image_url': image_url(category.image),
+            'text_skus': text_skus.get(category.id, []),
+            'img_skus': img_skus.get(category.id, []),
+        } for category in categories],
+        'slide_skus': [{
+            'sku_id': slide.sku_id,
+            'image_url': image_url(slide.image),
+        } for slide in slide_skus],
+        'promotions': [{
+            'url': promotion.url,
+            'image_url': image_url(promotion.image),
+        } for promotion in promotions],
+    }
+
+
+def dumps_index_page_data(context):
+    """首页数据序列化为json, 数据较大时使用zlib压缩"""
+    data = json.dumps(context, separators=(',', ':')).encode()
+    if INDEX_PAGE_COMPRESS and len(data) > INDEX_COMPRESS_MIN_SIZE:
+        return b'z' + zlib.compress(data)
+    return b'j' + data
+
+
+def loads_index_page_data(payload):
+    """反序列化首页数据"""
+    data = payload[1:]
+    if payload[:1] == b'z':
+        data = zlib.decompress(data)
+    return json.loads(data.decode())
+
+
+# 首页缓存数据的键
+INDEX_PAGE_KEY = 'index_page_payload'
+# 首页缓存版本号的键: 商品数据修改后版本号加1
+INDEX_VERSION_KEY = 'index_page_version'
+# 重建首页缓存时使用的锁
+INDEX_LOCK_KEY = 'index_page_lock'
+# 首页缓存有效时间, 过期后由一个进程重建
+INDEX_PAGE_TIMEOUT = 60 * 30
+# 缓存数据在Redis中保留的时间, 重建期间其它进程继续使用旧数据
+INDEX_STALE_TIMEOUT = 60 * 60 * 24
+# 重建锁的超时时间, 防止进程异常退出后锁无法释放
+INDEX_LOCK_TIMEOUT = 30
+# 是否压缩缓存的首页数据, 以及需要压缩的最小字节数
+INDEX_PAGE_COMPRESS = True
+INDEX_COMPRESS_MIN_SIZE = 1024
+# 首页数据的进程内缓存, Redis缓存由get_cached_index_page_data管理
+index_local_cache = TwoTierCache('index_page', maxsize=1, local_timeout=60,
+                                 remote=False)
+# 缓存完全为空时, 等待其它进程重建完成的最长时间
+INDEX_WAIT_TIMEOUT = 3
+
+
+def get_index_version():
+    """获取首页缓存的版本号"""
+    version = get_redis_connection().get(INDEX_VERSION_KEY)
+    return int(version) if version else 0
+
+
+def bump_index_version():
+    """首页缓存版本号加1, 使已缓存的首页数据失效"""
+    get_redis_connection().incr(INDEX_VERSION_KEY)
+    # 通知所有进程删除进程内缓存的首页数据
+    index_local_cache.delete('context')
+
+
+def get_index_context():
+    """读取首页数据: 先读进程内缓存, 没有再读Redis缓存"""
+    return index_local_cache.get('context', get_cached_index_page_data)
+
+
+def get_cached_index_page_data():
+    """
+    从缓存读取首页数据
+    缓存过期或版本号变化时, 只有获取到锁的一个进程从数据库重建缓存,
+    其它进程在重建期间继续使用旧的缓存数据
+    :return: 模板数据字典(不包含购物车数量)
+    """
+    version = get_index_version()
+    # 缓存数据: {'version': 版本号, 'expires': 过期时间, 'payload': 序列化的模板数据}
+    entry = cache.get(INDEX_PAGE_KEY)
+    if entry and entry['version'] == version \
+            and entry['expires'] > time.time():
+        return loads_index_page_data(entry['payload'])
+
+    lock = get_redis_connection().lock(INDEX_LOCK_KEY,
+                                       timeout=INDEX_LOCK_TIMEOUT)
+    if lock.acquire(blocking=False):
+        try:
+            print('缓存失效,从Mysql数据库读取')
+            context = get_index_page_data()
+            cache.set(INDEX_PAGE_KEY, {
+                'version': version,
+                'expires': time.time() + INDEX_PAGE_TIMEOUT,
+                'payload': dumps_index_page_data(context),
+            }, INDEX_STALE_TIMEOUT)
+        finally:
+            try:
+                lock.release()
+            except LockError:
+                # 锁已超时释放
+                pass
+        return context
+
+    if entry:
+        # 其它进程正在重建缓存, 先使用旧数据
+        return loads_index_page_data(entry['payload'])
+
+    # 缓存为空: 等待其它进程重建完成
+    deadline = time.time() + INDEX_WAIT_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(0.05)
+        entry = cache.get(INDEX_PAGE_KEY)
+        if entry:
+            return loads_index_page_data(entry['payload'])
+    return get_index_page_data()
@@ -0,0 +1,207 @@
+import csv
+import json
+import time
+from decimal import Decimal
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Case, When, Value, IntegerField
+from django.utils.timezone import now
+
+from apps.goods.catalog import category_cache, sku_cache, detail_cache, sku_count_cache
+from apps.goods.index_page import bump_index_version
+from apps.goods.models import GoodsCategory, GoodsSPU, GoodsSKU
+from apps.goods.ranking import rebuild_category_rank
+from apps.goods.signals import suppress_goods_signals
+from apps.goods.stock import rebuild_sku_stock
+from apps.goods.suggest import rebuild_suggest_entries, update_suggest_snapshot
+from celery_tasks.tasks import generate_static_index_page
+from utils.page_cache import bump_page_version
+
+# 商品SKU可以导入的字段, 没有的字段使用模型的默认值
+SKU_FIELDS = ('name', 'title', 'unit', 'price', 'stock', 'sales', 'status')
+
+
+class Command(BaseCommand):
+    """
+    批量导入商品数据: python manage.py import_catalog goods.csv
+    每行一个商品SKU, 字段: id(可选, 存在时修改该商品), category, spu, name, title,
+    unit, price, stock, sales, image, status; 类别和SPU按名称查找,
+    类别必须已经存在(不存在时停止导入), SPU不存在时新增
+    """
+    help = '从CSV或JSONL文件批量导入商品'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV或JSONL文件路径')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='文件格式, 默认根据扩展名判断')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='每批保存的行数')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or (
+            'jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+        chunk_size = options['chunk_size']
+
+        start = time.time()
+        total = 0
+        category_ids = set()
+        # 导入期间不处理每一行的信号(缓存、排序和索引), 导入完成后统一处理
+        try:
+            with suppress_goods_signals(), open(path, encoding='utf-8') as file:
+                chunk = []
+                for row in read_rows(file, file_format):
+                    chunk.append(row)
+                    if len(chunk) >= chunk_size:
+                        category_ids |= self.import_chunk(chunk)
+                        total += len(chunk)
+                        chunk = []
+                        self.report(total, start)
+                if chunk:
+                    category_ids |= self.import_chunk(chunk)
+                    total += len(chunk)
+        except CommandError:
+            # 出错的这批数据已经回滚, 之前导入的数据需要更新缓存
+            if total:
+                self.refresh(category_ids)
+            raise
+
+        seconds = time.time() - start
+        self.stdout.write('导入完成: %s行, 用时%.1f秒, %.0f行/秒' % (
+            total, seconds, total / seconds if seconds else total))
+        self.refresh(category_ids)
+
+    def report(self, total, start):
+        seconds = time.time() - start
+        self.stdout.write('已导入%s行, %.0f行/秒' % (
+            total, total / seconds if seconds else total))
+
+    @transaction.atomic
+    def import_chunk(self, rows):
+        """
+        保存一批数据: 一次查询已经存在的商品, 新增的商品使用bulk_create,
+        修改的商品按修改的字段分组, 每组一条UPDATE ... CASE id WHEN ...语句
+        :return: 这批商品的类别id集合(包括修改了类别的商品原来的类别)
+        """
+        categories = get_categories_by_name({row['category'] for row in rows})
+        spus = get_or_create_by_name(GoodsSPU, {row['spu'] for row in rows})
+
+        # 有id的行: {商品id: 字段}, 同一个商品出现多次时使用最后一行
+        updates = {}
+        new_skus = []
+        for row in rows:
+            fields = sku_fields(row)
+            fields['category_id'] = categories[row['category']]
+            fields['spu_id'] = spus[row['spu']]
+            sku_id = row.get('id')
+            if sku_id:
+                try:
+                    updates[int(sku_id)] = fields
+                except ValueError:
+                    raise CommandError('商品id不正确: %s' % row)
+            else:
+                new_skus.append(GoodsSKU(**fields))
+
+        # 一次查询已经存在的商品和原来的类别
+        old_categories = dict(GoodsSKU.objects.filter(
+            id__in=list(updates)).values_list('id', 'category_id'))
+        groups = {}
+        for sku_id, fields in updates.items():
+            if sku_id in old_categories:
+                groups.setdefault(tuple(sorted(fields)), []).append(sku_id)
+            else:
+                # 指定了id但不存在的商品: 使用该id新增
+                new_skus.append(GoodsSKU(id=sku_id, **fields))
+        for field_names, sku_ids in groups.items():
+            # UPDATE不会自动修改update_time
+            GoodsSKU.objects.filter(id__in=sku_ids).update(
+                update_time=now(),
+                **{name: case_by_id(name, sku_ids, updates) for name in field_names})
+        GoodsSKU.objects.bulk_create(new_skus)
+        return set(categories.values()) | set(old_categories.values())
+
+    def refresh(self, category_ids):
+        """导入完成后: 更新缓存、列表页排序、输入提示、库存、全文检索索引和静态首页"""
+        for two_tier_cache in (category_cache, sku_cache, detail_cache,
+                               sku_count_cache):
+            two_tier_cache.clear()
+        bump_index_version()
+        bump_page_version()
+        for category_id in category_ids:
+            rebuild_category_rank(category_id)
+        rebuild_suggest_entries()
+        update_suggest_snapshot()
+        rebuild_sku_stock()
+        self.stdout.write('重新生成全文检索索引')
+        call_command('rebuild_search_index')
+        # 重新生成静态首页(只生成一次)
+        generate_static_index_page.delay()
+
+
+def read_rows(file, file_format):
+    """逐行读取文件, 返回字典的生成器(不会一次读取整个文件)"""
+    if file_format == 'csv':
+        for row in csv.DictReader(file):
+            yield row
+    else:
+        for line in file:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def sku_fields(row):
+    """一行数据转换为商品SKU的字段"""
+    try:
+        fields = {field: row[field] for field in SKU_FIELDS
+                  if row.get(field) not in (None, '')}
+        if 'price' in fields:
+            fields['price'] = Decimal(str(fields['price']))
+        for field in ('stock', 'sales'):
+            if field in fields:
+                fields[field] = int(fields[field])
+        if 'status' in fields:
+            fields['status'] = str(fields['status']).lower() in ('1', 'true')
+    except Exception as e:
+        raise CommandError('数据格式不正确: %s, %s' % (row, e))
+    if row.get('image'):
+        fields['default_image'] = row['image']
+    return fields
+
+
+def case_by_id(name, sku_ids, updates):
+    """字段name的CASE id WHEN ... THEN ...表达式"""
+    field = GoodsSKU._meta.get_field(name)
+    # 外键字段的值是id
+    output_field = IntegerField() if field.is_relation else field
+    return Case(*[When(id=sku_id, then=Value(updates[sku_id][name]))
+                  for sku_id in sku_ids], output_field=output_field)
+
+
+def get_categories_by_name(names):
+    """
+    按名称查询类别, 不新增类别(类别需要图标和图片, 在后台添加)
+    :return: {名称: id}
+    :raise CommandError: 有不存在的类别
+    """
+    ids = dict(GoodsCategory.objects.filter(name__in=names).values_list('name', 'id'))
+    missing = sorted(name for name in names if name not in ids)
+    if missing:
+        raise CommandError('类别不存在, 请先在后台添加: %s' % ', '.join(missing))
+    return ids
+
+
+def get_or_create_by_name(model, names):
+    """
+    按名称查询SPU, 不存在的批量新增
+    :return: {名称: id}
+    """
+    ids = dict(model.objects.filter(name__in=names).values_list('name', 'id'))
+    missing = [name for name in names if name not in ids]
+    if missing:
+        model.objects.bulk_create([model(name=name) for name in missing])
+        # MySQL的bulk_create不会返回新增数据的id, 需要重新查询
+        ids.update(model.objects.filter(name__in=missing).values_list('name', 'id'))
+    return ids
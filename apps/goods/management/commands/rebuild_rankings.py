@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from apps.goods.models import GoodsCategory
+from apps.goods.ranking import rebuild_category_rank
+
+
+class Command(BaseCommand):
+    """重新生成所有类别的商品排序数据(Redis有序集合): python manage.py rebuild_rankings"""
+    help = '重新生成列表页使用的类别商品排序数据'
+
+    def handle(self, *args, **options):
+        for category in GoodsCategory.objects.all():
+            count = rebuild_category_rank(category.id)
+            self.stdout.write('%s: %s个商品' % (category.name, count))
@@ -0,0 +1,42 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.goods.search import rebuild_index, optimize_index
+
+
+class Command(BaseCommand):
+    """
+    使用多进程重新生成全文检索索引: python manage.py rebuild_search_index --procs 4
+    在新的目录中生成索引, 完成后替换原来的目录, 生成过程中可以正常搜索
+    """
+    help = '使用多进程重新生成全文检索索引'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--procs', type=int,
+                            default=getattr(settings, 'SEARCH_INDEX_PROCS', 4),
+                            help='生成索引的进程数')
+        parser.add_argument('--limitmb', type=int,
+                            default=getattr(settings, 'SEARCH_INDEX_LIMITMB', 128),
+                            help='每个进程使用的内存上限(MB)')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='每次查询的数据数量')
+        parser.add_argument('--optimize', action='store_true',
+                            help='不重新生成, 只合并索引的段')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        if options['optimize']:
+            result = optimize_index()
+            if result is None:
+                self.stdout.write('正在更新索引, 请稍后再试')
+            else:
+                self.stdout.write('合并索引的段: %s -> %s' % result)
+            return
+
+        total = rebuild_index(options['procs'], options['limitmb'],
+                              options['chunk_size'])
+        seconds = time.time() - start
+        self.stdout.write('生成索引完成: %s条数据, 用时%.1f秒, %.0f条/秒' % (
+            total, seconds, total / seconds if seconds else total))
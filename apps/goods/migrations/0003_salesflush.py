@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goods', '0002_goodssku_list_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SalesFlush',
+            fields=[
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('update_time', models.DateTimeField(auto_now=True, verbose_name='修改时间')),
+                ('flush_id', models.CharField(max_length=32, primary_key=True, serialize=False, verbose_name='批次id')),
+            ],
+            options={
+                'db_table': 'df_sales_flush',
+                'verbose_name_plural': '商品销量批次',
+                'verbose_name': '商品销量批次',
+            },
+        ),
+    ]
@@ -60,6 +60,12 @@ class GoodsSKU(BaseModel):
         db_table = "df_goods_sku"
         verbose_name = "商品SKU"
         verbose_name_plural = verbose_name
+        # 商品列表页按类别过滤后排序: 价格、人气(销量)、新品(创建时间)
+        index_together = [
+            ['category', 'price'],
+            ['category', 'sales'],
+            ['category', 'create_time'],
+        ]
 
 
 class GoodsImage(BaseModel):
@@ -129,3 +135,17 @@ class IndexPromotion(BaseModel):
         db_table = "df_index_promotion"
         verbose_name = "主页促销活动"
         verbose_name_plural = verbose_name
+
+
+class SalesFlush(BaseModel):
+    """已经保存到数据库的一批商品销量(Redis中记录的销量), 防止重复保存"""
+    flush_id = models.CharField(max_length=32, primary_key=True,
+                                verbose_name="批次id")
+
+    def __str__(self):
+        return self.flush_id
+
+    class Meta:
+        db_table = "df_sales_flush"
+        verbose_name = "商品销量批次"
+        verbose_name_plural = verbose_name
@@ -0,0 +1,161 @@
+from django_redis import get_redis_connection
+
+from apps.goods.catalog import get_sku_summaries, sku_summary
+from apps.goods.models import GoodsSKU
+
+# 列表页排序使用的字段: 每个类别每个字段一个有序集合, 成员为商品id, 分数为字段值
+RANK_FIELDS = ('price', 'sales', 'create_time')
+# 有序集合的成员: 补0到固定长度的商品id, 分数相同时Redis按成员的字符串排序,
+# 与MySQL中按id排序的顺序一致(升序时id从小到大, 降序时从大到小)
+RANK_MEMBER_FORMAT = '%010d'
+
+# 列表页排序方式: sort参数 -> (排序字段, 是否降序)
+SORT_RANKS = {
+    'default': ('create_time', False),
+    'price': ('price', False),
+    'hot': ('sales', True),
+}
+
+
+def rank_key(category_id, field):
+    """类别商品排序的有序集合的键"""
+    return 'sku_rank_%s_%s' % (category_id, field)
+
+
+def rank_member(sku_id):
+    """商品id对应的有序集合成员"""
+    return RANK_MEMBER_FORMAT % int(sku_id)
+
+
+def sku_scores(sku, pending_sales=0):
+    """
+    商品在各个有序集合中的分数
+    :param pending_sales: Redis中记录的还没有保存到数据库的销量
+    """
+    return {
+        'price': float(sku.price),
+        'sales': sku.sales + pending_sales,
+        'create_time': sku.create_time.timestamp(),
+    }
+
+
+def zadd(redis_conn, key, score, member):
+    """添加有序集合成员(直接执行命令, 兼容不同版本的redis-py参数顺序)"""
+    redis_conn.execute_command('ZADD', key, score, member)
+
+
+def zincrby(redis_conn, key, amount, member):
+    """增加有序集合成员的分数"""
+    redis_conn.execute_command('ZINCRBY', key, amount, member)
+
+
+def update_sku_rank(sku, previous_category_id=None, pending_sales=None):
+    """
+    商品新增或修改后, 更新类别商品排序
+    :param previous_category_id: 修改前的类别id, 修改了类别时从原来的类别中删除
+    :param pending_sales: 还没有保存到数据库的销量, 为None时不修改销量的分数
+        (销量和类别都没有修改, 有序集合中的分数已经包含了没有保存的销量)
+    """
+    member = rank_member(sku.id)
+    pipeline = get_redis_connection().pipeline()
+    if previous_category_id is not None and previous_category_id != sku.category_id:
+        for field in RANK_FIELDS:
+            pipeline.zrem(rank_key(previous_category_id, field), member)
+    for field, score in sku_scores(sku, pending_sales or 0).items():
+        if field == 'sales' and pending_sales is None:
+            continue
+        zadd(pipeline, rank_key(sku.category_id, field), score, member)
+    pipeline.execute()
+
+
+def remove_sku_rank(sku):
+    """商品删除后, 从类别商品排序中删除"""
+    pipeline = get_redis_connection().pipeline()
+    for field in RANK_FIELDS:
+        pipeline.zrem(rank_key(sku.category_id, field), rank_member(sku.id))
+    pipeline.execute()
+
+
+def rebuild_category_rank(category_id, chunk_size=1000):
+    """
+    重新生成一个类别的商品排序
+    先写入临时的键, 完成后再重命名, 生成期间列表页继续使用旧数据
+    :return: 类别中的商品数量
+    """
+    from apps.goods.sales import get_pending_sales
+    pending_sales = get_pending_sales()
+    redis_conn = get_redis_connection()
+    tmp_keys = {field: rank_key(category_id, field) + '_tmp'
+                for field in RANK_FIELDS}
+    redis_conn.delete(*tmp_keys.values())
+
+    count = 0
+    pipeline = redis_conn.pipeline()
+    skus = GoodsSKU.objects.filter(category_id=category_id).only(
+        'id', 'price', 'sales', 'create_time').iterator()
+    for sku in skus:
+        for field, score in sku_scores(
+                sku, pending_sales.get(sku.id, 0)).items():
+            zadd(pipeline, tmp_keys[field], score, rank_member(sku.id))
+        count += 1
+        if count % chunk_size == 0:
+            pipeline.execute()
+    pipeline.execute()
+
+    pipeline = redis_conn.pipeline()
+    for field, tmp_key in tmp_keys.items():
+        if count:
+            pipeline.rename(tmp_key, rank_key(category_id, field))
+        else:
+            pipeline.delete(rank_key(category_id, field))
+    pipeline.execute()
+    return count
+
+
+class RankedSkus(object):
+    """
+    类别中排好序的商品, 可以直接传给django的Paginator分页:
+    通过有序集合的ZCARD获取数量, 通过ZRANGE获取一页商品id,
+    再从商品摘要缓存中读取商品数据; 分数相同时的顺序与KeysetPaginator按id排序一致
+    """
+
+    def __init__(self, category_id, sort):
+        field, self.descending = SORT_RANKS.get(sort, SORT_RANKS['default'])
+        self.key = rank_key(category_id, field)
+        self.redis_conn = get_redis_connection()
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self.redis_conn.zcard(self.key)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start = index.start or 0
+        stop = index.stop if index.stop is not None else self.count()
+        if stop <= start:
+            return []
+        if self.descending:
+            sku_ids = self.redis_conn.zrevrange(self.key, start, stop - 1)
+        else:
+            sku_ids = self.redis_conn.zrange(self.key, start, stop - 1)
+        return get_sku_summaries(sku_ids)
+
+
+def get_new_skus(category_id, count=2):
+    """
+    类别中最新的商品(新品推荐), 返回商品摘要列表
+    优先从Redis的排序数据中读取, 还没有生成排序数据时查询数据库
+    """
+    sku_ids = get_redis_connection().zrevrange(
+        rank_key(category_id, 'create_time'), 0, count - 1)
+    if sku_ids:
+        return get_sku_summaries(sku_ids)
+    skus = GoodsSKU.objects.filter(
+        category_id=category_id).order_by('-create_time')[0:count]
+    return [sku_summary(sku) for sku in skus]
@@ -0,0 +1,140 @@
+import uuid
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Case, When, Value, F, IntegerField
+from django.utils.timezone import now
+from django_redis import get_redis_connection
+from redis.exceptions import LockError
+
+from apps.goods.models import GoodsSKU, SalesFlush
+from apps.goods.ranking import rank_key, rank_member, zincrby
+from utils.lua import LuaScript
+
+# 还没有保存到数据库的商品销量: {商品id: 增加的销量}
+SALES_BUFFER_KEY = 'sku_sales_buffer'
+# 正在保存到数据库的商品销量
+SALES_FLUSHING_KEY = 'sku_sales_flushing'
+# 正在保存的这批销量的批次id(保存时在同一个事务中记录到SalesFlush表)
+SALES_FLUSH_ID_KEY = 'sku_sales_flush_id'
+# SalesFlush表中批次id保存的天数
+SALES_FLUSH_KEEP_DAYS = 1
+# 保存销量的锁: 同时只有一个celery任务保存销量
+SALES_LOCK_KEY = 'sku_sales_flush_lock'
+SALES_LOCK_TIMEOUT = 60 * 5
+
+# 开始保存一批销量: 没有正在保存的销量时, 把新的销量重命名为正在保存的销量并生成批次id;
+# 上次保存失败时(正在保存的键还在)不重命名, 使用上次的批次id
+# KEYS: 新的销量, 正在保存的销量, 批次id; ARGV: 新的批次id
+# 返回: 批次id, 没有需要保存的销量时返回nil
+START_FLUSH = LuaScript("""
+if redis.call('exists', KEYS[2]) == 0 then
+    if redis.call('exists', KEYS[1]) == 0 then
+        return false
+    end
+    redis.call('renamenx', KEYS[1], KEYS[2])
+    redis.call('del', KEYS[3])
+end
+redis.call('set', KEYS[3], ARGV[1], 'NX')
+return redis.call('get', KEYS[3])
+""")
+
+
+def record_sales(sales):
+    """
+    订单提交成功后记录商品销量: 先保存到Redis, 由celery定时任务批量保存到数据库,
+    同时更新列表页的人气排序
+    :param sales: [(类别id, 商品id, 购买数量), ...]
+    """
+    pipeline = get_redis_connection().pipeline()
+    add_sales(pipeline, sales)
+    pipeline.execute()
+
+
+def add_sales(pipeline, sales):
+    """在pipeline中记录商品销量"""
+    for category_id, sku_id, count in sales:
+        pipeline.hincrby(SALES_BUFFER_KEY, sku_id, count)
+        zincrby(pipeline, rank_key(category_id, 'sales'), count,
+                rank_member(sku_id))
+
+
+def get_pending_sales(sku_ids=None):
+    """
+    还没有保存到数据库的商品销量
+    正在保存的一批销量已经提交到数据库(还没有从Redis删除)时不再计算, 避免重复计算
+    :param sku_ids: 商品id列表, 为None时返回所有商品
+    :return: {商品id: 销量}
+    """
+    redis_conn = get_redis_connection()
+    keys = [SALES_BUFFER_KEY]
+    flush_id = redis_conn.get(SALES_FLUSH_ID_KEY)
+    if flush_id is None or not SalesFlush.objects.filter(
+            flush_id=flush_id.decode()).exists():
+        keys.append(SALES_FLUSHING_KEY)
+
+    pending = {}
+    for key in keys:
+        if sku_ids is None:
+            items = redis_conn.hgetall(key).items()
+        else:
+            items = zip(sku_ids, redis_conn.hmget(key, sku_ids))
+        for sku_id, count in items:
+            if count:
+                sku_id = int(sku_id)
+                pending[sku_id] = pending.get(sku_id, 0) + int(count)
+    return pending
+
+
+def flush_sales(batch_size=500):
+    """
+    把Redis中记录的商品销量批量保存到数据库
+    每批商品只执行一条UPDATE ... CASE语句, 只修改销量字段;
+    在同一个事务中记录批次id, 保存后没有删除Redis中的数据时(进程退出), 不会重复保存
+    :return: 保存了销量的商品数量
+    """
+    redis_conn = get_redis_connection()
+    lock = redis_conn.lock(SALES_LOCK_KEY, timeout=SALES_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        # 其它任务正在保存
+        return 0
+    try:
+        return flush_sales_batch(redis_conn, batch_size)
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # 锁已过期
+            pass
+
+
+def flush_sales_batch(redis_conn, batch_size):
+    """保存一批销量(已获取到锁)"""
+    # 重命名后, 新的销量记录到新的键中; 上次保存失败时, 先保存上次的数据
+    flush_id = START_FLUSH([SALES_BUFFER_KEY, SALES_FLUSHING_KEY, SALES_FLUSH_ID_KEY],
+                           [uuid.uuid4().hex], redis_conn)
+    if flush_id is None:
+        # 没有需要保存的销量
+        return 0
+    flush_id = flush_id.decode()
+
+    sales = [(int(sku_id), int(count)) for sku_id, count
+             in redis_conn.hgetall(SALES_FLUSHING_KEY).items()]
+    if not SalesFlush.objects.filter(flush_id=flush_id).exists():
+        with transaction.atomic():
+            for i in range(0, len(sales), batch_size):
+                batch = sales[i:i + batch_size]
+                GoodsSKU.objects.filter(
+                    id__in=[sku_id for sku_id, _ in batch]).update(
+                    sales=F('sales') + Case(
+                        *[When(id=sku_id, then=Value(count))
+                          for sku_id, count in batch],
+                        default=Value(0), output_field=IntegerField()))
+            SalesFlush.objects.create(flush_id=flush_id)
+
+    # 事务提交后立即删除这批销量和批次id
+    redis_conn.delete(SALES_FLUSHING_KEY, SALES_FLUSH_ID_KEY)
+    # 批次id只需要保存一段时间
+    SalesFlush.objects.filter(
+        create_time__lt=now() - timedelta(days=SALES_FLUSH_KEEP_DAYS)).delete()
+    return len(sales)
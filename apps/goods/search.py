@@ -0,0 +1,408 @@
+import hashlib
+import os
+import shutil
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.conf import settings
+from django.db.models import signals
+from django_redis import get_redis_connection
+from haystack import connections
+from haystack.constants import ID
+from haystack.exceptions import NotHandled, SkipDocument
+from haystack.signals import BaseSignalProcessor
+from haystack.utils import get_identifier
+from redis.exceptions import ResponseError, LockError
+
+from utils.cache import TwoTierCache
+
+# 需要更新索引的数据: {'goods.goodssku.1': 'update'或'delete'}, 同一数据多次修改只记录最后一次
+INDEX_QUEUE_KEY = 'search_index_queue'
+# 正在更新索引的数据
+INDEX_PROCESSING_KEY = 'search_index_processing'
+# 更新索引时使用的锁
+INDEX_LOCK_KEY = 'search_index_lock'
+INDEX_LOCK_TIMEOUT = 60 * 10
+
+# 索引版本号的键: 索引更新后版本号加1, 缓存的搜索结果失效
+SEARCH_VERSION_KEY = 'search_index_version'
+# 每个线程保存的whoosh searcher
+_local = threading.local()
+# 搜索结果按价格区间过滤: (最低价, 最高价), 最高价为None表示不限
+PRICE_BANDS = ((0, 10), (10, 30), (30, 50), (50, 100), (100, None))
+
+# 搜索结果页面显示的字段
+RESULT_FIELDS = ('sku_id', 'name', 'price', 'unit', 'image_url')
+
+# 缓存的搜索结果: {'count': 总数量, 'results': [当前页的数据, ...]}, 键中包含版本号
+search_cache = TwoTierCache('search', maxsize=1000, local_timeout=30,
+                            timeout=60 * 10)
+
+# 索引段数超过MERGE_SEGMENTS时合并小的段, 超过OPTIMIZE_SEGMENTS时合并为一个段
+SEARCH_MERGE_SEGMENTS = getattr(settings, 'SEARCH_INDEX_MERGE_SEGMENTS', 10)
+SEARCH_OPTIMIZE_SEGMENTS = getattr(settings, 'SEARCH_INDEX_OPTIMIZE_SEGMENTS', 30)
+
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    """
+    haystack信号处理类: 数据修改后只在Redis中记录需要更新索引的数据id,
+    由celery定时任务批量更新索引, 请求处理过程中不会打开whoosh索引
+    settings: HAYSTACK_SIGNAL_PROCESSOR = 'apps.goods.search.QueuedSignalProcessor'
+    """
+
+    def setup(self):
+        signals.post_save.connect(self.handle_save)
+        signals.post_delete.connect(self.handle_delete)
+
+    def teardown(self):
+        signals.post_save.disconnect(self.handle_save)
+        signals.post_delete.disconnect(self.handle_delete)
+
+    def handle_save(self, sender, instance, **kwargs):
+        self.enqueue(sender, instance, 'update')
+
+    def handle_delete(self, sender, instance, **kwargs):
+        self.enqueue(sender, instance, 'delete')
+
+    def enqueue(self, sender, instance, action):
+        """记录需要更新索引的数据"""
+        try:
+            # 只处理创建了索引的模型类
+            self.connections['default'].get_unified_index().get_index(sender)
+        except NotHandled:
+            return
+        get_redis_connection().hset(INDEX_QUEUE_KEY,
+                                    get_identifier(instance), action)
+
+
+def remove_documents(backend, identifiers):
+    """从索引中删除数据: 使用一个writer, 只提交一次"""
+    if not backend.setup_complete:
+        backend.setup()
+    writer = backend.index.writer()
+    for identifier in identifiers:
+        writer.delete_by_term(ID, identifier)
+    writer.commit()
+
+
+@contextmanager
+def index_lock(redis_conn, blocking=False, timeout=INDEX_LOCK_TIMEOUT):
+    """
+    写索引的锁: 同一时间只有一个进程写索引, 避免争抢whoosh的写锁
+    :return: 是否获取到了锁
+    """
+    lock = redis_conn.lock(INDEX_LOCK_KEY, timeout=timeout)
+    acquired = lock.acquire(blocking=blocking)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            try:
+                lock.release()
+            except LockError:
+                # 锁已超时释放
+                pass
+
+
+def apply_index_queue(batch_size=500, using='default'):
+    """
+    批量更新Redis中记录的需要更新索引的数据
+    :return: 更新的数据数量
+    """
+    redis_conn = get_redis_connection()
+    with index_lock(redis_conn) as acquired:
+        if not acquired:
+            return 0
+        return apply_locked(redis_conn, batch_size, using)
+
+
+def apply_locked(redis_conn, batch_size, using):
+    """获取到锁之后更新索引"""
+    # 上次更新失败时, 先更新上次的数据
+    if not redis_conn.exists(INDEX_PROCESSING_KEY):
+        try:
+            # 重命名后, 新修改的数据记录到新的键中
+            redis_conn.rename(INDEX_QUEUE_KEY, INDEX_PROCESSING_KEY)
+        except ResponseError:
+            # 没有需要更新索引的数据
+            return 0
+
+    # 按模型类分组: {(app_label, model_name): {pk, ...}}
+    updates = defaultdict(set)
+    deletes = set()
+    items = redis_conn.hgetall(INDEX_PROCESSING_KEY)
+    for identifier, action in items.items():
+        identifier = identifier.decode()
+        if action == b'delete':
+            deletes.add(identifier)
+        else:
+            app_label, model_name, pk = identifier.split('.', 2)
+            updates[(app_label, model_name)].add(pk)
+
+    backend = connections[using].get_backend()
+    unified_index = connections[using].get_unified_index()
+    for (app_label, model_name), pks in updates.items():
+        model = apps.get_model(app_label, model_name)
+        index = unified_index.get_index(model)
+        pks = list(pks)
+        for i in range(0, len(pks), batch_size):
+            batch = pks[i:i + batch_size]
+            # 不在index_queryset中的数据(如已下线的商品)需要从索引中删除
+            objects = list(index.index_queryset(using=using).filter(pk__in=batch))
+            if objects:
+                # 一批数据只打开一次writer, 只提交一次
+                backend.update(index, objects)
+            found = {str(obj.pk) for obj in objects}
+            deletes |= {'%s.%s.%s' % (app_label, model_name, pk)
+                        for pk in batch if pk not in found}
+
+    if deletes:
+        remove_documents(backend, deletes)
+    bump_search_version(redis_conn)
+    redis_conn.delete(INDEX_PROCESSING_KEY)
+    return len(items)
+
+
+def segment_count(ix):
+    """索引的段数: 段越多, 查询时要读取的文件越多"""
+    if ix.is_empty():
+        return 0
+    # 每个段一个子reader
+    with ix.reader() as reader:
+        return len(reader.leaf_readers())
+
+
+def optimize_index(using='default'):
+    """
+    合并索引的段: 每次增量更新索引都会生成新的段, 段数超过阈值时合并
+    :return: (合并前的段数, 合并后的段数)
+    """
+    backend = connections[using].get_backend()
+    if not backend.setup_complete:
+        backend.setup()
+    with index_lock(get_redis_connection()) as acquired:
+        if not acquired:
+            # 正在更新索引, 下次再合并
+            return None
+        backend.index = backend.index.refresh()
+        before = segment_count(backend.index)
+        if before > SEARCH_OPTIMIZE_SEGMENTS:
+            # 合并为一个段
+            backend.index.writer().commit(optimize=True)
+        elif before > SEARCH_MERGE_SEGMENTS:
+            # 只合并小的段
+            backend.index.writer().commit(merge=True)
+        else:
+            return before, before
+        backend.index = backend.index.refresh()
+        return before, segment_count(backend.index)
+
+
+def rebuild_index(procs=1, limitmb=128, chunk_size=1000, using='default'):
+    """
+    重新生成全部索引: 在新的目录中使用多进程writer生成, 完成后替换原来的目录,
+    生成过程中查询仍然使用原来的索引
+    :param procs: 生成索引的进程数
+    :param limitmb: 每个进程使用的内存上限(MB)
+    :return: 索引的数据数量
+    """
+    backend = connections[using].get_backend()
+    if not backend.setup_complete:
+        backend.setup()
+    path = backend.path
+    new_path = path + '_new'
+    old_path = path + '_old'
+    for tmp_path in (new_path, old_path):
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+    os.makedirs(new_path)
+
+    from whoosh.filedb.filestore import FileStorage
+    ix = FileStorage(new_path).create_index(backend.schema)
+    # procs大于1时whoosh使用多进程的MpWriter
+    writer = ix.writer(procs=procs, limitmb=limitmb)
+    committed = False
+    try:
+        # 生成索引期间增量更新的数据留在队列中, 替换目录后再更新
+        with index_lock(get_redis_connection(), blocking=True,
+                        timeout=60 * 60 * 2):
+            total = 0
+            unified_index = connections[using].get_unified_index()
+            for model in unified_index.get_indexed_models():
+                index = unified_index.get_index(model)
+                queryset = index.index_queryset(using=using).order_by('pk')
+                # 按主键分批查询, 不会一次读取所有数据
+                last_pk = 0
+                while True:
+                    objects = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+                    if not objects:
+                        break
+                    for obj in objects:
+                        doc = prepare_document(backend, index, obj)
+                        if doc:
+                            writer.add_document(**doc)
+                            total += 1
+                    last_pk = objects[-1].pk
+            # 所有进程生成的段合并为一个段
+            writer.commit(optimize=True)
+            committed = True
+
+            os.rename(path, old_path)
+            os.rename(new_path, path)
+            shutil.rmtree(old_path)
+            backend.index = backend.index.refresh()
+    except BaseException:
+        # 生成失败: 停止writer的进程, 恢复原来的目录, 删除新的目录
+        if not committed:
+            writer.cancel()
+        if not os.path.exists(path) and os.path.exists(old_path):
+            os.rename(old_path, path)
+        shutil.rmtree(new_path, ignore_errors=True)
+        raise
+    bump_search_version(get_redis_connection())
+    return total
+
+
+def prepare_document(backend, index, obj):
+    """与haystack的whoosh后端一样准备索引的数据, 不需要索引时返回None"""
+    try:
+        doc = index.full_prepare(obj)
+    except SkipDocument:
+        return None
+    for key in doc:
+        doc[key] = backend._from_python(doc[key])
+    # whoosh不支持文档的boost
+    doc.pop('boost', None)
+    return doc
+
+
+def bump_search_version(redis_conn):
+    """索引版本号加1, 使缓存的搜索结果失效"""
+    redis_conn.incr(SEARCH_VERSION_KEY)
+
+
+def normalize_query(query):
+    """搜索关键字标准化: 去掉多余的空白, 转为小写, 结果相同的关键字使用同一个缓存"""
+    return ' '.join(query.split()).lower()
+
+
+def search_cache_key(query, *parts):
+    """搜索结果缓存的键: 索引版本号 + 关键字 + 页码和过滤条件"""
+    version = get_redis_connection().get(SEARCH_VERSION_KEY) or b'0'
+    query = hashlib.md5(normalize_query(query).encode()).hexdigest()
+    return '_'.join([version.decode(), query] + [str(part) for part in parts])
+
+
+def result_data(result):
+    """搜索结果转换为模板需要的普通字典数据"""
+    return {field: getattr(result, field) for field in RESULT_FIELDS}
+
+
+class CachedResults(object):
+    """
+    缓存的一页搜索结果, 用于Paginator: 只有总数量和当前页的数据
+    下标是在全部搜索结果中的位置, 只能读取当前页范围内的数据
+    """
+
+    def __init__(self, count, results, offset=0):
+        """
+        :param offset: 当前页第一条数据在全部搜索结果中的位置
+        """
+        self._count = count
+        self.results = results
+        self.offset = offset
+
+    def count(self):
+        return self._count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start = max((item.start or 0) - self.offset, 0)
+            stop = None if item.stop is None else max(item.stop - self.offset, 0)
+            return self.results[start:stop:item.step]
+        if not self.offset <= item < self.offset + len(self.results):
+            raise IndexError(item)
+        return self.results[item - self.offset]
+
+
+def search_facets(query_string, using='default'):
+    """
+    搜索结果的分面数量: 只搜索一次, 同时统计每个类别和每个价格区间的商品数量,
+    不需要每个类别或区间各搜索一次
+    :param query_string: haystack生成的查询字符串
+    :return: {'category': {类别id: 数量}, 'price': {价格区间序号: 数量}}
+    """
+    from whoosh import sorting
+    from whoosh.query import NumericRange
+
+    backend = connections[using].get_backend()
+    if not backend.setup_complete:
+        backend.setup()
+
+    facets = sorting.Facets()
+    facets.add_field('category')
+    facets.add_query('price', {
+        i: NumericRange('price_cents', low * 100,
+                        None if high is None else high * 100, endexcl=True)
+        for i, (low, high) in enumerate(PRICE_BANDS)})
+    query = backend.parser.parse(query_string)
+    # 分组统计所有匹配的商品, 不受limit影响
+    results = get_searcher(using).search(query, limit=1, groupedby=facets,
+                                         maptype=sorting.Count)
+    return {'category': results.groups('category'),
+            'price': results.groups('price')}
+
+
+def get_searcher(using='default'):
+    """
+    统计分面使用的whoosh searcher: 每个进程的每个线程一个, 一直保持打开,
+    索引更新后才重新打开(不需要每次查询都打开索引)
+    """
+    backend = connections[using].get_backend()
+    if not backend.setup_complete:
+        backend.setup()
+    # 重新生成索引时会替换目录(inode变化); fork之前打开的searcher不能在工作进程中使用
+    key = (os.getpid(), using, backend.path, os.stat(backend.path).st_ino)
+    searchers = getattr(_local, 'searchers', None)
+    if searchers is None:
+        searchers = _local.searchers = {}
+    searcher = searchers.get(key)
+    if searcher is None:
+        for old in searchers.values():
+            old.close()
+        searchers.clear()
+        searcher = backend.index.refresh().searcher()
+    elif not searcher.up_to_date():
+        searcher = searcher.refresh()
+    searchers[key] = searcher
+    return searcher
+
+
+def get_search_facets(query, query_string):
+    """读取缓存的分面数量: 与过滤条件和页码无关, 每个关键字只统计一次"""
+    key = search_cache_key(query, 'facets')
+    facets = search_cache.get(key)
+    if facets is None:
+        facets = search_facets(query_string)
+        search_cache.set(key, facets)
+    return facets
+
+
+def warm_up_search(using='default'):
+    """
+    预热全文检索: 加载jieba词典, 打开whoosh索引
+    在uwsgi主进程fork工作进程之前调用(wsgi.py), 工作进程第一次搜索时不再加载词典
+    """
+    backend = connections[using].get_backend()
+    if not backend.setup_complete:
+        backend.setup()
+    # 分词器第一次使用时加载jieba词典
+    analyzer = backend.schema[backend.content_field_name].analyzer
+    list(analyzer('天天生鲜'))
+    # 打开索引: 索引不存在或损坏时在启动时就能发现
+    get_searcher(using)
@@ -1,3 +1,4 @@
+from apps.goods.index_page import image_url
 from apps.goods.models import GoodsSKU
 from haystack import indexes
 
@@ -8,6 +9,19 @@ class GoodsSKUIndex(indexes.SearchIndex, indexes.Indexable):
     # 参数2： 通过模板来指定要对哪些表字段数据创建索引
     text = indexes.CharField(document=True, use_template=True)
 
+    # 搜索结果页面显示的字段保存在索引中, 显示搜索结果时不需要查询数据库
+    # (id是haystack使用的字段名, 商品id保存为sku_id)
+    sku_id = indexes.IntegerField(model_attr='id')
+    name = indexes.CharField(model_attr='name', indexed=False)
+    # 显示的价格保存为定点数的字符串(不经过二进制浮点数)
+    price = indexes.DecimalField(model_attr='price', indexed=False)
+    # 价格(分)使用整数类型, 可以按价格区间过滤和统计
+    price_cents = indexes.IntegerField()
+    unit = indexes.CharField(model_attr='unit', indexed=False)
+    image_url = indexes.CharField(indexed=False)
+    category = indexes.IntegerField(model_attr='category_id')
+    status = indexes.BooleanField(model_attr='status')
+
     def get_model(self):
         """商品SKU模型类，对应商品SKU表"""
         return GoodsSKU
@@ -15,3 +29,9 @@ class GoodsSKUIndex(indexes.SearchIndex, indexes.Indexable):
     def index_queryset(self, using=None):
         """要对表中的哪些数据创建索引"""
         return self.get_model().objects.filter(status=True)
+
+    def prepare_image_url(self, obj):
+        return image_url(obj.default_image)
+
+    def prepare_price_cents(self, obj):
+        return int(obj.price * 100)
@@ -0,0 +1,203 @@
+from contextlib import contextmanager
+
+from django.db.models.signals import pre_save, post_save, post_delete
+
+from apps.goods.catalog import category_cache, sku_cache, sku_count_cache, detail_cache, \
+    delete_spu_details, sku_summary
+from apps.goods.index_page import bump_index_version
+from apps.goods.models import GoodsCategory, GoodsSPU, GoodsSKU, GoodsImage, \
+    IndexSlideGoods, IndexPromotion, IndexCategoryGoods
+from apps.goods.ranking import update_sku_rank, remove_sku_rank, RANK_FIELDS
+from apps.goods.sales import get_pending_sales
+from apps.goods.stock import set_sku_stock, remove_sku_stock, ORDER_STOCK_FIELDS
+from apps.goods.suggest import update_suggest_entry, remove_suggest_entry
+from utils.page_cache import bump_page_version
+
+# 为True时不处理商品数据修改的信号(批量导入数据时)
+suppressed = False
+
+# 搜索框输入提示使用的商品字段
+SUGGEST_FIELDS = ('name', 'title', 'sales', 'status')
+
+# 商品的类别字段(update_fields中可能是这两个名称)
+CATEGORY_FIELDS = ('category', 'category_id')
+# 商品修改前需要记录原来的值的字段: 修改了SPU或类别时, 原来的SPU和类别的缓存也要失效;
+# 修改了销量或类别时, 重新计算排序中销量的分数
+PREVIOUS_FIELDS = ('spu_id', 'category_id', 'sales')
+
+# 修改后会影响首页显示的商品模型类
+GOODS_MODELS = (GoodsCategory, GoodsSPU, GoodsSKU, GoodsImage,
+                IndexSlideGoods, IndexPromotion, IndexCategoryGoods)
+
+
+def sku_pre_save(sender, instance, update_fields=None, **kwargs):
+    """
+    商品SKU保存前调用: 从数据库读取原来的SPU、类别和销量, 保存到instance.previous_values
+    (不依赖缓存, 缓存中没有商品数据时也能使原来的SPU和类别的缓存失效)
+    """
+    instance.previous_values = None
+    if suppressed or instance.pk is None:
+        return
+    if update_fields and not {'spu', 'category', 'spu_id', 'category_id', 'sales'} & \
+            set(update_fields):
+        return
+    instance.previous_values = GoodsSKU.objects.filter(pk=instance.pk).values(
+        *PREVIOUS_FIELDS).first()
+
+
+pre_save.connect(sku_pre_save, sender=GoodsSKU, dispatch_uid='sku_pre_save')
+
+
+def goods_changed(sender, instance, **kwargs):
+    """商品数据新增、修改或删除后调用: 使首页缓存和商品缓存失效"""
+    if suppressed:
+        return
+    if sender is GoodsSKU:
+        # post_delete信号没有created参数: 删除商品时缓存一定要失效
+        sku_changed(instance, kwargs.get('created', True))
+        return
+
+    bump_index_version()
+    bump_page_version()
+    if sender is GoodsCategory:
+        category_cache.delete('all')
+    elif sender is GoodsSPU:
+        # 详情页显示了商品SPU的描述
+        delete_spu_details([instance.id])
+
+
+def sku_changed(sku, force):
+    """
+    商品SKU新增、修改或删除后调用
+    :param force: 为False时, 页面显示的商品数据没有变化就不删除缓存
+    """
+    old = sku_cache.get(sku.id)
+    if not force and old == sku_summary(sku):
+        # 只修改了库存或销量(如提交订单): 页面缓存的数据没有变化
+        return
+
+    bump_index_version()
+    bump_page_version()
+    sku_cache.delete(sku.id)
+    # 新增、删除或修改了类别时, 类别中的商品数量会变化
+    sku_count_cache.delete(sku.category_id)
+    # 详情页缓存: 当前商品和同一SPU下的其它规格商品(修改了SPU时包括原来的SPU)
+    detail_cache.delete(sku.id)
+    spu_ids = {sku.spu_id}
+    previous = getattr(sku, 'previous_values', None)
+    if previous:
+        spu_ids.add(previous['spu_id'])
+        if previous['category_id'] != sku.category_id:
+            sku_count_cache.delete(previous['category_id'])
+    delete_spu_details(spu_ids)
+
+
+for model in GOODS_MODELS:
+    post_save.connect(goods_changed, sender=model,
+                      dispatch_uid='index_page_%s_save' % model.__name__)
+    post_delete.connect(goods_changed, sender=model,
+                        dispatch_uid='index_page_%s_delete' % model.__name__)
+
+
+def sku_pending_sales(instance, created, update_fields):
+    """
+    需要重新计算销量的分数时, 返回商品还没有保存到数据库的销量; 不需要时返回None
+    (只修改了价格等字段时不读取Redis和SalesFlush表)
+    """
+    if created:
+        # 新增的商品还没有销量
+        return 0
+    previous = getattr(instance, 'previous_values', None)
+    if previous is None:
+        if update_fields:
+            # 没有修改销量和类别
+            return None
+    elif previous['sales'] == instance.sales and \
+            previous['category_id'] == instance.category_id:
+        return None
+    return get_pending_sales([instance.id]).get(instance.id, 0)
+
+
+def sku_saved(sender, instance, created=False, update_fields=None, **kwargs):
+    """商品SKU新增或修改后调用: 更新列表页的排序数据"""
+    if suppressed:
+        return
+    if update_fields and not set(update_fields) & set(RANK_FIELDS + CATEGORY_FIELDS):
+        # 没有修改排序字段和类别(如提交订单时只修改了库存)
+        return
+    previous = getattr(instance, 'previous_values', None)
+    update_sku_rank(instance, previous['category_id'] if previous else None,
+                    sku_pending_sales(instance, created, update_fields))
+
+
+def sku_deleted(sender, instance, **kwargs):
+    """商品SKU删除后调用: 从列表页的排序数据中删除"""
+    if suppressed:
+        return
+    remove_sku_rank(instance)
+
+
+post_save.connect(sku_saved, sender=GoodsSKU, dispatch_uid='sku_rank_save')
+post_delete.connect(sku_deleted, sender=GoodsSKU, dispatch_uid='sku_rank_delete')
+
+
+def sku_suggest_saved(sender, instance, update_fields=None, **kwargs):
+    """商品SKU新增或修改后调用: 更新搜索框的输入提示数据"""
+    if suppressed:
+        return
+    if update_fields and not set(update_fields) & set(SUGGEST_FIELDS):
+        return
+    update_suggest_entry(instance)
+
+
+def sku_suggest_deleted(sender, instance, **kwargs):
+    """商品SKU删除后调用: 删除搜索框的输入提示数据"""
+    if suppressed:
+        return
+    remove_suggest_entry(instance)
+
+
+post_save.connect(sku_suggest_saved, sender=GoodsSKU,
+                  dispatch_uid='sku_suggest_save')
+post_delete.connect(sku_suggest_deleted, sender=GoodsSKU,
+                    dispatch_uid='sku_suggest_delete')
+
+
+def sku_stock_saved(sender, instance, update_fields=None, **kwargs):
+    """商品SKU新增或修改后调用: 更新Redis中的库存和上架状态"""
+    if suppressed:
+        return
+    if update_fields and set(update_fields) <= set(ORDER_STOCK_FIELDS):
+        # 提交订单时修改的库存: 事务提交后再修改Redis中的库存
+        return
+    set_sku_stock(instance)
+
+
+def sku_stock_deleted(sender, instance, **kwargs):
+    """商品SKU删除后调用: 删除Redis中的库存"""
+    if suppressed:
+        return
+    remove_sku_stock(instance.id)
+
+
+post_save.connect(sku_stock_saved, sender=GoodsSKU,
+                  dispatch_uid='sku_stock_save')
+post_delete.connect(sku_stock_deleted, sender=GoodsSKU,
+                    dispatch_uid='sku_stock_delete')
+
+
+@contextmanager
+def suppress_goods_signals():
+    """
+    暂停处理商品数据修改的信号, 包括haystack实时更新索引的信号,
+    用于批量导入数据, 导入完成后由调用者统一更新缓存和索引
+    """
+    from haystack import signal_processor
+    global suppressed
+    suppressed = True
+    signal_processor.teardown()
+    try:
+        yield
+    finally:
+        suppressed = False
+        signal_processor.setup()
@@ -0,0 +1,96 @@
+from django_redis import get_redis_connection
+
+from apps.goods.models import GoodsSKU
+
+# 商品库存: {商品id: 库存}, 添加到购物车时校验库存不需要查询MySQL
+SKU_STOCK_KEY = 'sku_stock'
+# 上架的商品id集合
+SKU_ONLINE_KEY = 'sku_online'
+# 提交订单时只修改这些字段, 库存由提交订单的代码在事务提交后修改
+ORDER_STOCK_FIELDS = ('stock', 'update_time')
+
+
+def set_sku_stock(sku, client=None):
+    """保存商品的库存和上架状态"""
+    pipeline = (client or get_redis_connection()).pipeline()
+    add_sku_stock(pipeline, sku)
+    pipeline.execute()
+
+
+def add_sku_stock(pipeline, sku):
+    """在pipeline中保存商品的库存和上架状态"""
+    pipeline.hset(SKU_STOCK_KEY, sku.id, sku.stock)
+    if sku.status:
+        pipeline.sadd(SKU_ONLINE_KEY, sku.id)
+    else:
+        pipeline.srem(SKU_ONLINE_KEY, sku.id)
+
+
+def remove_sku_stock(sku_id):
+    """商品删除后删除库存"""
+    pipeline = get_redis_connection().pipeline()
+    pipeline.hdel(SKU_STOCK_KEY, sku_id)
+    pipeline.srem(SKU_ONLINE_KEY, sku_id)
+    pipeline.execute()
+
+
+def decr_sku_stock(items, client=None):
+    """
+    订单提交成功后减少库存: 使用HINCRBY, 同时提交的订单不会互相覆盖
+    :param items: [(商品id, 购买数量), ...]
+    """
+    pipeline = (client or get_redis_connection()).pipeline()
+    add_decr_sku_stock(pipeline, items)
+    pipeline.execute()
+
+
+def add_decr_sku_stock(pipeline, items):
+    """在pipeline中减少库存"""
+    for sku_id, count in items:
+        pipeline.hincrby(SKU_STOCK_KEY, sku_id, -count)
+
+
+def load_sku_stock(sku_id):
+    """
+    Redis中没有商品的库存时从数据库读取
+    :return: 商品是否存在
+    """
+    return bool(load_sku_stocks([sku_id]))
+
+
+def load_sku_stocks(sku_ids):
+    """
+    Redis中没有商品的库存时从数据库批量读取(一次查询)
+    :return: 存在的商品id集合
+    """
+    try:
+        skus = GoodsSKU.objects.only('id', 'stock', 'status').in_bulk(
+            [int(sku_id) for sku_id in sku_ids])
+    except ValueError:
+        return set()
+    pipeline = get_redis_connection().pipeline()
+    for sku in skus.values():
+        add_sku_stock(pipeline, sku)
+    pipeline.execute()
+    return set(skus)
+
+
+def rebuild_sku_stock(chunk_size=1000):
+    """从数据库重新生成所有商品的库存和上架状态(批量导入商品后)"""
+    redis_conn = get_redis_connection()
+    stock_tmp, online_tmp = SKU_STOCK_KEY + '_tmp', SKU_ONLINE_KEY + '_tmp'
+    redis_conn.delete(stock_tmp, online_tmp)
+    pipeline = redis_conn.pipeline()
+    queryset = GoodsSKU.objects.values_list('id', 'stock', 'status').order_by('id')
+    for i, (sku_id, stock, status) in enumerate(queryset.iterator(), 1):
+        pipeline.hset(stock_tmp, sku_id, stock)
+        if status:
+            pipeline.sadd(online_tmp, sku_id)
+        if i % chunk_size == 0:
+            pipeline.execute()
+    pipeline.execute()
+    for tmp_key, key in ((stock_tmp, SKU_STOCK_KEY), (online_tmp, SKU_ONLINE_KEY)):
+        if redis_conn.exists(tmp_key):
+            redis_conn.rename(tmp_key, key)
+        else:
+            redis_conn.delete(key)
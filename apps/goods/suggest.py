@@ -0,0 +1,450 @@
+import heapq
+import json
+import threading
+import time
+import zlib
+from bisect import bisect_left, bisect_right
+
+from django_redis import get_redis_connection
+from redis.exceptions import LockError
+
+from apps.goods.models import GoodsSKU
+from utils.lua import LuaScript
+
+# 上架商品的输入提示数据: {商品id: json([名称, 简介, 销量])}, 重新生成有序数组时使用
+SUGGEST_ENTRIES_KEY = 'suggest_entries'
+# 输入提示数据的版本号: 每次修改加1
+SUGGEST_VERSION_KEY = 'suggest_version'
+# 修改记录: [json([版本号, [商品id, 名称, 简介, 销量]]), ...], 删除或下架时只有商品id
+# 各进程按版本号的顺序应用到进程内的有序数组, 生成快照后删除快照中已包含的记录
+SUGGEST_CHANGES_KEY = 'suggest_changes'
+# 生成的有序数组(压缩的json)和生成时的版本号, 所有进程共用
+SUGGEST_SNAPSHOT_KEY = 'suggest_snapshot'
+SUGGEST_SNAPSHOT_VERSION_KEY = 'suggest_snapshot_version'
+# 生成快照的锁: 同时只有一个进程生成
+SUGGEST_LOCK_KEY = 'suggest_snapshot_lock'
+SUGGEST_LOCK_TIMEOUT = 60 * 5
+
+# 返回的提示数量
+SUGGEST_LIMIT = 10
+# 预先计算的销量最高的商品数量: 比返回的多一些, 商品下架后一般不需要重新计算
+TOP_SIZE = SUGGEST_LIMIT * 2
+# 匹配的商品超过这么多个的前缀预先计算销量最高的商品, 其它前缀查询时比较全部匹配的商品
+MAX_SCAN = 1000
+# 进程内的数据每5秒检查一次是否有新的修改
+CHECK_INTERVAL = 5
+
+
+def normalize(text):
+    """前缀匹配时不区分大小写, 去掉多余的空白"""
+    return ' '.join((text or '').split()).lower()
+
+
+def entry_keys(name, title):
+    """商品的名称和简介用于前缀匹配的键"""
+    return {key for key in (normalize(name), normalize(title)) if key}
+
+
+def key_prefixes(key):
+    return {key[:length] for length in range(1, len(key) + 1)}
+
+
+class Suggester(object):
+    """商品名称前缀匹配: 名称和简介组成有序数组, 使用二分查找, 按销量排序"""
+
+    def __init__(self, keys, ids, skus, top):
+        # keys和ids一一对应, 按(key, id)排序
+        self.keys = keys
+        self.ids = ids
+        # {商品id: (名称, 销量, 简介)}
+        self.skus = skus
+        # {匹配的商品超过MAX_SCAN个的前缀: [销量最高的商品id, ...]}
+        self.top = top
+
+    @classmethod
+    def build(cls, entries):
+        """
+        :param entries: [(商品id, 名称, 简介, 销量), ...]
+        """
+        skus = {}
+        pairs = set()
+        for sku_id, name, title, sales in entries:
+            skus[sku_id] = (name, sales, title)
+            pairs.update((key, sku_id) for key in entry_keys(name, title))
+        pairs = sorted(pairs)
+        suggester = cls([key for key, _ in pairs], [sku_id for _, sku_id in pairs],
+                        skus, {})
+        suggester.build_top()
+        return suggester
+
+    def build_top(self):
+        """预先计算匹配的商品很多的前缀: 逐个增加前缀的长度, 只在上一层超过MAX_SCAN的范围中查找"""
+        ranges = [(0, len(self.keys))]
+        length = 1
+        while ranges:
+            next_ranges = []
+            for start, end in ranges:
+                while start < end:
+                    key = self.keys[start]
+                    if len(key) < length:
+                        # 与上一层的前缀相同
+                        start = bisect_right(self.keys, key, start, end)
+                        continue
+                    prefix = key[:length]
+                    stop = self.prefix_end(prefix, start, end)
+                    if stop - start > MAX_SCAN:
+                        self.top[prefix] = self.rank_range(start, stop, TOP_SIZE)
+                        next_ranges.append((start, stop))
+                    start = stop
+            ranges = next_ranges
+            length += 1
+
+    def prefix_end(self, prefix, start, end=None):
+        """从start开始, 以prefix开头的最后一个键的下一个位置"""
+        if end is None:
+            end = len(self.keys)
+        return bisect_left(self.keys, prefix + '\uffff', start, end)
+
+    def rank_range(self, start, end, limit=SUGGEST_LIMIT):
+        """有序数组[start, end)中销量最高的limit个商品id"""
+        return heapq.nlargest(limit, set(self.ids[start:end]),
+                              key=lambda sku_id: self.skus[sku_id][1])
+
+    def suggest(self, prefix, limit=SUGGEST_LIMIT):
+        """
+        名称或简介以prefix开头的商品
+        :return: [{'id': 商品id, 'name': 名称}, ...]
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        sku_ids = self.top.get(prefix)
+        if sku_ids is None:
+            # 匹配的商品不超过MAX_SCAN个
+            start = bisect_left(self.keys, prefix)
+            sku_ids = self.rank_range(start, self.prefix_end(prefix, start), limit)
+        return [{'id': sku_id, 'name': self.skus[sku_id][0]}
+                for sku_id in sku_ids[:limit]]
+
+    def apply(self, change):
+        """
+        应用一条修改记录
+        :param change: [商品id, 名称, 简介, 销量], 删除时为[商品id]
+        """
+        if len(change) == 1:
+            self.remove(change[0])
+        else:
+            self.update(*change)
+
+    def update(self, sku_id, name, title, sales):
+        """商品新增或修改: 在有序数组中插入新的键, 调整相关前缀的排序"""
+        prefixes = self.remove_keys(sku_id)
+        self.skus[sku_id] = (name, sales, title)
+        for key in entry_keys(name, title):
+            start = bisect_left(self.keys, key)
+            index = bisect_left(self.ids, sku_id, start,
+                                bisect_right(self.keys, key, start))
+            self.keys.insert(index, key)
+            self.ids.insert(index, sku_id)
+            prefixes.update(key_prefixes(key))
+        self.update_top(prefixes, sku_id)
+
+    def remove(self, sku_id):
+        """商品删除或下架"""
+        prefixes = self.remove_keys(sku_id)
+        self.skus.pop(sku_id, None)
+        self.update_top(prefixes, sku_id)
+
+    def remove_keys(self, sku_id):
+        """
+        从有序数组中删除商品的键
+        :return: 删除的键的全部前缀
+        """
+        if sku_id not in self.skus:
+            return set()
+        name, _, title = self.skus[sku_id]
+        prefixes = set()
+        for key in entry_keys(name, title):
+            start = bisect_left(self.keys, key)
+            index = bisect_left(self.ids, sku_id, start,
+                                bisect_right(self.keys, key, start))
+            del self.keys[index]
+            del self.ids[index]
+            prefixes.update(key_prefixes(key))
+        return prefixes
+
+    def update_top(self, prefixes, sku_id):
+        """
+        商品修改后调整预先计算的排序: 只移动这个商品的位置,
+        剩下的商品不够SUGGEST_LIMIT个时重新计算
+        """
+        if sku_id in self.skus:
+            name, sales, title = self.skus[sku_id]
+            keys = entry_keys(name, title)
+        else:
+            sales, keys = None, ()
+        for prefix in prefixes:
+            start = bisect_left(self.keys, prefix)
+            end = self.prefix_end(prefix, start)
+            if end - start <= MAX_SCAN:
+                self.top.pop(prefix, None)
+                continue
+            top = self.top.get(prefix)
+            if top is None:
+                # 匹配的商品超过了MAX_SCAN个
+                self.top[prefix] = self.rank_range(start, end, TOP_SIZE)
+                continue
+            if sku_id in top:
+                top.remove(sku_id)
+            # top中是销量最高的len(top)个商品, 不在top中的商品销量都不高于最后一个
+            if any(key.startswith(prefix) for key in keys) and (
+                    not top or sales >= self.skus[top[-1]][1]):
+                index = next((i for i, top_id in enumerate(top)
+                              if self.skus[top_id][1] < sales), len(top))
+                top.insert(index, sku_id)
+                del top[TOP_SIZE:]
+            if len(top) < SUGGEST_LIMIT:
+                self.top[prefix] = self.rank_range(start, end, TOP_SIZE)
+
+    def copy(self):
+        return Suggester(list(self.keys), list(self.ids), dict(self.skus),
+                         {prefix: list(sku_ids) for prefix, sku_ids in self.top.items()})
+
+    def dumps(self):
+        data = {
+            'keys': self.keys,
+            'ids': self.ids,
+            'skus': [[sku_id, name, sales, title]
+                     for sku_id, (name, sales, title) in self.skus.items()],
+            'top': self.top,
+        }
+        return zlib.compress(json.dumps(data, ensure_ascii=False).encode())
+
+    @classmethod
+    def loads(cls, payload):
+        """从快照恢复, 不需要重新排序"""
+        data = json.loads(zlib.decompress(payload).decode())
+        skus = {sku_id: (name, sales, title)
+                for sku_id, name, sales, title in data['skus']}
+        return cls(data['keys'], data['ids'], skus, data['top'])
+
+
+def apply_changes(suggester, version, changes):
+    """
+    按顺序应用版本号大于version的修改记录, 版本号不连续(缺少修改记录)时停止
+    :return: 应用后的版本号
+    """
+    for change_version, change in changes:
+        if change_version <= version:
+            continue
+        if change_version != version + 1:
+            break
+        suggester.apply(change)
+        version = change_version
+    return version
+
+
+def read_changes(redis_conn):
+    """
+    :return: (当前的版本号, 快照的版本号(没有快照时为None), [(版本号, 修改), ...])
+    """
+    pipeline = redis_conn.pipeline()
+    pipeline.get(SUGGEST_VERSION_KEY)
+    pipeline.get(SUGGEST_SNAPSHOT_VERSION_KEY)
+    pipeline.lrange(SUGGEST_CHANGES_KEY, 0, -1)
+    version, snapshot_version, changes = pipeline.execute()
+    if snapshot_version is not None:
+        snapshot_version = int(snapshot_version)
+    return (int(version or 0), snapshot_version,
+            [json.loads(change.decode()) for change in changes])
+
+
+def entry_value(sku):
+    return json.dumps([sku.name, sku.title, sku.sales], ensure_ascii=False)
+
+
+# 修改输入提示数据, 同时增加版本号并记录修改: 记录的顺序与版本号一致
+# KEYS: 输入提示数据, 版本号, 修改记录
+# ARGV: 商品id, 输入提示数据(为空时删除), 修改(json)
+SAVE_ENTRY = LuaScript("""
+if ARGV[2] == '' then
+    redis.call('hdel', KEYS[1], ARGV[1])
+else
+    redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+end
+local version = redis.call('incr', KEYS[2])
+redis.call('rpush', KEYS[3], '[' .. version .. ',' .. ARGV[3] .. ']')
+return version
+""")
+
+
+def save_entry(sku, online):
+    if online:
+        value = entry_value(sku)
+        change = [sku.id, sku.name, sku.title, sku.sales]
+    else:
+        value = ''
+        change = [sku.id]
+    SAVE_ENTRY([SUGGEST_ENTRIES_KEY, SUGGEST_VERSION_KEY, SUGGEST_CHANGES_KEY],
+               [sku.id, value, json.dumps(change, ensure_ascii=False)])
+
+
+def update_suggest_entry(sku):
+    """商品修改后更新输入提示数据: 下架的商品删除"""
+    save_entry(sku, sku.status)
+
+
+def remove_suggest_entry(sku):
+    """商品删除后删除输入提示数据"""
+    save_entry(sku, False)
+
+
+def rebuild_suggest_entries(chunk_size=1000):
+    """从数据库重新生成输入提示数据(同时更新销量)"""
+    redis_conn = get_redis_connection()
+    tmp_key = SUGGEST_ENTRIES_KEY + '_tmp'
+    redis_conn.delete(tmp_key)
+    queryset = GoodsSKU.objects.filter(status=True).only(
+        'id', 'name', 'title', 'sales', 'status').order_by('id')
+    pipeline = redis_conn.pipeline()
+    for i, sku in enumerate(queryset.iterator(), 1):
+        pipeline.hset(tmp_key, sku.id, entry_value(sku))
+        if i % chunk_size == 0:
+            pipeline.execute()
+    pipeline.execute()
+    if redis_conn.exists(tmp_key):
+        redis_conn.rename(tmp_key, SUGGEST_ENTRIES_KEY)
+    else:
+        redis_conn.delete(SUGGEST_ENTRIES_KEY)
+    redis_conn.incr(SUGGEST_VERSION_KEY)
+
+
+def update_suggest_snapshot(force=False):
+    """
+    把修改记录应用到快照, 保存到Redis中供所有进程读取;
+    还没有快照、缺少修改记录(重新生成了输入提示数据)或者force时重新生成有序数组
+    :return: 快照的版本号, 没有修改或其它进程正在生成时返回None
+    """
+    redis_conn = get_redis_connection()
+    lock = redis_conn.lock(SUGGEST_LOCK_KEY, timeout=SUGGEST_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        return None
+    try:
+        return save_suggest_snapshot(redis_conn, force)
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # 锁已过期
+            pass
+
+
+def save_suggest_snapshot(redis_conn, force):
+    """生成快照(已获取到锁)"""
+    version, snapshot_version, changes = read_changes(redis_conn)
+    if not force and version == snapshot_version:
+        return None
+    suggester = None
+    if not force and snapshot_version is not None:
+        payload = redis_conn.get(SUGGEST_SNAPSHOT_KEY)
+        if payload is not None:
+            suggester = Suggester.loads(payload)
+            if apply_changes(suggester, snapshot_version, changes) != version:
+                suggester = None
+    if suggester is None:
+        suggester, version = build_suggester(redis_conn)
+    pipeline = redis_conn.pipeline()
+    pipeline.set(SUGGEST_SNAPSHOT_KEY, suggester.dumps())
+    pipeline.set(SUGGEST_SNAPSHOT_VERSION_KEY, version)
+    # 删除快照中已包含的修改记录: 记录按版本号排序, 新的记录添加在最后
+    pipeline.ltrim(SUGGEST_CHANGES_KEY,
+                   sum(1 for change_version, _ in changes if change_version <= version), -1)
+    pipeline.execute()
+    return version
+
+
+def build_suggester(redis_conn):
+    """
+    从输入提示数据重新生成有序数组
+    :return: (Suggester, 版本号)
+    """
+    if not redis_conn.exists(SUGGEST_ENTRIES_KEY):
+        rebuild_suggest_entries()
+    pipeline = redis_conn.pipeline()
+    pipeline.get(SUGGEST_VERSION_KEY)
+    pipeline.hgetall(SUGGEST_ENTRIES_KEY)
+    version, values = pipeline.execute()
+    entries = []
+    for sku_id, value in values.items():
+        name, title, sales = json.loads(value.decode())
+        entries.append((int(sku_id), name, title, sales))
+    return Suggester.build(entries), int(version or 0)
+
+
+class LocalSuggester(object):
+    """
+    进程内的输入提示数据: 每隔CHECK_INTERVAL秒按顺序应用Redis中新的修改记录,
+    第一次使用或缺少修改记录时读取快照; 还没有快照时没有数据(预热或celery任务中生成)
+    """
+
+    def __init__(self):
+        self.suggester = None
+        self.version = None
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        if time.time() - self.checked < CHECK_INTERVAL:
+            return self.suggester
+        with self.lock:
+            if time.time() - self.checked >= CHECK_INTERVAL:
+                self.reload()
+                self.checked = time.time()
+        return self.suggester
+
+    def reload(self):
+        redis_conn = get_redis_connection()
+        version, snapshot_version, changes = read_changes(redis_conn)
+        if version == self.version:
+            return
+        if self.suggester is not None:
+            # 修改副本, 其它线程仍然使用原来的数据
+            suggester = self.suggester.copy()
+            if apply_changes(suggester, self.version, changes) == version:
+                self.suggester, self.version = suggester, version
+                return
+        if snapshot_version is None:
+            # 还没有生成快照
+            return
+        pipeline = redis_conn.pipeline()
+        pipeline.get(SUGGEST_SNAPSHOT_VERSION_KEY)
+        pipeline.get(SUGGEST_SNAPSHOT_KEY)
+        snapshot_version, payload = pipeline.execute()
+        if payload is None:
+            return
+        suggester = Suggester.loads(payload)
+        # 应用快照之后的修改, 缺少的修改记录生成新的快照后再读取
+        self.version = apply_changes(suggester, int(snapshot_version), changes)
+        self.suggester = suggester
+
+
+local_suggester = LocalSuggester()
+
+
+def warm_up_suggest():
+    """
+    预热输入提示: 还没有快照时生成快照, 读取到进程内
+    在uwsgi主进程fork工作进程之前调用(wsgi.py)
+    """
+    if get_redis_connection().get(SUGGEST_SNAPSHOT_VERSION_KEY) is None:
+        update_suggest_snapshot()
+    local_suggester.get()
+
+
+def suggest(prefix, limit=SUGGEST_LIMIT):
+    """搜索框输入提示: 名称或简介以prefix开头的上架商品, 销量高的在前"""
+    suggester = local_suggester.get()
+    if suggester is None:
+        # 还没有生成快照
+        return []
+    return suggester.suggest(prefix, limit)
@@ -1,3 +1,537 @@
-from django.test import TestCase
+import pickle
+import shutil
+import tempfile
+import time
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.core.management.base import CommandError
+from django.db import connection
+from django.template import loader
+from django.test import TestCase, SimpleTestCase
+from django.test.utils import CaptureQueriesContext
+from haystack import connections
+
+from apps.goods.catalog import get_categories
+from apps.goods.index_page import get_index_page_data, dumps_index_page_data, \
+    loads_index_page_data
+from apps.goods.management.commands.import_catalog import Command as ImportCommand
+from apps.goods.models import GoodsCategory, GoodsSPU, GoodsSKU, IndexCategoryGoods, \
+    IndexSlideGoods, IndexPromotion, SalesFlush
+from apps.goods.ranking import RankedSkus, SORT_RANKS, rebuild_category_rank, \
+    rank_key, rank_member
+from apps.goods.sales import record_sales, flush_sales, get_pending_sales, \
+    SALES_BUFFER_KEY, SALES_FLUSHING_KEY, SALES_FLUSH_ID_KEY
+from apps.goods.search import rebuild_index, CachedResults
+from apps.goods.suggest import Suggester, LocalSuggester, update_suggest_snapshot, \
+    MAX_SCAN, SUGGEST_ENTRIES_KEY, SUGGEST_VERSION_KEY, SUGGEST_CHANGES_KEY, \
+    SUGGEST_SNAPSHOT_KEY, SUGGEST_SNAPSHOT_VERSION_KEY
+from utils.paginator import KeysetPaginator
+from utils.testing import RedisTestMixin
+
+
+def create_category_goods(count):
+    """创建count个类别, 每个类别一个文字商品和一个图片商品"""
+    spu = GoodsSPU.objects.create(name='草莓')
+    for i in range(count):
+        category = GoodsCategory.objects.create(
+            name='类别%s' % i, logo='fruit', image='category/fruit.jpg')
+        sku = GoodsSKU.objects.create(
+            name='商品%s' % i, title='简介', unit='500g', price=10,
+            stock=100, default_image='goods/goods001.jpg',
+            category=category, spu=spu)
+        for display_type in (0, 1):
+            IndexCategoryGoods.objects.create(
+                display_type=display_type, category=category, sku=sku)
+
+
+class IndexPageQueryTest(RedisTestMixin, TestCase):
+    """首页数据的查询次数与类别数量无关"""
+
+    def assert_build_queries(self, category_count):
+        create_category_goods(category_count)
+        # 类别、轮播、促销、类别商品(关联SKU) 各一次查询
+        with self.assertNumQueries(4):
+            context = get_index_page_data()
+            context['cart_count'] = 0
+            # 模板渲染时不能再有延迟查询
+            loader.get_template('index.html').render(context)
+        self.assertEqual(len(context['categories']), category_count)
+
+    def test_one_category(self):
+        self.assert_build_queries(1)
+
+    def test_many_categories(self):
+        self.assert_build_queries(20)
+
+
+def legacy_index_context():
+    """原来缓存的首页数据: 查询集和动态添加属性的模型对象"""
+    categories = GoodsCategory.objects.all()
+    for category in categories:
+        category.text_skus = IndexCategoryGoods.objects.filter(
+            category=category, display_type=0).order_by('index')
+        category.img_skus = IndexCategoryGoods.objects.filter(
+            category=category, display_type=1).order_by('index')
+    return {
+        'categories': categories,
+        'slide_skus': IndexSlideGoods.objects.all().order_by('index'),
+        'promotions': IndexPromotion.objects.all().order_by('index'),
+    }
+
+
+class IndexPageCacheBenchmark(RedisTestMixin, TestCase):
+    """比较缓存模型对象和缓存普通数据: 数据大小和反序列化+渲染的耗时"""
+
+    rounds = 50
+
+    def render_rounds(self, loads, payload):
+        template = loader.get_template('index.html')
+        start = time.time()
+        for _ in range(self.rounds):
+            context = loads(payload)
+            context['cart_count'] = 0
+            template.render(context)
+        return (time.time() - start) / self.rounds
+
+    def test_plain_payload(self):
+        create_category_goods(20)
+        legacy_payload = pickle.dumps(legacy_index_context())
+        plain_payload = dumps_index_page_data(get_index_page_data())
+
+        legacy_time = self.render_rounds(pickle.loads, legacy_payload)
+        plain_time = self.render_rounds(loads_index_page_data, plain_payload)
+        print('\n首页缓存: 模型对象 %d字节 %.2fms, 普通数据 %d字节 %.2fms' % (
+            len(legacy_payload), legacy_time * 1000,
+            len(plain_payload), plain_time * 1000))
+
+        self.assertLess(len(plain_payload), len(legacy_payload))
+        # 普通数据渲染时不会再查询数据库
+        with self.assertNumQueries(0):
+            self.render_rounds(loads_index_page_data, plain_payload)
+
+
+def create_tied_goods():
+    """创建一个类别的12个商品, 价格和销量有重复值, 返回类别的商品查询集"""
+    create_category_goods(1)
+    sku = GoodsSKU.objects.get()
+    for i in range(11):
+        GoodsSKU.objects.create(
+            name='商品%s' % i, title='简介', unit='500g', price=i % 3,
+            sales=i % 4, default_image='goods/goods001.jpg',
+            category_id=sku.category_id, spu_id=sku.spu_id)
+    return GoodsSKU.objects.filter(category_id=sku.category_id)
+
+
+class KeysetPaginatorTest(RedisTestMixin, TestCase):
+    """seek分页和OFFSET分页的结果一致(排序字段值相同时按id排序)"""
+
+    def setUp(self):
+        super().setUp()
+        self.skus = create_tied_goods()
+
+    def test_pages(self):
+        for order_field in ('id', 'price', '-sales'):
+            paginator = KeysetPaginator(self.skus, 5, order_field,
+                                        self.skus.count())
+            expected = [paginator.page(n).object_list
+                        for n in paginator.page_range]
+            # 通过"下一页"翻到最后一页
+            page = paginator.page(1)
+            for n in paginator.page_range[1:]:
+                page = paginator.page(n, after=page.next_cursor)
+                self.assertEqual(page.object_list, expected[n - 1])
+            # 通过"上一页"翻回第一页
+            for n in reversed(paginator.page_range[:-1]):
+                page = paginator.page(n, before=page.previous_cursor)
+                self.assertEqual(page.object_list, expected[n - 1])
+
+
+class RankedSkusTest(RedisTestMixin, TestCase):
+    """Redis有序集合和MySQL的排序结果一致(分数相同时都按数字id排序)"""
+
+    def setUp(self):
+        super().setUp()
+        self.skus = create_tied_goods()
+
+    def test_ties(self):
+        category_id = self.skus[0].category_id
+        rebuild_category_rank(category_id)
+        for sort, (field, descending) in SORT_RANKS.items():
+            order_field = '-' + field if descending else field
+            paginator = KeysetPaginator(self.skus, 100, order_field,
+                                        self.skus.count())
+            expected = [sku.id for sku in paginator.page(1)]
+            ranked = [sku['id'] for sku in RankedSkus(category_id, sort)[0:100]]
+            self.assertEqual(ranked, expected, sort)
+
+    def test_sales_score(self):
+        sku = self.skus.order_by('id')[0]
+        key = rank_key(sku.category_id, 'sales')
+        rebuild_category_rank(sku.category_id)
+        record_sales([(sku.category_id, sku.id, 5)])
+        # 只修改价格: 不读取没有保存的销量, 保留有序集合中的销量分数
+        sku.price = 100
+        with CaptureQueriesContext(connection) as queries:
+            sku.save()
+        self.assertFalse([query for query in queries.captured_queries
+                          if SalesFlush._meta.db_table in query['sql']])
+        self.assertEqual(self.redis_conn.zscore(key, rank_member(sku.id)),
+                         sku.sales + 5)
+        # 修改销量: 重新计算分数(包含没有保存的销量)
+        sku.sales += 10
+        sku.save()
+        self.assertEqual(self.redis_conn.zscore(key, rank_member(sku.id)),
+                         sku.sales + 5)
+
+
+class ListPageCacheTest(RedisTestMixin, TestCase):
+    """列表页缓存: 只缓存实际显示的页码, 页码不正确时不缓存"""
+
+    def cached_pages(self):
+        return len(self.redis_conn.keys('*tt:page:*'))
+
+    def test_page_num(self):
+        create_category_goods(1)
+        category_id = GoodsCategory.objects.get().id
+        for page_num in ('999', '01', '1'):
+            response = self.client.get('/list/%s/%s' % (category_id, page_num))
+            self.assertEqual(response.status_code, 200)
+        # 只缓存了第1页
+        self.assertEqual(self.cached_pages(), 1)
+
+
+class SalesFlushTest(RedisTestMixin, TestCase):
+    """销量保存到数据库后不会重复计算, 也不会重复保存"""
+
+    def setUp(self):
+        super().setUp()
+        create_category_goods(1)
+        self.sku = GoodsSKU.objects.get()
+        # 上次测试中断时可能留下了待保存的销量
+        self.redis_conn.delete(SALES_BUFFER_KEY, SALES_FLUSHING_KEY, SALES_FLUSH_ID_KEY)
+
+    def test_flush(self):
+        record_sales([(self.sku.category_id, self.sku.id, 3)])
+        self.assertEqual(get_pending_sales([self.sku.id]), {self.sku.id: 3})
+        self.assertEqual(flush_sales(), 1)
+        self.sku.refresh_from_db()
+        self.assertEqual(self.sku.sales, 3)
+        self.assertEqual(get_pending_sales([self.sku.id]), {})
+
+    def test_flushed_but_not_deleted(self):
+        # 事务已经提交, 还没有删除Redis中的数据(进程退出)
+        record_sales([(self.sku.category_id, self.sku.id, 3)])
+        self.redis_conn.rename(SALES_BUFFER_KEY, SALES_FLUSHING_KEY)
+        self.redis_conn.set(SALES_FLUSH_ID_KEY, 'flushed')
+        GoodsSKU.objects.filter(id=self.sku.id).update(sales=3)
+        SalesFlush.objects.create(flush_id='flushed')
+
+        self.assertEqual(get_pending_sales([self.sku.id]), {})
+        flush_sales()
+        self.sku.refresh_from_db()
+        self.assertEqual(self.sku.sales, 3)
+        self.assertFalse(self.redis_conn.exists(SALES_FLUSHING_KEY))
+
+    def test_interleaved(self):
+        # 第一次保存还没有提交时开始第二次保存: 第二次不保存, 新的销量下次保存
+        record_sales([(self.sku.category_id, self.sku.id, 3)])
+        create = SalesFlush.objects.create
+        results = []
+
+        def create_and_flush(**kwargs):
+            record_sales([(self.sku.category_id, self.sku.id, 2)])
+            results.append(flush_sales())
+            return create(**kwargs)
+
+        with mock.patch.object(SalesFlush.objects, 'create', side_effect=create_and_flush):
+            self.assertEqual(flush_sales(), 1)
+        self.assertEqual(results, [0])
+        self.sku.refresh_from_db()
+        self.assertEqual(self.sku.sales, 3)
+        self.assertEqual(get_pending_sales([self.sku.id]), {self.sku.id: 2})
+
+        self.assertEqual(flush_sales(), 1)
+        self.sku.refresh_from_db()
+        self.assertEqual(self.sku.sales, 5)
+
+
+class ImportCatalogTest(RedisTestMixin, TestCase):
+    """批量导入商品: 每批数据的查询次数与行数无关"""
+
+    def setUp(self):
+        super().setUp()
+        create_category_goods(2)
+        self.categories = list(GoodsCategory.objects.order_by('id'))
+        self.command = ImportCommand()
+
+    def import_rows(self, count):
+        """导入count个新商品, 并把它们全部修改为另一个类别, 返回修改时的查询次数"""
+        rows = [{'category': self.categories[0].name, 'spu': '草莓',
+                 'name': '导入%s_%s' % (count, i), 'price': '%s.50' % i,
+                 'stock': i} for i in range(count)]
+        self.command.import_chunk(rows)
+        skus = GoodsSKU.objects.filter(name__startswith='导入%s_' % count)
+        for row, sku in zip(rows, skus.order_by('id')):
+            row.update(id=sku.id, category=self.categories[1].name, stock=100)
+        with CaptureQueriesContext(connection) as queries:
+            category_ids = self.command.import_chunk(rows)
+        # 原来的类别也需要重新生成排序数据
+        self.assertEqual(category_ids, {category.id for category in self.categories})
+        self.assertEqual(set(skus.values_list('category_id', 'stock')),
+                         {(self.categories[1].id, 100)})
+        return len(queries)
+
+    def test_queries(self):
+        self.assertEqual(self.import_rows(2), self.import_rows(20))
+
+    def test_unknown_category(self):
+        with self.assertRaises(CommandError):
+            self.command.import_chunk([{'category': '不存在', 'spu': '草莓',
+                                        'name': '商品', 'price': '1'}])
+        self.assertFalse(GoodsCategory.objects.filter(name='不存在').exists())
+
+
+class SearchIndexTestCase(RedisTestMixin, TestCase):
+    """使用临时目录中的全文检索索引: 两个类别, 5个价格不同的商品"""
+
+    # (类别序号, 价格)
+    prices = ((0, '5.00'), (0, '15.00'), (0, '15.50'), (1, '35.00'), (1, '120.00'))
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.index_path = tempfile.mkdtemp()
+        cls.old_index_path = connections.connections_info['default']['PATH']
+        connections.connections_info['default']['PATH'] = cls.index_path
+        connections.reload('default')
+
+    @classmethod
+    def tearDownClass(cls):
+        connections.connections_info['default']['PATH'] = cls.old_index_path
+        connections.reload('default')
+        shutil.rmtree(cls.index_path, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        spu = GoodsSPU.objects.create(name='草莓')
+        self.categories = [GoodsCategory.objects.create(
+            name=name, logo='fruit', image='category/fruit.jpg')
+            for name in ('水果', '海鲜')]
+        self.skus = [GoodsSKU.objects.create(
+            name='草莓%s' % i, title='新鲜草莓', unit='500g', price=Decimal(price),
+            stock=10, default_image='goods/goods001.jpg',
+            category=self.categories[category], spu=spu)
+            for i, (category, price) in enumerate(self.prices)]
+        rebuild_index()
+
+
+class SearchPageTest(SearchIndexTestCase):
+    """搜索结果页: 显示的字段都保存在索引中, 不查询数据库"""
+
+    def test_queries(self):
+        # 类别数据已缓存
+        get_categories()
+        with self.assertNumQueries(0):
+            response = self.client.get('/search/', {'q': '草莓'})
+        self.assertEqual(response.context['paginator'].count, len(self.prices))
+        # 价格是定点数的字符串
+        self.assertContains(response, '￥15.50')
+
+
+class SearchFacetTest(SearchIndexTestCase):
+    """搜索结果的分面数量和按类别、价格区间过滤"""
+
+    def search(self, **params):
+        response = self.client.get('/search/', dict(params, q='草莓'))
+        return response.context, [result['sku_id'] for result
+                                  in response.context['page'].object_list]
+
+    def test_facets(self):
+        context, sku_ids = self.search()
+        self.assertEqual(
+            {facet['id']: facet['count'] for facet in context['category_facets']},
+            {self.categories[0].id: 3, self.categories[1].id: 2})
+        # 价格区间: 0-10: 5.00; 10-30: 15.00, 15.50; 30-50: 35.00; 100以上: 120.00
+        self.assertEqual(
+            [(facet['index'], facet['count']) for facet in context['price_facets']],
+            [(0, 1), (1, 2), (2, 1), (4, 1)])
+
+    def test_filters(self):
+        skus = self.skus
+        _, sku_ids = self.search(category=self.categories[1].id)
+        self.assertEqual(set(sku_ids), {skus[3].id, skus[4].id})
+        _, sku_ids = self.search(price=1)
+        self.assertEqual(set(sku_ids), {skus[1].id, skus[2].id})
+        context, sku_ids = self.search(category=self.categories[0].id, price=0)
+        self.assertEqual(sku_ids, [skus[0].id])
+        self.assertEqual(context['paginator'].count, 1)
+        # 分面数量不受过滤条件影响
+        self.assertEqual(len(context['category_facets']), 2)
+
+    def test_cached_results(self):
+        # 第3页的缓存数据: 下标是在全部结果中的位置
+        results = CachedResults(12, ['a', 'b'], offset=10)
+        self.assertEqual(results[10:15], ['a', 'b'])
+        self.assertEqual(results[11], 'b')
+        self.assertEqual(results[10:11], ['a'])
+        with self.assertRaises(IndexError):
+            results[0]
+
+
+class SearchSegmentBenchmark(SimpleTestCase):
+    """索引的段数对查询耗时的影响: 合并为一个段后查询更快"""
+
+    doc_count = 2000
+    rounds = 200
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def create_index(self, segments):
+        """创建有segments个段的索引(每次提交不合并段)"""
+        from whoosh.fields import Schema, ID, TEXT
+        from whoosh.filedb.filestore import FileStorage
+        storage = FileStorage(self.path)
+        ix = storage.create_index(Schema(id=ID(stored=True), text=TEXT))
+        per_segment = self.doc_count // segments
+        for i in range(segments):
+            writer = ix.writer()
+            for n in range(i * per_segment, (i + 1) * per_segment):
+                writer.add_document(id=str(n), text='商品%s 草莓 苹果%s' % (n, n % 10))
+            writer.commit(merge=False)
+        return ix
+
+    def search_time(self, ix):
+        from whoosh.qparser import QueryParser
+        query = QueryParser('text', ix.schema).parse('草莓')
+        with ix.searcher() as searcher:
+            start = time.time()
+            for _ in range(self.rounds):
+                count = len(searcher.search(query, limit=5))
+            return (time.time() - start) / self.rounds, count
+
+    def test_segments(self):
+        from apps.goods.search import segment_count
+        ix = self.create_index(30)
+        self.assertEqual(segment_count(ix), 30)
+        before, count = self.search_time(ix)
+
+        ix.writer().commit(optimize=True)
+        ix = ix.refresh()
+        self.assertEqual(segment_count(ix), 1)
+        after, optimized_count = self.search_time(ix)
+        print('\n索引查询: 30个段 %.2fms, 1个段 %.2fms' % (
+            before * 1000, after * 1000))
+        self.assertEqual(count, optimized_count)
+
+
+class SuggestBenchmark(SimpleTestCase):
+    """10万个商品时输入提示的查询耗时小于1毫秒"""
+
+    sku_count = 100000
+    rounds = 10000
+
+    def test_lookup(self):
+        words = ['草莓', '苹果', '香蕉', '葡萄', '橙子', '猕猴桃', '牛肉', '羊肉',
+                 '大虾', '螃蟹', '白菜', '土豆', '有机', '进口', '新鲜']
+        entries = [(i, '%s%s %sg' % (words[i % 15], words[i // 15 % 15], i),
+                    '%s简介' % words[i // 225 % 15], i % 1000)
+                   for i in range(self.sku_count)]
+        suggester = Suggester.loads(Suggester.build(entries).dumps())
+
+        queries = ['草', '草莓', '草莓苹', '有机牛肉', '进口大虾 1', 'abc']
+        start = time.time()
+        for i in range(self.rounds):
+            suggester.suggest(queries[i % len(queries)])
+        seconds = (time.time() - start) / self.rounds
+        print('\n输入提示: %s个商品, %.3fms' % (self.sku_count, seconds * 1000))
+        self.assertLess(seconds, 0.001)
+
+        # 销量高的在前
+        suggestions = suggester.suggest('草莓苹')
+        sales = [entries[s['id']][3] for s in suggestions]
+        self.assertEqual(sales, sorted(sales, reverse=True))
+        self.assertTrue(all(s['name'].startswith('草莓苹果') for s in suggestions))
+
+
+class SuggesterTest(SimpleTestCase):
+    """前缀匹配的结果: 按全部匹配的商品排序, 逐条应用修改与重新生成的结果相同"""
+
+    def test_many_matches(self):
+        # 销量最高的商品排在有序数组的最后
+        count = MAX_SCAN * 3
+        entries = [(i, '苹果%05d' % i, '', i) for i in range(count)]
+        suggester = Suggester.build(entries)
+        self.assertEqual([s['id'] for s in suggester.suggest('苹果', 3)],
+                         [count - 1, count - 2, count - 3])
+        self.assertEqual([s['id'] for s in suggester.suggest('苹果01', 3)],
+                         [1999, 1998, 1997])
+
+    def test_apply(self):
+        words = ['草莓', '苹果', '香蕉', 'ab']
+        entries = {i: (i, '%s%s' % (words[i % 4], words[i // 4 % 4]), '%s简介' % words[i % 3],
+                       i) for i in range(MAX_SCAN * 2)}
+        suggester = Suggester.loads(Suggester.build(entries.values()).dumps())
+        changes = [[0], [5], [7, '苹果草莓', '新简介', 10 ** 6],
+                   [MAX_SCAN * 2, 'AB 草莓', '', MAX_SCAN * 3]]
+        changes += [[i, '草莓ab', '草莓简介', 1] for i in range(10, MAX_SCAN * 2, 2)]
+        for change in changes:
+            suggester.apply(change)
+            if len(change) == 1:
+                entries.pop(change[0])
+            else:
+                entries[change[0]] = tuple(change)
+
+        rebuilt = Suggester.build(entries.values())
+        self.assertEqual((suggester.keys, suggester.ids), (rebuilt.keys, rebuilt.ids))
+        self.assertEqual(set(suggester.top), set(rebuilt.top))
+        for prefix in ('草', '草莓', '草莓ab', '苹果', '苹果草莓', 'ab', 'ab 草', '草莓简介'):
+            self.assertEqual(suggester.suggest(prefix), rebuilt.suggest(prefix))
+
+
+class LocalSuggesterTest(RedisTestMixin, TestCase):
+    """进程内的输入提示: 没有快照时返回空的提示, 商品修改后只应用修改记录"""
+
+    def setUp(self):
+        super().setUp()
+        self.redis_conn.delete(SUGGEST_ENTRIES_KEY, SUGGEST_VERSION_KEY, SUGGEST_CHANGES_KEY,
+                               SUGGEST_SNAPSHOT_KEY, SUGGEST_SNAPSHOT_VERSION_KEY)
+        create_category_goods(2)
+        self.local_suggester = LocalSuggester()
+
+    def get_suggester(self):
+        # 不等待CHECK_INTERVAL
+        self.local_suggester.checked = 0
+        return self.local_suggester.get()
+
+    def test_no_snapshot(self):
+        self.assertIsNone(self.get_suggester())
+        # 请求中不生成快照
+        self.assertFalse(self.redis_conn.exists(SUGGEST_SNAPSHOT_KEY))
+
+    def test_changes(self):
+        update_suggest_snapshot()
+        self.assertEqual(len(self.get_suggester().suggest('商品')), 2)
+        snapshot = self.redis_conn.get(SUGGEST_SNAPSHOT_KEY)
+
+        sku = GoodsSKU.objects.get(name='商品0')
+        sku.sales = 10
+        sku.save()
+        offline = GoodsSKU.objects.get(name='商品1')
+        offline.status = False
+        offline.save()
+        expected = [{'id': sku.id, 'name': '商品0'}]
+        self.assertEqual(self.get_suggester().suggest('商品'), expected)
+        # 快照还没有更新
+        self.assertEqual(self.redis_conn.get(SUGGEST_SNAPSHOT_KEY), snapshot)
+
+        # 修改记录应用到快照中后删除
+        version = update_suggest_snapshot()
+        self.assertEqual(int(self.redis_conn.get(SUGGEST_SNAPSHOT_VERSION_KEY)), version)
+        self.assertEqual(self.redis_conn.llen(SUGGEST_CHANGES_KEY), 0)
+        self.assertEqual(LocalSuggester().get().suggest('商品'), expected)
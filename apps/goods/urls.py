@@ -6,4 +6,5 @@ urlpatterns = [
     url(r'^index$', views.IndexView.as_view(), name='index'),
     url(r'^detail/(\d+)$', views.DetailView.as_view(), name='detail'),
     url(r'^list/(\d+)/(\d+)$', views.ListView.as_view(), name='list'),
+    url(r'^suggest$', views.SuggestView.as_view(), name='suggest'),
 ]
@@ -1,30 +1,33 @@
-from django.core.cache import cache
-from django.core.paginator import Paginator, EmptyPage
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.urlresolvers import reverse
-from django.shortcuts import render, redirect
+from django.http import Http404, JsonResponse
+from django.shortcuts import redirect
 from django.views.generic import View
 from django_redis import get_redis_connection
-from redis import StrictRedis
+from haystack.views import SearchView
 
-from apps.goods.models import GoodsCategory, IndexSlideGoods, IndexPromotion, IndexCategoryGoods, GoodsSKU
+from apps.cart.cart import get_cart_count, cart_owner
+from apps.goods.catalog import get_categories, get_category, get_category_sku_count, \
+    get_sku_summaries, get_sku_detail
+from apps.goods.index_page import get_index_context
+from apps.goods.models import GoodsSKU
+from apps.goods.ranking import RankedSkus, SORT_RANKS, get_new_skus
+from apps.goods.search import search_cache, search_cache_key, result_data, \
+    CachedResults, get_search_facets, PRICE_BANDS
+from apps.goods.suggest import suggest
+from utils.page_cache import get_cached_page, render_cached_page, cached_page_response
+from utils.paginator import KeysetPaginator
 
 
 class BaseCartView(View):
     def get_cart_count(self, request):
         """获取购物车中商品的数量"""
         cart_count = 0
-        # 如果用户登录，就获取购物车数据
-        if request.user.is_authenticated():
-            # 获取 StrictRedis 对象
-            strict_redis = get_redis_connection()  # type: StrictRedis
-            # 获取用户id
-            user_id = request.user.id
-            key = 'cart_%s' % user_id
-            # 从redis中获取购物车数据，返回字典
-            cart_dict = strict_redis.hgetall(key)
-            # 遍历购物车字典的值，累加购物车的值
-            for c in cart_dict.values():
-                cart_count += int(c)
+        # 登录用户的购物车, 或未登录用户session对应的购物车
+        owner = cart_owner(request, create=False)
+        if owner is not None:
+            # 购物车中商品的总数量单独保存, 修改购物车时同时修改
+            cart_count = get_cart_count(owner)
 
         return cart_count
 
@@ -32,73 +35,30 @@ class BaseCartView(View):
 class IndexView(BaseCartView):
     def get(self, request):
         """显示首页"""
-        # 读取缓存:  键=值
-        # index_page_data=context字典数据
-        context = cache.get('index_page_data')
-        if not context:  # 数据为空
-            print('缓存为空,从Mysql数据库读取')
-            # 查询商品类别数据
-            categories = GoodsCategory.objects.all()
-
-            # 查询商品轮播轮数据
-            # index为表示显示先后顺序的一个字段，值小的会在前面
-            slide_skus = IndexSlideGoods.objects.all().order_by('index')
-
-            # 查询商品促销活动数据
-            promotions = IndexPromotion.objects.all().order_by('index')
-
-            # 查询类别商品数据
-            for category in categories:
-                # 查询某一类别下的文字类别商品
-                text_skus = IndexCategoryGoods.objects.filter(
-                    category=category, display_type=0).order_by('index')
-                # 查询某一类别下的图片类别商品
-                img_skus = IndexCategoryGoods.objects.filter(
-                    category=category, display_type=1).order_by('index')
-
-                # 动态地给类别新增实例属性
-                category.text_skus = text_skus
-                # 动态地给类别新增实例属性
-                category.img_skus = img_skus
-            context = {
-                'categories': categories,
-                'slide_skus': slide_skus,
-                'promotions': promotions,
-            }
-            cache.set('index_page_data', context, 60 * 30)
-        else:
-            print('使用缓存')
-        # 查询购物车中的商品数量
+        # 读取缓存的页面html: 所有用户共用, 用户相关的内容返回时再填充
+        html = get_cached_page(request)
+        if html is None:
+            # 读取缓存: 先读进程内缓存, 再读Redis缓存,
+            # 缓存过期时只有一个进程重建, 其它进程使用旧数据
+            context = get_index_context()
+            # template = loader.get_template('index.html')
+            html = render_cached_page(request, 'index.html', context)
 
+        # 查询购物车中的商品数量
         cart_count = self.get_cart_count(request)
-        # 定义模板数据
-
-        context.update({'cart_count': cart_count})
-
-        # template = loader.get_template('index.html')
-        return render(request, 'index.html', context)
+        return cached_page_response(request, html, cart_count)
 
 
 class DetailView(BaseCartView):
     def get(self, request, sku_id):
 
-        # 查询商品详情信息
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
+        # 查询商品详情信息: 商品、商品描述和其它规格的商品一起缓存
+        detail = get_sku_detail(sku_id)
+        if detail is None:
             # 查询不到商品则跳转到首页
             # return HttpResponse('商品不存在')
             return redirect(reverse('goods:index'))
-
-        # 获取所有的类别数据
-        categories = GoodsCategory.objects.all()
-
-        # 获取最新推荐
-        new_skus = GoodsSKU.objects.filter(
-            category=sku.category).order_by('-create_time')[0:2]
-
-        # 查询其它规格的商品
-        other_skus = sku.spu.goodssku_set.exclude(id=sku.id)
+        sku = detail['sku']
 
         # 获取购物车中的商品数量
         cart_count = self.get_cart_count(request)
@@ -112,23 +72,33 @@ class DetailView(BaseCartView):
             # history_用户id: [3, 1, 2]
             # 移除现有的商品浏览记录
             key = 'history_%s' % request.user.id
-            redis_conn.lrem(key, 0, sku.id)
+            redis_conn.lrem(key, 0, sku['id'])
             # 从左侧添加新的商品浏览记录
-            redis_conn.lpush(key, sku.id)
+            redis_conn.lpush(key, sku['id'])
             # 控制历史浏览记录最多只保存5项(包含头尾)
             redis_conn.ltrim(key, 0, 4)
 
-        # 定义模板数据
-        context = {
-            'categories': categories,
-            'sku': sku,
-            'new_skus': new_skus,
-            'cart_count': cart_count,
-            'other_skus': other_skus,
-        }
+        # 读取缓存的页面html
+        html = get_cached_page(request)
+        if html is None:
+            # 获取所有的类别数据(缓存)
+            categories = get_categories()
+
+            # 获取最新推荐
+            new_skus = get_new_skus(sku['category_id'])
+
+            # 定义模板数据
+            context = {
+                'categories': categories,
+                'sku': sku,
+                'spu_desc': detail['spu_desc'],
+                'new_skus': new_skus,
+                'other_skus': detail['other_skus'],
+            }
+            html = render_cached_page(request, 'detail.html', context)
 
         # 响应请求,返回html界面
-        return render(request, 'detail.html', context)
+        return cached_page_response(request, html, cart_count)
 
 
 class ListView(BaseCartView):
@@ -139,59 +109,176 @@ class ListView(BaseCartView):
         # 获取sort参数:如果用户不传，就是默认的排序规则
         sort = request.GET.get('sort', 'default')
         # 校验参数
-        # 判断category_id是否正确，通过异常来判断
-        try:
-            category = GoodsCategory.objects.get(id=category_id)
-        except GoodsCategory.DoesNotExist:
+        if sort not in SORT_RANKS:
+            # 无论用户是否传入或者传入其他的排序规则，我在这里都重置成'default'
+            sort = 'default'
+        # 判断category_id是否正确: 从缓存的类别中查找
+        category = get_category(category_id)
+        if category is None:
             return redirect(reverse('goods:index'))
 
-        # 查询商品所有类别
-        categories = GoodsCategory.objects.all()
+        # 购物车商品数量
+        cart_count = self.get_cart_count(request)
 
-        # 查询该类别商品新品推荐
-        new_skus = GoodsSKU.objects.filter(
-            category=category).order_by('-create_time')[0:2]
+        # 读取缓存的页面html: 键中使用校验后的排序参数;
+        # 带定位参数(上一页/下一页)的页面不缓存
+        params = {'sort': sort}
+        cacheable = not (request.GET.get('after') or request.GET.get('before'))
+        if cacheable:
+            html = get_cached_page(request, params)
+            if html is not None:
+                return cached_page_response(request, html, cart_count)
 
-        # 查询该类别所有商品SKU信息：按照排序规则来查询
-        if sort == 'price':
-            # 按照价格由低到高
-            skus = GoodsSKU.objects.filter(category=category).order_by('price')
-        elif sort == 'hot':
-            # 按照销量由高到低
-            skus = GoodsSKU.objects.filter(category=category).order_by('-sales')
-        else:
-            skus = GoodsSKU.objects.filter(category=category)
-            # 无论用户是否传入或者传入其他的排序规则，我在这里都重置成'default'
-            sort = 'default'
+        # 查询商品所有类别(缓存)
+        categories = get_categories()
 
-        # 分页：需要知道从第几页展示
-        page_num = int(page_num)
+        # 查询该类别商品新品推荐: 优先从Redis的排序数据中读取
+        new_skus = get_new_skus(category_id)
 
-        # 创建分页器：每页2条记录
-        paginator = Paginator(skus, 5)
-        try:
-            # 获取分页数据
-            page = paginator.page(page_num)
-        except EmptyPage:
+        # 查询该类别所有商品SKU信息：按照排序规则来查询
+        # 优先使用Redis中类别商品的有序集合: 不需要查询MySQL就能确定一页的商品id
+        ranked_skus = RankedSkus(category_id, sort)
+        if ranked_skus.count():
+            # 创建分页器：每页5条记录
+            paginator = Paginator(ranked_skus, 5)
+            try:
+                # 获取分页数据
+                page = paginator.page(page_num)
+            except (EmptyPage, PageNotAnInteger):
+                # 如果page_num不正确，默认给用户显示第一页数据
+                page = paginator.page(1)
+            skus = page.object_list
+        else:
+            # 还没有生成排序数据: 从MySQL查询
+            # 排序字段相同时再按id排序, 保证顺序唯一(分页时不会重复或遗漏)
+            field, descending = SORT_RANKS[sort]
+            order_field = '-' + field if descending else field
+            queryset = GoodsSKU.objects.filter(category_id=category_id).only(
+                'id', field)
+            # 创建分页器：每页5条记录, 商品总数量从缓存读取
+            paginator = KeysetPaginator(queryset, 5, order_field,
+                                        get_category_sku_count(category_id))
+            # 获取分页数据: 点击上一页/下一页时根据定位参数查询, 不使用OFFSET
             # 如果page_num不正确，默认给用户显示第一页数据
-            page = paginator.page(1)
+            page = paginator.page(page_num,
+                                  after=request.GET.get('after'),
+                                  before=request.GET.get('before'))
+            skus = get_sku_summaries([sku.id for sku in page])
 
         # 获取页数列表
         page_list = paginator.page_range
 
-        # 购物车商品数量
-        cart_count = self.get_cart_count(request)
-
         # 构造上下文
         context = {
             'category': category,
             'categories': categories,
             'page': page,
+            'skus': skus,
             'new_skus': new_skus,
             'page_list': page_list,
-            'cart_count': cart_count,
             'sort': sort,
         }
 
-        # 渲染模板
-        return render(request, 'list.html', context)
+        # 渲染模板: 页码不正确(显示了第一页)或者路径中有多余的0时不缓存,
+        # 缓存的键中只有实际显示的类别和页码, 任意页码不会生成大量缓存
+        cacheable = cacheable and request.path == reverse(
+            'goods:list', args=(category['id'], page.number))
+        html = render_cached_page(request, 'list.html', context, params,
+                                  cache=cacheable)
+        return cached_page_response(request, html, cart_count)
+
+
+class GoodsSearchView(SearchView):
+    """
+    全文检索: 相同的关键字和页码只搜索一次, 索引更新后重新搜索
+    可以按类别(category=类别id)和价格区间(price=区间序号)过滤
+    """
+
+    def get_results(self):
+        results = self.base_results = super().get_results()
+        self.category = parse_int(self.request.GET.get('category'))
+        self.price_band = parse_int(self.request.GET.get('price'))
+        if self.price_band not in range(len(PRICE_BANDS)):
+            self.price_band = None
+
+        if self.category is not None:
+            results = results.filter(category=self.category)
+        if self.price_band is not None:
+            low, high = PRICE_BANDS[self.price_band]
+            # 按价格(分)过滤
+            results = results.filter(price_cents__gte=low * 100)
+            if high is not None:
+                results = results.filter(price_cents__lt=high * 100)
+        return results
+
+    def filter_params(self):
+        """分页链接中需要保留的过滤参数"""
+        params = ''
+        if self.category is not None:
+            params += '&category=%s' % self.category
+        if self.price_band is not None:
+            params += '&price=%s' % self.price_band
+        return params
+
+    def build_page(self):
+        if not self.query:
+            # 没有关键字: 返回空的结果
+            return super().build_page()
+        try:
+            page_no = int(self.request.GET.get('page', 1))
+        except (TypeError, ValueError):
+            raise Http404('页码不正确')
+
+        key = search_cache_key(self.query, page_no, self.category,
+                               self.price_band)
+        data = search_cache.get(key)
+        if data is None:
+            paginator, page = super().build_page()
+            data = {'count': paginator.count,
+                    'results': [result_data(result) for result in page]}
+            search_cache.set(key, data)
+
+        offset = (page_no - 1) * self.results_per_page
+        paginator = Paginator(
+            CachedResults(data['count'], data['results'], offset),
+            self.results_per_page)
+        return paginator, paginator.page(page_no)
+
+    def extra_context(self):
+        """分面: 每个类别和价格区间的商品数量(不受当前过滤条件影响)"""
+        if not self.query:
+            return {}
+        facets = get_search_facets(self.query,
+                                   self.base_results.query.build_query())
+        category_facets = [
+            {'id': category['id'], 'name': category['name'],
+             'count': facets['category'][category['id']]}
+            for category in get_categories()
+            if facets['category'].get(category['id'])]
+        price_facets = [
+            {'index': i, 'low': low, 'high': high, 'count': facets['price'][i]}
+            for i, (low, high) in enumerate(PRICE_BANDS)
+            if facets['price'].get(i)]
+        return {
+            'category_facets': category_facets,
+            'price_facets': price_facets,
+            'category': self.category,
+            'price_band': self.price_band,
+            'filter_params': self.filter_params(),
+        }
+
+
+def parse_int(value):
+    """请求参数转换为整数, 格式不正确时返回None"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class SuggestView(View):
+    """搜索框输入提示: 名称或简介以输入内容开头的商品, 销量高的在前"""
+
+    def get(self, request):
+        query = request.GET.get('q', '')
+        return JsonResponse({'code': 0, 'suggestions': suggest(query)})
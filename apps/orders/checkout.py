@@ -0,0 +1,97 @@
+import time
+from decimal import Decimal
+
+from django.db import transaction, OperationalError
+from django.db.models import F
+from django.utils.timezone import now
+
+from apps.goods.models import GoodsSKU
+from apps.orders.models import OrderInfo, OrderGoods
+from utils.order_id import next_order_id
+
+# 数据库死锁或锁等待超时后重新提交订单的次数
+ORDER_RETRIES = 3
+# 重试前等待的时间(秒), 每次重试加倍
+RETRY_DELAY = 0.05
+# 运费
+TRANS_COST = 10
+
+
+class OrderError(Exception):
+    """提交订单失败: code和errmsg为响应的json数据"""
+
+    def __init__(self, code, errmsg):
+        super().__init__(errmsg)
+        self.code = code
+        self.errmsg = errmsg
+
+
+def deduct_stock(sku_id, count):
+    """
+    减少库存: 一条UPDATE语句判断并减少库存, 不需要先查询库存再保存(并发时不会超卖),
+    也不需要SELECT ... FOR UPDATE
+    UPDATE df_goods_sku SET stock = stock - count WHERE id = sku_id AND stock >= count
+    :return: 是否成功(库存不足时返回False)
+    """
+    return GoodsSKU.objects.filter(id=sku_id, stock__gte=count).update(
+        stock=F('stock') - count, update_time=now()) == 1
+
+
+def create_order(user, address, pay_method, counts):
+    """
+    保存订单: 一个事务中保存订单信息、订单商品和减少库存,
+    数据库死锁或锁等待超时时重试, 最多ORDER_RETRIES次
+    :param counts: 购买的商品 {商品id: 数量}
+    :return: (订单, 销量[(类别id, 商品id, 数量), ...])
+    :raise OrderError: 商品不存在、库存不足或保存失败
+    """
+    # 在事务外一次查询所有商品的价格
+    skus = GoodsSKU.objects.only('id', 'price', 'category').in_bulk(list(counts))
+    if len(skus) != len(counts):
+        raise OrderError(4, '商品不存在')
+
+    for retry in range(ORDER_RETRIES + 1):
+        try:
+            return save_order(user, address, pay_method, skus, counts)
+        except OperationalError:
+            if retry == ORDER_RETRIES:
+                raise OrderError(6, '创建订单失败')
+            time.sleep(RETRY_DELAY * 2 ** retry)
+
+
+@transaction.atomic
+def save_order(user, address, pay_method, skus, counts, order_id=None):
+    """
+    在一个事务中保存订单
+    :param skus: {商品id: 商品(包含价格和类别)}
+    :param order_id: 订单id, 为None时生成
+    """
+    total_count = sum(counts.values())
+    total_amount = sum((skus[sku_id].price * count
+                        for sku_id, count in counts.items()), Decimal('0'))
+    if order_id is None:
+        order_id = next_order_id()
+    order = OrderInfo.objects.create(
+        order_id=order_id,
+        total_count=total_count,
+        total_amount=total_amount,
+        trans_cost=TRANS_COST,
+        pay_method=pay_method,
+        user=user,
+        address=address,
+    )
+
+    # 按商品id的顺序减少库存, 同时提交的订单加锁的顺序相同, 减少死锁
+    sales = []
+    for sku_id in sorted(counts):
+        if not deduct_stock(sku_id, counts[sku_id]):
+            # 抛出异常, 事务回滚
+            raise OrderError(5, '库存不足')
+        sales.append((skus[sku_id].category_id, sku_id, counts[sku_id]))
+
+    # 订单商品一次保存
+    OrderGoods.objects.bulk_create([
+        OrderGoods(count=count, price=skus[sku_id].price, order=order,
+                   sku_id=sku_id)
+        for sku_id, count in counts.items()])
+    return order, sales
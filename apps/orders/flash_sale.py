@@ -0,0 +1,276 @@
+import json
+import logging
+
+from django.db import transaction, DatabaseError, IntegrityError
+from django_redis import get_redis_connection
+from redis.exceptions import LockError, ResponseError
+
+from apps.goods.models import GoodsSKU
+from apps.goods.sales import add_sales
+from apps.goods.stock import add_decr_sku_stock
+from apps.orders.checkout import save_order, OrderError
+from apps.orders.models import OrderInfo
+from apps.users.models import User, Address
+from utils.lua import LuaScript
+from utils.order_id import next_order_id
+
+# 秒杀商品的库存: {商品id: 剩余库存}, 开始秒杀时从数据库读取
+FLASH_STOCK_KEY = 'flash_stock'
+# 每个用户限购的数量: {商品id: 限购数量}, 开始秒杀时设置, 没有设置时不限购
+FLASH_LIMIT_KEY = 'flash_limit'
+# 限购商品的用户已购买的数量: flash_buyers_商品id = {用户id: 数量}
+FLASH_BUYERS_KEY = 'flash_buyers_%s'
+# 等待保存到数据库的订单(列表, 每个元素为json)
+FLASH_QUEUE_KEY = 'flash_order_queue'
+# 正在保存到数据库的订单
+FLASH_PROCESSING_KEY = 'flash_order_processing'
+# 订单的状态: flash_order_订单id = json({'user_id', 'status', 'errmsg'}), 保存一天
+FLASH_STATUS_KEY = 'flash_order_%s'
+FLASH_STATUS_TIMEOUT = 60 * 60 * 24
+# 已经记录了销量和减少了库存的订单: flash_order_applied_订单id, 保存一天
+FLASH_APPLIED_KEY = 'flash_order_applied_%s'
+# 保存订单的锁: 同时只有一个celery任务保存订单
+FLASH_LOCK_KEY = 'flash_order_lock'
+FLASH_LOCK_TIMEOUT = 60 * 5
+
+logger = logging.getLogger(__name__)
+
+# 订单状态: 等待保存, 保存成功, 保存失败
+PENDING = 'pending'
+SUCCESS = 'success'
+FAILED = 'failed'
+
+# 预留秒杀商品的库存: 判断并减少库存、记录用户已购买的数量和订单原子执行
+# KEYS: 秒杀库存, 限购数量, 已购买的用户, 订单队列, 订单状态
+# ARGV: 商品id, 数量, 用户id, 订单数据(json), 订单状态(json), 订单状态的有效期
+# 返回: 0成功, 1不是秒杀商品, 2库存不足, 3超过限购数量
+RESERVE = LuaScript("""
+local stock = redis.call('hget', KEYS[1], ARGV[1])
+if not stock then
+    return 1
+end
+if tonumber(stock) < tonumber(ARGV[2]) then
+    return 2
+end
+local limit = redis.call('hget', KEYS[2], ARGV[1])
+if limit then
+    local bought = tonumber(redis.call('hget', KEYS[3], ARGV[3]) or 0)
+    if bought + tonumber(ARGV[2]) > tonumber(limit) then
+        return 3
+    end
+    redis.call('hincrby', KEYS[3], ARGV[3], ARGV[2])
+end
+redis.call('hincrby', KEYS[1], ARGV[1], -tonumber(ARGV[2]))
+redis.call('rpush', KEYS[4], ARGV[4])
+redis.call('set', KEYS[5], ARGV[5], 'EX', ARGV[6])
+return 0
+""")
+
+# 预留库存的结果
+RESERVE_ERRORS = {
+    1: (4, '商品不在秒杀中'),
+    2: (5, '库存不足'),
+    3: (7, '超过每个用户的限购数量'),
+}
+
+
+def start_flash_sale(sku_id, stock=None, limit=None):
+    """
+    开始秒杀: 把商品的库存读取到Redis中
+    :param stock: 秒杀的数量, 不能超过商品的库存, 为None时为商品的全部库存
+    :param limit: 每个用户限购的数量, 为None时不限购
+    :return: 秒杀的数量
+    """
+    sku_stock = GoodsSKU.objects.values_list('stock', flat=True).get(id=sku_id)
+    stock = sku_stock if stock is None else min(stock, sku_stock)
+    pipeline = get_redis_connection().pipeline()
+    pipeline.hset(FLASH_STOCK_KEY, sku_id, stock)
+    if limit is None:
+        pipeline.hdel(FLASH_LIMIT_KEY, sku_id)
+    else:
+        pipeline.hset(FLASH_LIMIT_KEY, sku_id, limit)
+    pipeline.delete(FLASH_BUYERS_KEY % sku_id)
+    pipeline.execute()
+    return stock
+
+
+def stop_flash_sale(sku_id):
+    """结束秒杀: 剩余的库存不需要处理(保存订单时才减少数据库中的库存)"""
+    pipeline = get_redis_connection().pipeline()
+    pipeline.hdel(FLASH_STOCK_KEY, sku_id)
+    pipeline.hdel(FLASH_LIMIT_KEY, sku_id)
+    pipeline.delete(FLASH_BUYERS_KEY % sku_id)
+    pipeline.execute()
+
+
+def reserve_order(user_id, address_id, pay_method, sku_id, count=1):
+    """
+    提交秒杀订单: 只在Redis中预留库存, 订单由celery任务保存到数据库
+    :return: 订单id
+    :raise OrderError: 不是秒杀商品、库存不足或超过限购数量
+    """
+    order_id = next_order_id()
+    job = json.dumps({'order_id': order_id, 'user_id': user_id,
+                      'address_id': address_id, 'pay_method': pay_method,
+                      'sku_id': sku_id, 'count': count})
+    status = json.dumps({'user_id': user_id, 'status': PENDING})
+    result = RESERVE([FLASH_STOCK_KEY, FLASH_LIMIT_KEY, FLASH_BUYERS_KEY % sku_id,
+                      FLASH_QUEUE_KEY, FLASH_STATUS_KEY % order_id],
+                     [sku_id, count, user_id, job, status, FLASH_STATUS_TIMEOUT])
+    if result:
+        raise OrderError(*RESERVE_ERRORS[result])
+    return order_id
+
+
+def get_order_status(order_id, user_id):
+    """
+    秒杀订单的状态
+    :return: {'status': 状态, 'errmsg': 失败原因}, 订单不存在时返回None
+    """
+    value = get_redis_connection().get(FLASH_STATUS_KEY % order_id)
+    if value is None:
+        return None
+    status = json.loads(value.decode())
+    if status.pop('user_id') != user_id:
+        return None
+    return status
+
+
+def persist_orders(batch_size=200):
+    """
+    把预留了库存的秒杀订单批量保存到数据库: 一批订单一个事务, 每个订单一个保存点,
+    保存失败(如数据库中的库存不足)的订单释放预留的库存
+    :return: 保存的订单数量
+    """
+    redis_conn = get_redis_connection()
+    lock = redis_conn.lock(FLASH_LOCK_KEY, timeout=FLASH_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        # 其它任务正在保存
+        return 0
+    try:
+        # 上次保存失败时, 先保存上次的订单
+        if not redis_conn.exists(FLASH_PROCESSING_KEY):
+            try:
+                # 重命名后, 新提交的订单记录到新的键中
+                redis_conn.rename(FLASH_QUEUE_KEY, FLASH_PROCESSING_KEY)
+            except ResponseError:
+                # 没有需要保存的订单
+                return 0
+
+        jobs = load_jobs(redis_conn.lrange(FLASH_PROCESSING_KEY, 0, -1))
+        for i in range(0, len(jobs), batch_size):
+            persist_batch(redis_conn, jobs[i:i + batch_size])
+        redis_conn.delete(FLASH_PROCESSING_KEY)
+        return len(jobs)
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # 锁已过期
+            pass
+
+
+def load_jobs(values):
+    """
+    读取保存中的订单: 不是json或者没有订单id的订单不能保存, 也不能修改状态, 只记录日志
+    """
+    jobs = []
+    for value in values:
+        try:
+            job = json.loads(value.decode())
+            valid = isinstance(job['order_id'], str)
+        except (ValueError, KeyError, TypeError):
+            valid = False
+        if not valid:
+            logger.error('秒杀订单格式不正确: %r', value)
+            continue
+        jobs.append(job)
+    return jobs
+
+
+def job_reservation(job):
+    """
+    订单预留的库存
+    :return: (商品id, 数量, 用户id), 格式不正确时返回None
+    """
+    values = tuple(job.get(name) for name in ('sku_id', 'count', 'user_id'))
+    if all(isinstance(value, int) for value in values):
+        return values
+    return None
+
+
+def persist_batch(redis_conn, jobs):
+    # 一次查询这批订单中所有商品的价格
+    skus = GoodsSKU.objects.only('id', 'price', 'category').in_bulk(
+        {job.get('sku_id') for job in jobs if isinstance(job.get('sku_id'), int)})
+    results = {}
+    # 保存成功的订单: {订单id: (类别id, 商品id, 数量)}
+    sales = {}
+    with transaction.atomic():
+        for job in jobs:
+            try:
+                sku_id, count = job['sku_id'], job['count']
+                if sku_id not in skus:
+                    raise OrderError(4, '商品不存在')
+                # 保存点: 保存失败时只撤销这个订单
+                with transaction.atomic():
+                    save_order(User(id=job['user_id']),
+                               Address(id=job['address_id']),
+                               job['pay_method'], skus, {sku_id: count},
+                               order_id=job['order_id'])
+                sales[job['order_id']] = (skus[sku_id].category_id, sku_id, count)
+                results[job['order_id']] = (job, None)
+            except IntegrityError:
+                if OrderInfo.objects.filter(order_id=job['order_id']).exists():
+                    # 上次已经保存过的订单(保存后没有删除队列), 销量可能还没有记录
+                    sales[job['order_id']] = (skus[sku_id].category_id, sku_id, count)
+                    results[job['order_id']] = (job, None)
+                else:
+                    # 收货地址不存在等
+                    results[job['order_id']] = (job, '创建订单失败')
+            except OrderError as e:
+                results[job['order_id']] = (job, e.errmsg)
+            except DatabaseError:
+                # 保存点已经回滚, 只有这个订单保存失败
+                logger.exception('保存秒杀订单失败: %s', job['order_id'])
+                results[job['order_id']] = (job, '创建订单失败')
+            except (KeyError, TypeError, ValueError):
+                # 格式不正确的订单
+                logger.exception('秒杀订单格式不正确: %s', job)
+                results[job['order_id']] = (job, '创建订单失败')
+
+    # 事务提交后: 记录销量和减少库存, 修改订单状态, 释放保存失败的订单预留的库存;
+    # 在一个Redis事务(MULTI)中执行, 同时标记已经记录的订单,
+    # 执行前进程退出时重新保存这批订单, 已经标记的订单不会重复记录
+    order_ids = list(sales)
+    pipeline = redis_conn.pipeline(transaction=False)
+    for order_id in order_ids:
+        pipeline.exists(FLASH_APPLIED_KEY % order_id)
+    applied = pipeline.execute()
+    new_sales = [sales[order_id] for order_id, exists
+                 in zip(order_ids, applied) if not exists]
+    # 已经结束秒杀的商品不需要释放库存; 限购的商品减少用户已购买的数量
+    flash_sku_ids = {int(sku_id) for sku_id in redis_conn.hkeys(FLASH_STOCK_KEY)}
+    limit_sku_ids = {int(sku_id) for sku_id in redis_conn.hkeys(FLASH_LIMIT_KEY)}
+
+    pipeline = redis_conn.pipeline()
+    add_sales(pipeline, new_sales)
+    add_decr_sku_stock(pipeline, [(sku_id, count) for _, sku_id, count in new_sales])
+    for order_id, exists in zip(order_ids, applied):
+        if not exists:
+            pipeline.set(FLASH_APPLIED_KEY % order_id, 1, FLASH_STATUS_TIMEOUT)
+    for order_id, (job, errmsg) in results.items():
+        status = {'user_id': job.get('user_id'),
+                  'status': FAILED if errmsg else SUCCESS}
+        if errmsg:
+            status['errmsg'] = errmsg
+            reservation = job_reservation(job)
+            if reservation is not None:
+                sku_id, count, user_id = reservation
+                if sku_id in flash_sku_ids:
+                    pipeline.hincrby(FLASH_STOCK_KEY, sku_id, count)
+                if sku_id in limit_sku_ids:
+                    pipeline.hincrby(FLASH_BUYERS_KEY % sku_id, user_id, -count)
+        pipeline.set(FLASH_STATUS_KEY % order_id, json.dumps(status),
+                     FLASH_STATUS_TIMEOUT)
+    pipeline.execute()
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.goods.models import GoodsSKU
+from apps.orders.flash_sale import start_flash_sale, stop_flash_sale
+
+
+class Command(BaseCommand):
+    """
+    开始或结束商品的秒杀: python manage.py flash_sale 商品id --stock 100 --limit 1
+    开始时把秒杀的库存读取到Redis中, 结束时删除
+    """
+    help = '开始或结束商品的秒杀'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sku_id', type=int, help='商品id')
+        parser.add_argument('--stock', type=int,
+                            help='秒杀的数量, 默认为商品的全部库存')
+        parser.add_argument('--limit', type=int,
+                            help='每个用户限购的数量, 默认不限购')
+        parser.add_argument('--stop', action='store_true', help='结束秒杀')
+
+    def handle(self, *args, **options):
+        sku_id = options['sku_id']
+        if options['stop']:
+            stop_flash_sale(sku_id)
+            self.stdout.write('结束秒杀: %s' % sku_id)
+            return
+
+        try:
+            stock = start_flash_sale(sku_id, options['stock'], options['limit'])
+        except GoodsSKU.DoesNotExist:
+            raise CommandError('商品不存在: %s' % sku_id)
+        self.stdout.write('开始秒杀: %s, 数量: %s' % (sku_id, stock))
@@ -0,0 +1,159 @@
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.utils.timezone import now
+from django_redis import get_redis_connection
+
+from apps.orders.models import OrderInfo
+
+# 订单的支付状态(订单还是待支付时): pay_status_订单id = 状态
+PAY_STATUS_KEY = 'pay_status_%s'
+# 支付状态: 等待支付, 支付成功, 交易关闭, 超过支付时间
+WAITING = 'waiting'
+PAID = 'paid'
+FAILED = 'failed'
+EXPIRED = 'expired'
+# 支付宝中交易成功的状态
+SUCCESS_TRADE_STATUS = ('TRADE_SUCCESS', 'TRADE_FINISHED')
+
+# 支付宝sdk对象: {(appid, 是否沙箱环境, 私钥文件, 公钥文件): AliPay}
+_alipay_clients = {}
+
+
+def get_alipay():
+    """支付宝sdk对象, 每个进程只读取一次密钥"""
+    config = (settings.ALIPAY_APPID, settings.ALIPAY_DEBUG,
+              settings.ALIPAY_APP_PRIVATE_KEY_PATH, settings.ALIPAY_PUBLIC_KEY_PATH)
+    alipay = _alipay_clients.get(config)
+    if alipay is None:
+        from alipay import AliPay
+        with open(settings.ALIPAY_APP_PRIVATE_KEY_PATH) as file:
+            app_private_key_string = file.read()
+        with open(settings.ALIPAY_PUBLIC_KEY_PATH) as file:
+            alipay_public_key_string = file.read()
+        alipay = AliPay(
+            appid=settings.ALIPAY_APPID,
+            app_notify_url=settings.ALIPAY_NOTIFY_URL,  # 支付成功后支付宝通知的url
+            app_private_key_string=app_private_key_string,
+            # 支付宝的公钥，验证支付宝回传消息使用，不是你自己的公钥,
+            alipay_public_key_string=alipay_public_key_string,
+            sign_type="RSA2",  # RSA 或者 RSA2   # 使用RSA测试会有问题
+            debug=settings.ALIPAY_DEBUG  # 默认False, 如果是True表示使用沙箱环境
+        )
+        _alipay_clients[config] = alipay
+    return alipay
+
+
+def get_pay_url(order):
+    """支付宝电脑网站支付的url"""
+    # 订单的实付金额
+    total_pay = order.total_amount + order.trans_cost
+    order_string = get_alipay().api_alipay_trade_page_pay(
+        out_trade_no=order.order_id,  # 订单号
+        total_amount=str(total_pay),  # 注意: 不能传递total_pay
+        subject="天天生鲜测试订单",
+        return_url=None,
+        # 超过支付时间后支付宝关闭交易
+        timeout_express='%dm' % (settings.ALIPAY_PAY_TIMEOUT // 60),
+    )
+    return settings.ALIPAY_GATEWAY + '?' + order_string
+
+
+def start_payment(order_id):
+    """
+    开始支付: 记录等待支付的状态
+    :return: 是否需要开始查询支付结果(正在查询或已有查询结果时不需要)
+    """
+    # 没有支付状态时才设置: 同时请求支付的多个请求只有一个开始查询
+    return bool(get_redis_connection().set(
+        PAY_STATUS_KEY % order_id, WAITING, ex=settings.ALIPAY_POLL_TIMEOUT, nx=True))
+
+
+def set_pay_status(order_id, status):
+    get_redis_connection().set(PAY_STATUS_KEY % order_id, status,
+                               settings.ALIPAY_POLL_TIMEOUT)
+
+
+def get_pay_status(order_id, user):
+    """
+    订单的支付状态: 只查询数据库和Redis, 不请求支付宝
+    :return: 支付状态, 订单不存在时返回None
+    """
+    status = OrderInfo.objects.filter(order_id=order_id, user=user).values_list(
+        'status', flat=True).first()
+    if status is None:
+        return None
+    if status != 1:
+        return PAID
+    value = get_redis_connection().get(PAY_STATUS_KEY % order_id)
+    return value.decode() if value else WAITING
+
+
+def confirm_payment(order_id, trade_no):
+    """
+    支付成功: 修改订单状态为待评价, 保存支付宝交易号;
+    支付宝通知和查询支付结果都会调用, 只有待支付的订单才修改
+    :return: 是否修改了订单
+    """
+    updated = OrderInfo.objects.filter(order_id=order_id, status=1).update(
+        status=4, trade_no=trade_no, update_time=now())
+    get_redis_connection().delete(PAY_STATUS_KEY % order_id)
+    return updated == 1
+
+
+def check_payment(order_id, expired=False):
+    """
+    向支付宝查询一次订单的支付结果
+    :param expired: 是否已经超过支付时间, 超过时还没有支付则不再查询
+    :return: 支付状态
+    """
+    try:
+        response = get_alipay().api_alipay_trade_query(out_trade_no=order_id)
+    except Exception as e:
+        # 网络错误, 或者用户还没有打开支付页面(40004: 交易不存在)
+        print('check_payment: %s %s' % (order_id, e))
+        response = {}
+    # 获取响应参数
+    code = response.get('code')  # 响应状态码
+    trade_status = response.get('trade_status')  # 订单支付状态
+
+    if code == '10000' and trade_status in SUCCESS_TRADE_STATUS:
+        confirm_payment(order_id, response.get('trade_no'))
+        return PAID
+    if code == '10000' and trade_status == 'TRADE_CLOSED':
+        set_pay_status(order_id, FAILED)
+        return FAILED
+    if expired:
+        set_pay_status(order_id, EXPIRED)
+        return EXPIRED
+    return WAITING
+
+
+def handle_notify(data):
+    """
+    处理支付宝的异步通知: 验证签名、appid和金额后修改订单状态
+    :param data: 通知的参数(dict)
+    :return: 是否处理成功(失败时支付宝会重新通知)
+    """
+    signature = data.pop('sign', None)
+    if not signature or not get_alipay().verify(data, signature):
+        return False
+    if data.get('app_id') != settings.ALIPAY_APPID:
+        return False
+    if data.get('trade_status') not in SUCCESS_TRADE_STATUS:
+        # 其它状态不需要处理
+        return True
+
+    order_id = data.get('out_trade_no')
+    order = OrderInfo.objects.filter(order_id=order_id).only(
+        'total_amount', 'trans_cost').first()
+    if order is None:
+        return False
+    try:
+        total_amount = Decimal(data.get('total_amount'))
+    except (TypeError, InvalidOperation):
+        return False
+    if total_amount != order.total_amount + order.trans_cost:
+        return False
+    confirm_payment(order_id, data.get('trade_no'))
+    return True
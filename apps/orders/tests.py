@@ -1,3 +1,339 @@
-from django.test import TestCase
+import hashlib
+import json
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.db import connection, OperationalError
+from django.test import TransactionTestCase, SimpleTestCase, TestCase, \
+    override_settings
+
+from apps.goods.models import GoodsCategory, GoodsSPU, GoodsSKU
+from apps.goods.sales import get_pending_sales
+from apps.orders.checkout import create_order, save_order, OrderError
+from apps.orders.flash_sale import start_flash_sale, stop_flash_sale, reserve_order, \
+    persist_orders, get_order_status, FLASH_QUEUE_KEY, FLASH_PROCESSING_KEY, \
+    FLASH_STOCK_KEY, FLASH_BUYERS_KEY, SUCCESS, FAILED as FLASH_FAILED
+from apps.orders.models import OrderInfo, OrderGoods
+from apps.orders.payment import check_payment, handle_notify, get_pay_status, \
+    start_payment, PAY_STATUS_KEY, WAITING, PAID, FAILED, EXPIRED
+from apps.users.models import User, Address
+from utils.order_id import OrderIdGenerator, OrderIdError, SEQUENCE_SIZE
+from utils.testing import RedisTestMixin
+
+
+@override_settings(ORDER_ID_WORKER=1)
+class ConcurrentCheckoutTest(RedisTestMixin, TransactionTestCase):
+    """多个用户同时购买同一个商品: 不会超卖"""
+
+    stock = 10
+    buyer_count = 30
+
+    def setUp(self):
+        super().setUp()
+        category = GoodsCategory.objects.create(
+            name='水果', logo='fruit', image='category/fruit.jpg')
+        spu = GoodsSPU.objects.create(name='草莓')
+        self.sku = GoodsSKU.objects.create(
+            name='草莓', title='简介', unit='500g', price=10, stock=self.stock,
+            default_image='goods/goods001.jpg', category=category, spu=spu)
+        self.buyers = [User.objects.create_user('buyer%s' % i, password='123456')
+                       for i in range(self.buyer_count)]
+        self.addresses = [Address.objects.create(
+            receiver_name='张三', receiver_mobile='13800000000',
+            detail_addr='北京', user=user) for user in self.buyers]
+
+    def checkout(self, user, address, results):
+        try:
+            create_order(user, address, 1, {self.sku.id: 1})
+            results.append(0)
+        except OrderError as e:
+            results.append(e.code)
+        finally:
+            # 每个线程使用自己的数据库连接
+            connection.close()
+
+    def test_no_oversell(self):
+        results = []
+        threads = [threading.Thread(target=self.checkout,
+                                    args=(user, address, results))
+                   for user, address in zip(self.buyers, self.addresses)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.sku.refresh_from_db()
+        self.assertEqual(results.count(0), self.stock)
+        self.assertEqual(results.count(5), self.buyer_count - self.stock)
+        self.assertEqual(self.sku.stock, 0)
+        self.assertEqual(OrderGoods.objects.filter(sku=self.sku).count(),
+                         self.stock)
+
+
+@override_settings(ORDER_ID_WORKER=1)
+class FlashSaleTest(RedisTestMixin, TestCase):
+    """秒杀订单: 限购数量, 重新保存同一批订单时不会重复记录销量"""
+
+    def setUp(self):
+        super().setUp()
+        category = GoodsCategory.objects.create(
+            name='水果', logo='fruit', image='category/fruit.jpg')
+        spu = GoodsSPU.objects.create(name='草莓')
+        self.sku = GoodsSKU.objects.create(
+            name='草莓', title='简介', unit='500g', price=10, stock=10,
+            default_image='goods/goods001.jpg', category=category, spu=spu)
+        self.user = User.objects.create_user('buyer', password='123456')
+        self.address = Address.objects.create(
+            receiver_name='张三', receiver_mobile='13800000000',
+            detail_addr='北京', user=self.user)
+        self.addCleanup(stop_flash_sale, self.sku.id)
+
+    def reserve(self, count=1):
+        return reserve_order(self.user.id, self.address.id, 3, self.sku.id, count)
+
+    def test_limit(self):
+        start_flash_sale(self.sku.id, 5, limit=2)
+        self.reserve()
+        with self.assertRaises(OrderError) as cm:
+            self.reserve(2)
+        self.assertEqual(cm.exception.code, 7)
+        self.reserve()
+
+        # 不限购
+        start_flash_sale(self.sku.id, 5)
+        for _ in range(3):
+            self.reserve()
+
+    def test_persist_again(self):
+        start_flash_sale(self.sku.id, 5)
+        order_id = self.reserve()
+        job = self.redis_conn.lindex(FLASH_QUEUE_KEY, 0)
+        # 订单已经保存到数据库, 还没有记录销量(进程退出)
+        save_order(self.user, self.address, 3, {self.sku.id: self.sku}, {self.sku.id: 1},
+                   order_id=order_id)
+        self.assertEqual(persist_orders(), 1)
+        self.assertEqual(get_order_status(order_id, self.user.id), {'status': SUCCESS})
+        self.assertEqual(get_pending_sales([self.sku.id]), {self.sku.id: 1})
+
+        # 已经记录了销量, 还没有删除保存中的订单(进程退出)
+        self.redis_conn.rpush(FLASH_QUEUE_KEY, job)
+        self.assertEqual(persist_orders(), 1)
+        self.assertEqual(get_pending_sales([self.sku.id]), {self.sku.id: 1})
+        self.assertEqual(OrderInfo.objects.filter(order_id=order_id).count(), 1)
+
+    def test_persist_errors(self):
+        # 一个订单保存时数据库出错, 一个订单格式不正确: 只有这两个订单失败并释放预留的库存
+        start_flash_sale(self.sku.id, 5, limit=5)
+        failed_id = self.reserve()
+        order_id = self.reserve()
+        malformed = {'order_id': 'malformed', 'user_id': self.user.id,
+                     'sku_id': self.sku.id, 'count': 1}
+        self.redis_conn.hincrby(FLASH_STOCK_KEY, self.sku.id, -1)
+        self.redis_conn.hincrby(FLASH_BUYERS_KEY % self.sku.id, self.user.id, 1)
+        self.redis_conn.rpush(FLASH_QUEUE_KEY, json.dumps(malformed), 'not json')
+
+        def failing_save_order(user, address, pay_method, skus, counts, order_id=None):
+            if order_id == failed_id:
+                raise OperationalError('Deadlock found')
+            return save_order(user, address, pay_method, skus, counts, order_id=order_id)
+
+        with mock.patch('apps.orders.flash_sale.save_order', side_effect=failing_save_order):
+            self.assertEqual(persist_orders(), 3)
+        self.assertFalse(self.redis_conn.exists(FLASH_PROCESSING_KEY))
+        for failed in (failed_id, 'malformed'):
+            self.assertEqual(get_order_status(failed, self.user.id),
+                             {'status': FLASH_FAILED, 'errmsg': '创建订单失败'})
+        self.assertEqual(get_order_status(order_id, self.user.id), {'status': SUCCESS})
+        self.assertEqual(list(OrderInfo.objects.values_list('order_id', flat=True)),
+                         [order_id])
+        self.assertEqual(get_pending_sales([self.sku.id]), {self.sku.id: 1})
+        self.assertEqual(int(self.redis_conn.hget(FLASH_STOCK_KEY, self.sku.id)), 4)
+        self.assertEqual(int(self.redis_conn.hget(FLASH_BUYERS_KEY % self.sku.id,
+                                                  self.user.id)), 1)
+
+
+class OrderIdBenchmark(SimpleTestCase):
+    """订单id的生成速度, 多个线程同时生成不重复, 序号用完和时钟回拨时不重复"""
+
+    count = 100000
+    threads = 4
+
+    def test_throughput(self):
+        generator = OrderIdGenerator(instance_id=1, worker_id=1)
+        start = time.time()
+        order_ids = [generator() for _ in range(self.count)]
+        seconds = time.time() - start
+        print('\n订单id: %d个/秒' % (self.count / seconds))
+        self.assertEqual(len(set(order_ids)), self.count)
+        self.assertEqual({len(order_id) for order_id in order_ids}, {26})
+        # 时间在前: 订单id按时间递增
+        self.assertLessEqual(order_ids[0][:17], order_ids[-1][:17])
+
+    def test_threads(self):
+        generator = OrderIdGenerator(instance_id=1, worker_id=1)
+        results = []
+
+        def generate():
+            results.extend([generator() for _ in range(self.count // self.threads)])
+
+        threads = [threading.Thread(target=generate) for _ in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(results)), len(results))
+
+    def test_workers(self):
+        # 不同实例和进程在同一毫秒生成的订单id也不重复
+        generators = [OrderIdGenerator(instance_id=i, worker_id=w)
+                      for i in (1, 2) for w in (1, 2)]
+        order_ids = [generator() for _ in range(1000) for generator in generators]
+        self.assertEqual(len(set(order_ids)), len(order_ids))
+
+    def fake_clock(self, generator, times):
+        """生成器依次读取times中的毫秒数"""
+        times = iter(times)
+        generator.current_ms = lambda: next(times)
+
+    def test_sequence_exhausted(self):
+        # 一毫秒的序号用完后等到下一毫秒
+        generator = OrderIdGenerator(instance_id=1, worker_id=1)
+        ms = int(time.time()) * 1000
+        self.fake_clock(generator, [ms] * (SEQUENCE_SIZE + 2) + [ms + 1])
+        order_ids = [generator() for _ in range(SEQUENCE_SIZE + 1)]
+        self.assertEqual(len(set(order_ids)), len(order_ids))
+        self.assertEqual(order_ids[-2][14:17] + order_ids[-2][-4:], '000%04d' % (
+            SEQUENCE_SIZE - 1))
+        self.assertEqual(order_ids[-1][14:17] + order_ids[-1][-4:], '0010000')
+
+    def test_clock_backward(self):
+        generator = OrderIdGenerator(instance_id=1, worker_id=1)
+        ms = int(time.time()) * 1000 + 500
+        # 回拨较少: 等到时钟追上
+        self.fake_clock(generator, [ms, ms - 10, ms])
+        order_ids = [generator(), generator()]
+        self.assertEqual(order_ids[1][:17], order_ids[0][:17])
+        self.assertEqual(order_ids[1][-4:], '0001')
+        # 回拨太多: 不生成订单id
+        self.fake_clock(generator, [ms - 10000])
+        with self.assertRaises(OrderIdError):
+            generator()
+
+
+class FakeAlipay(object):
+    """
+    假的支付宝sdk对象, 测试时替换get_alipay()的返回值:
+    查询接口返回trade_status的交易状态, 通知的签名为参数排序后的sha256
+    """
+
+    def __init__(self):
+        self.trade_status = 'WAIT_BUYER_PAY'
+        self.queries = []
+
+    def api_alipay_trade_query(self, out_trade_no):
+        self.queries.append(out_trade_no)
+        if self.trade_status is None:
+            # 交易不存在(用户还没有打开支付页面)
+            return {'code': '40004', 'msg': 'Business Failed',
+                    'sub_code': 'ACQ.TRADE_NOT_EXIST'}
+        return {'code': '10000', 'msg': 'Success', 'out_trade_no': out_trade_no,
+                'trade_no': '2018010122001', 'trade_status': self.trade_status,
+                'total_amount': '30.00'}
+
+    def sign(self, data):
+        message = '&'.join('%s=%s' % item for item in sorted(data.items()))
+        return hashlib.sha256(message.encode()).hexdigest()
+
+    def verify(self, data, signature):
+        # 与sdk相同: sign_type不参与签名
+        data.pop('sign_type', None)
+        return signature == self.sign(data)
+
+    def notify_data(self, order_id, total_amount, app_id):
+        """支付宝异步通知的参数: 除sign和sign_type外的参数排序后签名"""
+        data = {'app_id': app_id, 'out_trade_no': order_id,
+                'trade_no': '2018010122001', 'trade_status': 'TRADE_SUCCESS',
+                'total_amount': total_amount, 'notify_id': '1'}
+        data['sign'] = self.sign(data)
+        data['sign_type'] = 'RSA2'
+        return data
+
+
+class PaymentTest(RedisTestMixin, TestCase):
+    """查询支付结果、支付宝通知和支付状态查询(使用假的支付宝sdk对象)"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('buyer', password='123456')
+        address = Address.objects.create(
+            receiver_name='张三', receiver_mobile='13800000000',
+            detail_addr='北京', user=self.user)
+        self.order = OrderInfo.objects.create(
+            order_id='20180101120000000010010001', total_count=1,
+            total_amount=20, trans_cost=10, pay_method=3, user=self.user,
+            address=address)
+        self.alipay = FakeAlipay()
+        patcher = mock.patch('apps.orders.payment.get_alipay', return_value=self.alipay)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # 上次测试中断时可能留下了支付状态
+        self.redis_conn.delete(PAY_STATUS_KEY % self.order.order_id)
+        start_payment(self.order.order_id)
+
+    def order_status(self):
+        return OrderInfo.objects.get(order_id=self.order.order_id).status
+
+    def test_waiting(self):
+        # 已经开始查询支付结果: 再次请求支付时不重复查询
+        self.assertFalse(start_payment(self.order.order_id))
+        self.assertEqual(check_payment(self.order.order_id), WAITING)
+        self.alipay.trade_status = None
+        self.assertEqual(check_payment(self.order.order_id), WAITING)
+        self.assertEqual(self.order_status(), 1)
+        self.assertEqual(get_pay_status(self.order.order_id, self.user), WAITING)
+
+    def test_paid(self):
+        self.alipay.trade_status = 'TRADE_SUCCESS'
+        self.assertEqual(check_payment(self.order.order_id), PAID)
+        order = OrderInfo.objects.get(order_id=self.order.order_id)
+        self.assertEqual(order.status, 4)
+        self.assertEqual(order.trade_no, '2018010122001')
+        self.assertEqual(get_pay_status(self.order.order_id, self.user), PAID)
+
+    def test_closed_and_expired(self):
+        self.assertEqual(check_payment(self.order.order_id, expired=True), EXPIRED)
+        self.assertEqual(get_pay_status(self.order.order_id, self.user), EXPIRED)
+        self.alipay.trade_status = 'TRADE_CLOSED'
+        self.assertEqual(check_payment(self.order.order_id), FAILED)
+        self.assertEqual(get_pay_status(self.order.order_id, self.user), FAILED)
+        self.assertEqual(self.order_status(), 1)
+
+    def test_notify(self):
+        # 签名错误、金额错误时不修改订单
+        data = self.alipay.notify_data(self.order.order_id, '30.00', '2016091500513483')
+        data['sign'] = self.alipay.sign({'wrong': ''})
+        self.assertFalse(handle_notify(data))
+        data = self.alipay.notify_data(self.order.order_id, '0.01', '2016091500513483')
+        self.assertFalse(handle_notify(data))
+        self.assertEqual(self.order_status(), 1)
+
+        data = self.alipay.notify_data(self.order.order_id, '30.00', '2016091500513483')
+        response = self.client.post('/orders/notify', data)
+        self.assertEqual(response.content, b'success')
+        self.assertEqual(self.order_status(), 4)
+        # 重复通知
+        self.assertTrue(handle_notify(
+            self.alipay.notify_data(self.order.order_id, '30.00', '2016091500513483')))
+
+    def test_check_view(self):
+        # 查询支付状态不请求支付宝
+        self.client.login(username='buyer', password='123456')
+        queries = len(self.alipay.queries)
+        start = time.time()
+        response = self.client.get('/orders/check',
+                                   {'order_id': self.order.order_id})
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(json.loads(response.content.decode()),
+                         {'code': 0, 'status': WAITING})
+        self.assertEqual(len(self.alipay.queries), queries)
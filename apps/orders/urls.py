@@ -7,7 +7,13 @@ urlpatterns = [
     url(r'^place$', views.PlaceOrderView.as_view(), name='place'),
     # 订单提交 /orders/commit
     url(r'^commit$', views.CommitOrderView.as_view(), name='commit'),
+    # 秒杀订单提交和状态查询
+    url(r'^flash/commit$', views.FlashOrderView.as_view(), name='flash_commit'),
+    url(r'^flash/status$', views.FlashOrderStatusView.as_view(),
+        name='flash_status'),
     # 支付接口
     url(r'^pay$', views.OrderPayView.as_view(), name='pay'),
     url(r'^check$', views.CheckPayView.as_view(), name='check'),
+    # 支付宝的异步通知
+    url(r'^notify$', views.NotifyPayView.as_view(), name='notify'),
 ]
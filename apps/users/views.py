@@ -10,7 +10,8 @@ from django.views.generic import View
 from django_redis import get_redis_connection
 from itsdangerous import TimedJSONWebSignatureSerializer, SignatureExpired
 from redis import StrictRedis
-from apps.goods.models import GoodsSKU
+from apps.cart.cart import cart_owner, merge_cart_items
+from apps.goods.catalog import get_sku_summaries
 from apps.orders.models import OrderInfo, OrderGoods
 from apps.users.models import User, Address
 from dailyfresh import settings
@@ -149,8 +150,13 @@ class LoginView(View):
             # 用户未激活
             return render(request, 'login.html', {'errmsg': '请先激活账号'})
 
+        # 未登录时添加到购物车的商品(login会修改session的键, 需要先获取)
+        anon_owner = cart_owner(request, create=False)
         # 通过django的login方法，保存登录用户状态（使用session）
         login(request, user)
+        if anon_owner is not None:
+            # 合并到用户的购物车: 只执行一次Lua脚本
+            merge_cart_items(anon_owner, user.id)
         # 获取是否勾选'记住用户名'
         remember = request.POST.get('remember')
         # 判断是否是否勾选'记住用户名'
@@ -194,13 +200,8 @@ class UserInfoView(LoginRequiredMixin, View):
         key = 'history_%s' % request.user.id
         # 最多只取5个商品ID[3,1,2]
         sku_ids = strict_redis.lrange(key, 0, 4)
-        # 根据商品ID,查询出商品对象
-
-        # skus = GoodsSKU.objects.filter(id__in=sku_ids)
-        skus = []
-        for sku_id in sku_ids:
-            sku = GoodsSKU.objects.get(id=sku_id)
-            skus.append(sku)
+        # 根据商品ID,读取商品摘要(缓存), 保持浏览的先后顺序
+        skus = get_sku_summaries(sku_ids)
 
         # 获取用户对象
         user = request.user
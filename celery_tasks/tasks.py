@@ -3,17 +3,59 @@
 #
 # os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dailyfresh.settings")
 # django.setup()
+import time
 from time import sleep
 
 from celery import Celery
 from django.core.mail import send_mail
 from django.template import loader
 
-from apps.goods.models import GoodsCategory, IndexSlideGoods, IndexPromotion, IndexCategoryGoods
+from apps.goods.index_page import get_index_page_data
+from apps.goods.sales import flush_sales
+from apps.goods.search import apply_index_queue, optimize_index
+from apps.goods.suggest import update_suggest_snapshot, rebuild_suggest_entries
+from apps.orders.flash_sale import persist_orders
+from apps.orders.payment import check_payment, WAITING
 from dailyfresh import settings
 
 app = Celery('dailyfresh', broker='redis://127.0.0.1:6379/2')
 
+# 定时任务: celery -A celery_tasks.tasks beat
+app.conf.update(
+    CELERYBEAT_SCHEDULE={
+        # 每分钟把Redis中记录的商品销量保存到数据库
+        'flush-sku-sales': {
+            'task': 'celery_tasks.tasks.flush_sku_sales',
+            'schedule': 60,
+        },
+        # 每10秒批量更新一次全文检索索引
+        'update-search-index': {
+            'task': 'celery_tasks.tasks.update_search_index',
+            'schedule': 10,
+        },
+        # 每小时检查一次索引的段数, 超过阈值时合并
+        'optimize-search-index': {
+            'task': 'celery_tasks.tasks.optimize_search_index',
+            'schedule': 60 * 60,
+        },
+        # 每10秒把输入提示的修改记录应用到快照中
+        'update-suggest': {
+            'task': 'celery_tasks.tasks.update_suggest',
+            'schedule': 10,
+        },
+        # 每小时从数据库重新生成一次输入提示数据(更新销量排序)
+        'rebuild-suggest': {
+            'task': 'celery_tasks.tasks.rebuild_suggest',
+            'schedule': 60 * 60,
+        },
+        # 提交秒杀订单时会通知保存, 每5秒再检查一次没有保存的秒杀订单
+        'persist-flash-orders': {
+            'task': 'celery_tasks.tasks.persist_flash_orders',
+            'schedule': 5,
+        },
+    },
+)
+
 
 @app.task
 def send_active_mail(username, email, token):
@@ -37,36 +79,10 @@ def send_active_mail(username, email, token):
 def generate_static_index_page():
     """生成静态首页"""
     sleep(2)
-    # 查询商品类别数据
-    categories = GoodsCategory.objects.all()
-
-    # 查询商品轮播轮数据
-    # index为表示显示先后顺序的一个字段，值小的会在前面
-    slide_skus = IndexSlideGoods.objects.all().order_by('index')
-
-    # 查询商品促销活动数据
-    promotions = IndexPromotion.objects.all().order_by('index')
-
-    # 查询类别商品数据
-    for category in categories:
-        # 查询某一类别下的文字类别商品
-        text_skus = IndexCategoryGoods.objects.filter(
-            category=category, display_type=0).order_by('index')
-        # 查询某一类别下的图片类别商品
-        img_skus = IndexCategoryGoods.objects.filter(
-            category=category, display_type=1).order_by('index')
-
-        # 动态地给类别新增实例属性
-        category.text_skus = text_skus
-        # 动态地给类别新增实例属性
-        category.img_skus = img_skus
+    # 查询首页数据: 类别商品一次查询获取
+    context = get_index_page_data()
     # 定义模板数据
-    context = {
-        'categories': categories,
-        'slide_skus': slide_skus,
-        'promotions': promotions,
-        'cart_count': 0,
-    }
+    context.update({'cart_count': 0})
     template = loader.get_template('index.html')
     # 渲染生成标准备的html内容
     html_str = template.render(context)
@@ -76,3 +92,61 @@ def generate_static_index_page():
     with open(file_path, 'w') as file:
         # 写入html内容
         file.write(html_str)
+
+
+@app.task
+def flush_sku_sales():
+    """把Redis中记录的商品销量批量保存到数据库"""
+    count = flush_sales()
+    print('flush_sku_sales: %s' % count)
+
+
+@app.task
+def update_search_index():
+    """批量更新Redis中记录的需要更新全文检索索引的数据"""
+    count = apply_index_queue()
+    print('update_search_index: %s' % count)
+
+
+@app.task
+def optimize_search_index():
+    """全文检索索引的段数超过阈值时合并"""
+    result = optimize_index()
+    print('optimize_search_index: %s' % (result,))
+
+
+@app.task
+def update_suggest():
+    """把输入提示的修改记录应用到快照中, 还没有快照时生成"""
+    update_suggest_snapshot()
+
+
+@app.task
+def rebuild_suggest():
+    """从数据库重新生成输入提示数据"""
+    rebuild_suggest_entries()
+    update_suggest_snapshot()
+
+
+@app.task
+def persist_flash_orders():
+    """把Redis中预留了库存的秒杀订单批量保存到数据库"""
+    count = persist_orders()
+    print('persist_flash_orders: %s' % count)
+
+
+@app.task
+def poll_payment(order_id, deadline, delay=settings.ALIPAY_POLL_DELAY):
+    """
+    查询订单的支付结果: 没有支付时过一段时间再查询, 间隔每次加倍(最多ALIPAY_POLL_MAX_DELAY秒),
+    超过支付时间后不再查询
+    :param deadline: 停止查询的时间(时间戳)
+    """
+    remaining = deadline - time.time()
+    status = check_payment(order_id, expired=remaining <= 0)
+    if status == WAITING:
+        # 最后一次在截止时间查询
+        poll_payment.apply_async(
+            (order_id, deadline, min(delay * 2, settings.ALIPAY_POLL_MAX_DELAY)),
+            countdown=min(delay, remaining))
+    print('poll_payment: %s %s' % (order_id, status))
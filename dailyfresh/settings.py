@@ -147,6 +147,9 @@ CACHES = {
     }
 }
 
+# 单元测试使用的Redis数据库, 不读写上面的缓存数据
+TEST_REDIS_LOCATION = "redis://127.0.0.1:6379/15"
+
 # session数据缓存到Redis中
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
 SESSION_CACHE_ALIAS = "default"
@@ -167,7 +170,40 @@ HAYSTACK_CONNECTIONS = {
 }
 
 # 当添加、修改、删除了数据时，自动生成索引
-HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
+# HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
+# 添加、修改、删除了数据时, 先记录到Redis中, 由celery定时任务批量更新索引
+HAYSTACK_SIGNAL_PROCESSOR = 'apps.goods.search.QueuedSignalProcessor'
 HAYSTACK_SEARCH_RESULTS_PER_PAGE = 5
+# 索引段数超过10个时合并小的段, 超过30个时合并为一个段
+SEARCH_INDEX_MERGE_SEGMENTS = 10
+SEARCH_INDEX_OPTIMIZE_SEGMENTS = 30
+# 重新生成索引时使用的进程数和每个进程的内存上限(MB)
+SEARCH_INDEX_PROCS = 4
+SEARCH_INDEX_LIMITMB = 128
+
+# 生成订单id时使用的实例id(0-99), 同时运行多个uwsgi实例时每个实例不同(在uwsgi.ini中用env设置)
+ORDER_ID_INSTANCE = int(os.environ.get('ORDER_ID_INSTANCE', 0))
+# 生成订单id时使用的进程编号(0-999): uwsgi中使用worker的编号,
+# 不在uwsgi中运行时(celery、manage.py)需要设置, 同时运行的每个进程不同
+ORDER_ID_WORKER = os.environ.get('ORDER_ID_WORKER')
+
+# 支付宝: ALIPAY_DEBUG为True时使用沙箱环境(sdk的debug参数)
+ALIPAY_APPID = '2016091500513483'
+ALIPAY_DEBUG = True
+# 支付页面的网关, 与sdk使用的环境一致
+ALIPAY_GATEWAY = 'https://openapi-sandbox.dl.alipaydev.com/gateway.do' if ALIPAY_DEBUG \
+    else 'https://openapi.alipay.com/gateway.do'
+ALIPAY_APP_PRIVATE_KEY_PATH = os.path.join(BASE_DIR, 'apps/orders/app_private_key.pem')
+ALIPAY_PUBLIC_KEY_PATH = os.path.join(BASE_DIR, 'apps/orders/alipay_public_key.pem')
+# 支付成功后支付宝通知的url, 需要外网可以访问
+ALIPAY_NOTIFY_URL = 'http://127.0.0.1/orders/notify'
+# 支付时间(秒): 超过后支付宝关闭交易, 不再查询支付结果
+ALIPAY_PAY_TIMEOUT = 60 * 30
+# 支付状态在Redis中保存的时间(秒): 超过支付时间后还要保存最后一次查询的结果
+ALIPAY_POLL_TIMEOUT = ALIPAY_PAY_TIMEOUT * 2
+# 查询支付结果的间隔(秒): 从2秒开始每次加倍, 最多60秒
+ALIPAY_POLL_DELAY = 2
+ALIPAY_POLL_MAX_DELAY = 60
+
 # 指定收集的静态文件保存在哪个目录下：
 STATIC_ROOT = '/home/python/Desktop/static'
\ No newline at end of file
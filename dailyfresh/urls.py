@@ -1,7 +1,10 @@
 from django.conf.urls import include, url
 from django.contrib import admin
+from haystack.forms import SearchForm
 import tinymce.urls
 
+from apps.goods.views import GoodsSearchView
+
 urlpatterns = [
     url(r'^admin/', include(admin.site.urls)),
 
@@ -11,7 +14,9 @@ urlpatterns = [
     url(r'^tinymce/', include('tinymce.urls')),
     url(r'^accounts/', include('apps.users.urls')),
     url(r'^', include('apps.goods.urls', namespace='goods')),  # 商品模块
-    url(r'^search/', include('haystack.urls')),
+    # 全文检索: load_all=False, 搜索结果使用索引中保存的字段显示, 不查询数据库
+    url(r'^search/$', GoodsSearchView(load_all=False, form_class=SearchForm),
+        name='haystack_search'),
 
 
 ]
@@ -7,6 +7,7 @@ For more information on this file, see
 https://docs.djangoproject.com/en/1.8/howto/deployment/wsgi/
 """
 
+import logging
 import os
 
 from django.core.wsgi import get_wsgi_application
@@ -14,3 +15,20 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dailyfresh.settings")
 
 application = get_wsgi_application()
+
+# uwsgi主进程加载程序后再fork工作进程(不要设置lazy-apps):
+# 在这里加载jieba词典、打开whoosh索引和读取输入提示的快照, 工作进程不需要再加载
+from apps.goods.search import warm_up_search
+from apps.goods.suggest import warm_up_suggest
+
+try:
+    warm_up_search()
+except Exception:
+    # 索引不存在、为空或被锁定时不影响网站运行, 第一次搜索时再打开索引
+    logging.getLogger(__name__).exception('全文检索预热失败')
+
+try:
+    warm_up_suggest()
+except Exception:
+    # Redis不可用时不影响网站运行, 输入提示暂时为空
+    logging.getLogger(__name__).exception('输入提示预热失败')
@@ -0,0 +1,222 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+# 通知所有进程删除本地缓存的Redis频道
+INVALIDATE_CHANNEL = 'two_tier_cache_invalidate'
+
+# 缓存中不存在数据时的标记(缓存的值可以为None)
+_MISSING = object()
+
+# 所有二级缓存对象: {缓存名称: 缓存对象}
+_caches = {}
+# 当前进程中监听失效消息的线程所属的进程id
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+class TwoTierCache(object):
+    """
+    二级缓存: 进程内有容量限制的LRU缓存 + Redis缓存(django_redis)
+    读取时先读本进程的缓存, 没有再读Redis, 最后才查询数据库;
+    删除缓存时通过Redis发布订阅通知所有uwsgi进程删除本地缓存
+    """
+
+    def __init__(self, name, maxsize=1000, local_timeout=60, timeout=60 * 30,
+                 remote=True):
+        """
+        :param name: 缓存名称, 用于区分Redis中的键
+        :param maxsize: 进程内缓存最多保存的数据条数
+        :param local_timeout: 进程内缓存的有效时间(秒), 错过失效消息时最多使用这么久的旧数据
+        :param timeout: Redis缓存的有效时间(秒)
+        :param remote: 是否使用Redis缓存, 为False时loader自己负责Redis缓存
+        """
+        self.name = name
+        self.maxsize = maxsize
+        self.local_timeout = local_timeout
+        self.timeout = timeout
+        self.remote = remote
+        # 进程内缓存: {键: (过期时间, 值)}, 最近使用的在最后
+        self._local = OrderedDict()
+        # uwsgi每个进程有多个线程
+        self._lock = threading.Lock()
+        _caches[name] = self
+
+    def make_key(self, key):
+        """Redis中保存数据的键"""
+        return 'tt:%s:%s' % (self.name, key)
+
+    def get_local(self, key):
+        """读取进程内缓存"""
+        # 本地缓存的键统一转换为字符串, 与失效消息中的键一致
+        key = str(key)
+        with self._lock:
+            item = self._local.get(key)
+            if item is None:
+                return _MISSING
+            expires, value = item
+            if expires < time.time():
+                del self._local[key]
+                return _MISSING
+            self._local.move_to_end(key)
+            return value
+
+    def set_local(self, key, value):
+        """保存数据到进程内缓存, 超出容量时删除最久没有使用的数据"""
+        key = str(key)
+        with self._lock:
+            self._local[key] = (time.time() + self.local_timeout, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.maxsize:
+                self._local.popitem(last=False)
+
+    def delete_local(self, keys=None):
+        """删除进程内缓存, keys为None时全部删除"""
+        with self._lock:
+            if keys is None:
+                self._local.clear()
+            else:
+                for key in keys:
+                    self._local.pop(str(key), None)
+
+    def get(self, key, loader=None):
+        """
+        读取缓存数据
+        :param loader: 缓存中没有数据时调用, 从数据库查询数据, 返回值会保存到缓存中
+        """
+        ensure_listener()
+        value = self.get_local(key)
+        if value is not _MISSING:
+            return value
+
+        value = _MISSING
+        if self.remote:
+            value = cache.get(self.make_key(key), _MISSING)
+        if value is _MISSING:
+            if loader is None:
+                return None
+            value = loader()
+            if self.remote:
+                cache.set(self.make_key(key), value, self.timeout)
+        self.set_local(key, value)
+        return value
+
+    def get_many(self, keys, loader=None):
+        """
+        批量读取缓存数据
+        :param loader: 参数为缓存中没有的键列表, 返回{键: 值}字典
+        :return: {键: 值}, 不包含缓存和数据库中都没有的键
+        """
+        ensure_listener()
+        result = {}
+        missing = []
+        for key in keys:
+            value = self.get_local(key)
+            if value is _MISSING:
+                missing.append(key)
+            else:
+                result[key] = value
+        if not missing:
+            return result
+
+        if self.remote:
+            redis_keys = {self.make_key(key): key for key in missing}
+            for redis_key, value in cache.get_many(list(redis_keys)).items():
+                key = redis_keys[redis_key]
+                result[key] = value
+                self.set_local(key, value)
+            missing = [key for key in missing if key not in result]
+
+        if missing and loader is not None:
+            loaded = loader(missing)
+            if self.remote:
+                cache.set_many({self.make_key(key): value
+                                for key, value in loaded.items()}, self.timeout)
+            for key, value in loaded.items():
+                result[key] = value
+                self.set_local(key, value)
+        return result
+
+    def set(self, key, value):
+        """保存数据到缓存"""
+        if self.remote:
+            cache.set(self.make_key(key), value, self.timeout)
+        self.set_local(key, value)
+
+    def delete(self, *keys):
+        """删除缓存数据, 并通知所有进程删除本地缓存"""
+        if self.remote:
+            cache.delete_many([self.make_key(key) for key in keys])
+        self.delete_local(keys)
+        publish_invalidate(self.name, list(keys))
+
+    def clear(self):
+        """删除全部缓存数据, 并通知所有进程删除本地缓存"""
+        if self.remote:
+            cache.delete_pattern(self.make_key('*'))
+        self.delete_local()
+        publish_invalidate(self.name, None)
+
+
+def publish_invalidate(name, keys):
+    """
+    发布缓存失效消息
+    :param keys: 要删除的键列表, None表示删除全部
+    """
+    message = json.dumps({'name': name, 'keys': keys})
+    get_redis_connection().publish(INVALIDATE_CHANNEL, message)
+
+
+def handle_invalidate(message):
+    """收到缓存失效消息: 删除本进程对应的缓存数据"""
+    data = json.loads(message.decode())
+    two_tier_cache = _caches.get(data['name'])
+    if two_tier_cache is None:
+        return
+    two_tier_cache.delete_local(data['keys'])
+
+
+def listen_invalidate():
+    """在后台线程中监听缓存失效消息"""
+    while True:
+        try:
+            pubsub = get_redis_connection().pubsub(
+                ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATE_CHANNEL)
+            for message in pubsub.listen():
+                handle_invalidate(message['data'])
+        except Exception as e:
+            print('监听缓存失效消息出错: %s' % e)
+        # 断开连接期间可能错过了失效消息, 删除所有的本地缓存
+        delete_local_caches()
+        time.sleep(1)
+
+
+def delete_local_caches():
+    """删除本进程所有的进程内缓存"""
+    for two_tier_cache in _caches.values():
+        two_tier_cache.delete_local()
+
+
+def ensure_listener():
+    """
+    确保当前进程已启动监听线程
+    uwsgi在加载项目后fork出工作进程, 线程不会被复制, 需要在每个进程中启动
+    """
+    global _listener_pid
+    pid = os.getpid()
+    if _listener_pid == pid:
+        return
+    with _listener_lock:
+        if _listener_pid == pid:
+            return
+        _listener_pid = pid
+        # fork前主进程中保存的本地缓存可能已经失效
+        delete_local_caches()
+        thread = threading.Thread(target=listen_invalidate, daemon=True)
+        thread.start()
@@ -0,0 +1,19 @@
+from django_redis import get_redis_connection
+
+
+class LuaScript(object):
+    """
+    Redis的Lua脚本: 脚本中的多条命令原子执行, 只需要一次网络往返
+    第一次执行时加载脚本, 之后使用EVALSHA执行(Redis重启后自动重新加载)
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.script = None
+
+    def __call__(self, keys=(), args=(), client=None):
+        if client is None:
+            client = get_redis_connection()
+        if self.script is None:
+            self.script = client.register_script(self.source)
+        return self.script(keys=list(keys), args=list(args), client=client)
@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# 订单id的格式: 时间(年月日时分秒+毫秒) + 实例id(2位) + 进程id(3位) + 序号(4位), 共26位
+# 例如: 20180101120000123 01 001 0001
+# 时间在前, 订单id大致按时间递增, 插入主键索引时不会随机分裂页
+ORDER_ID_FORMAT = '%s%03d%02d%03d%04d'
+# 实例id和进程编号的范围
+INSTANCE_SIZE = 100
+WORKER_SIZE = 1000
+# 序号的范围: 同一个进程在同一毫秒内最多生成这么多个订单id, 用完时等到下一毫秒
+SEQUENCE_SIZE = 10000
+# 系统时钟回拨(如NTP校时)不超过这么多毫秒时等待时钟追上, 超过时不生成订单id
+MAX_CLOCK_BACKWARD_MS = 100
+
+
+class OrderIdError(Exception):
+    """不能生成订单id: 系统时钟回拨太多"""
+
+
+def check_range(name, value, size):
+    """实例id和进程编号超出范围时, 不同进程生成的订单id可能重复"""
+    value = int(value)
+    if not 0 <= value < size:
+        raise ImproperlyConfigured('%s必须在0-%d之间: %s' % (name, size - 1, value))
+    return value
+
+
+def get_worker_id():
+    """
+    当前进程的编号: uwsgi中为worker的编号(从1开始);
+    不在uwsgi中运行时(celery、manage.py)必须设置settings.ORDER_ID_WORKER,
+    同时运行的每个进程不同
+    """
+    try:
+        import uwsgi
+    except ImportError:
+        worker_id = getattr(settings, 'ORDER_ID_WORKER', None)
+        if worker_id is None:
+            raise ImproperlyConfigured(
+                '不在uwsgi中运行时需要设置ORDER_ID_WORKER(环境变量), 每个进程不同')
+        return check_range('ORDER_ID_WORKER', worker_id, WORKER_SIZE)
+    return check_range('uwsgi worker_id', uwsgi.worker_id(), WORKER_SIZE)
+
+
+class OrderIdGenerator(object):
+    """
+    订单id生成器(参考Snowflake): 时间 + 实例id + 进程id + 序号
+    不同的uwsgi实例和进程生成的订单id不会重复; 同一个进程中上次的毫秒数和序号在锁中修改,
+    多个线程同时生成也不会重复
+    """
+
+    def __init__(self, instance_id=None, worker_id=None):
+        """
+        :param instance_id: 实例id(0-99), 为None时使用settings.ORDER_ID_INSTANCE
+        :param worker_id: 进程编号(0-999), 为None时在生成订单id的进程中获取
+        """
+        self.instance_id = instance_id
+        self.worker_id = worker_id
+        self.lock = threading.Lock()
+        # 上次生成订单id的毫秒数和序号
+        self.last_ms = 0
+        self.sequence = 0
+        # 生成订单id的进程和进程编号: uwsgi在加载项目后fork出worker进程, fork后重新获取
+        self.pid = None
+        self.instance = None
+        self.worker = None
+        # 缓存当前秒的时间字符串: (秒, '年月日时分秒')
+        self.second = (None, '')
+
+    def current_ms(self):
+        return int(time.time() * 1000)
+
+    def wait_until(self, ms):
+        """等到时钟到达ms毫秒"""
+        now_ms = self.current_ms()
+        while now_ms < ms:
+            time.sleep((ms - now_ms) / 1000)
+            now_ms = self.current_ms()
+        return now_ms
+
+    def __call__(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                instance_id = self.instance_id
+                if instance_id is None:
+                    instance_id = getattr(settings, 'ORDER_ID_INSTANCE', 0)
+                self.instance = check_range('ORDER_ID_INSTANCE', instance_id,
+                                            INSTANCE_SIZE)
+                worker_id = self.worker_id
+                self.worker = get_worker_id() if worker_id is None else check_range(
+                    'worker_id', worker_id, WORKER_SIZE)
+                self.pid = os.getpid()
+
+            now_ms = self.current_ms()
+            if now_ms < self.last_ms:
+                # 时钟回拨: 时间回到了已经生成过的毫秒
+                if self.last_ms - now_ms > MAX_CLOCK_BACKWARD_MS:
+                    raise OrderIdError('系统时钟回拨了%dms' % (self.last_ms - now_ms))
+                now_ms = self.wait_until(self.last_ms)
+            if now_ms == self.last_ms:
+                self.sequence += 1
+                if self.sequence >= SEQUENCE_SIZE:
+                    # 这一毫秒的序号已用完
+                    now_ms = self.wait_until(self.last_ms + 1)
+                    self.sequence = 0
+            else:
+                self.sequence = 0
+            self.last_ms = now_ms
+            sequence = self.sequence
+
+        seconds, ms = divmod(now_ms, 1000)
+        second = self.second
+        if second[0] != seconds:
+            # 每秒只格式化一次时间
+            second = (seconds, time.strftime('%Y%m%d%H%M%S',
+                                             time.localtime(seconds)))
+            self.second = second
+        return ORDER_ID_FORMAT % (second[1], ms, self.instance, self.worker, sequence)
+
+
+# 每个进程一个生成器
+next_order_id = OrderIdGenerator()
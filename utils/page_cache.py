@@ -0,0 +1,73 @@
+import hashlib
+
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from django_redis import get_redis_connection
+
+from utils.cache import TwoTierCache
+
+# 页面缓存版本号的键: 商品数据修改后版本号加1, 所有缓存的页面失效
+PAGE_VERSION_KEY = 'page_cache_version'
+
+# 缓存的页面中与用户相关的内容使用占位符, 返回页面时再替换
+CART_COUNT_PLACEHOLDER = '<!--cart_count-->'
+CSRF_TOKEN_PLACEHOLDER = 'PAGE_CACHE_CSRF_TOKEN'
+LOGIN_BTN_PLACEHOLDER = '<!--login_btn-->'
+
+# 缓存的页面html: 键中包含版本号, 版本号变化后旧页面不会再被读取
+page_cache = TwoTierCache('page', maxsize=200, local_timeout=30,
+                          timeout=60 * 5)
+
+
+def bump_page_version():
+    """页面缓存版本号加1, 使所有缓存的页面失效"""
+    get_redis_connection().incr(PAGE_VERSION_KEY)
+
+
+def page_cache_key(request, params=None):
+    """
+    页面缓存的键: 版本号 + 请求路径 + 参数
+    :param params: 校验过的请求参数, 不直接使用查询字符串(任意参数值会生成大量缓存)
+    """
+    version = get_redis_connection().get(PAGE_VERSION_KEY) or b'0'
+    path = request.path
+    if params:
+        path += '?' + '&'.join('%s=%s' % item for item in sorted(params.items()))
+    return '%s_%s' % (version.decode(),
+                      hashlib.md5(path.encode()).hexdigest())
+
+
+def get_cached_page(request, params=None):
+    """读取缓存的页面html, 没有缓存时返回None"""
+    return page_cache.get(page_cache_key(request, params))
+
+
+def render_cached_page(request, template_name, context, params=None, cache=True):
+    """
+    以匿名用户的身份渲染页面并缓存,
+    购物车数量、csrf令牌和登录信息使用占位符
+    :param cache: 为False时只渲染, 不缓存
+    :return: 包含占位符的html
+    """
+    context = dict(context, page_cache=True, user=AnonymousUser(),
+                   cart_count=mark_safe(CART_COUNT_PLACEHOLDER),
+                   csrf_token=CSRF_TOKEN_PLACEHOLDER)
+    html = render_to_string(template_name, context, request=request)
+    if cache:
+        page_cache.set(page_cache_key(request, params), html)
+    return html
+
+
+def cached_page_response(request, html, cart_count):
+    """把缓存页面中的占位符替换为当前用户的数据, 返回响应对象"""
+    login_btn = render_to_string('login_btn.html', {'user': request.user},
+                                 request=request)
+    html = html.replace(CART_COUNT_PLACEHOLDER, str(cart_count)) \
+        .replace(LOGIN_BTN_PLACEHOLDER, login_btn)
+    if CSRF_TOKEN_PLACEHOLDER in html:
+        # get_token会设置csrf cookie
+        html = html.replace(CSRF_TOKEN_PLACEHOLDER, get_token(request))
+    return HttpResponse(html)
@@ -0,0 +1,136 @@
+from django.db.models import Q
+
+
+class KeysetPage(object):
+    """
+    一页数据, 提供模板中用到的分页属性(与django的Page对象一致)
+    next_cursor/previous_cursor: 下一页/上一页的定位参数
+    """
+
+    def __init__(self, object_list, number, num_pages, paginator):
+        self.object_list = object_list
+        self.number = number
+        self.num_pages = num_pages
+        self.paginator = paginator
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.number < self.num_pages
+
+    def has_previous(self):
+        return self.number > 1
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    @property
+    def next_cursor(self):
+        if not self.object_list:
+            return ''
+        return self.paginator.make_cursor(self.object_list[-1])
+
+    @property
+    def previous_cursor(self):
+        if not self.object_list:
+            return ''
+        return self.paginator.make_cursor(self.object_list[0])
+
+
+class KeysetPaginator(object):
+    """
+    基于排序字段定位的分页器(seek分页)
+    按(排序字段, id)确定唯一顺序, 翻页时根据上一页最后一条数据的(排序字段值, id)
+    查询下一页, 不需要OFFSET跳过前面的数据; 总数量由调用者提供(可以缓存)
+    """
+
+    def __init__(self, queryset, per_page, order_field, count):
+        """
+        :param order_field: 排序字段, 如'price'、'-sales', 为'id'或'-id'时只按id排序
+        :param count: 数据总数量
+        """
+        self.queryset = queryset
+        self.per_page = per_page
+        self.descending = order_field.startswith('-')
+        self.field = order_field.lstrip('-')
+        self.count = count
+        self.num_pages = max(1, (count + per_page - 1) // per_page)
+
+    @property
+    def page_range(self):
+        return range(1, self.num_pages + 1)
+
+    def make_cursor(self, obj):
+        """数据对象的定位参数: 排序字段值_id"""
+        if self.field == 'id':
+            return str(obj.id)
+        return '%s_%s' % (getattr(obj, self.field), obj.id)
+
+    def parse_cursor(self, cursor):
+        """解析定位参数, 返回(排序字段值, id), 格式不正确返回None"""
+        try:
+            if self.field == 'id':
+                return None, int(cursor)
+            value, pk = cursor.rsplit('_', 1)
+            field = self.queryset.model._meta.get_field(self.field)
+            return field.to_python(value), int(pk)
+        except Exception:
+            return None
+
+    def order_by(self, reverse):
+        """排序条件: reverse为True时按相反的顺序"""
+        prefix = '-' if self.descending != reverse else ''
+        if self.field == 'id':
+            return [prefix + 'id']
+        return [prefix + self.field, prefix + 'id']
+
+    def seek_filter(self, key, after):
+        """查询定位数据之后(after=True)或之前的数据的条件"""
+        value, pk = key
+        # 降序时"之后"表示更小的值
+        op = 'gt' if after != self.descending else 'lt'
+        if self.field == 'id':
+            return Q(**{'id__' + op: pk})
+        return Q(**{'%s__%s' % (self.field, op): value}) | \
+            Q(**{self.field: value, 'id__' + op: pk})
+
+    def page(self, number, after=None, before=None):
+        """
+        获取一页数据
+        :param number: 页码, 不正确时返回第一页
+        :param after: 上一页最后一条数据的定位参数, 用于查询下一页
+        :param before: 下一页第一条数据的定位参数, 用于查询上一页
+        """
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            number = 1
+        if number < 1 or number > self.num_pages:
+            number = 1
+            after = before = None
+
+        after_key = self.parse_cursor(after) if after else None
+        before_key = self.parse_cursor(before) if before else None
+        if after_key:
+            objects = list(self.queryset.filter(
+                self.seek_filter(after_key, True)).order_by(
+                *self.order_by(False))[:self.per_page])
+        elif before_key:
+            # 反向查询定位数据之前的一页, 再恢复正常顺序
+            objects = list(self.queryset.filter(
+                self.seek_filter(before_key, False)).order_by(
+                *self.order_by(True))[:self.per_page])
+            objects.reverse()
+        else:
+            # 没有定位参数(直接点击页码): 使用OFFSET查询
+            offset = (number - 1) * self.per_page
+            objects = list(self.queryset.order_by(
+                *self.order_by(False))[offset:offset + self.per_page])
+        return KeysetPage(objects, number, self.num_pages, self)
@@ -0,0 +1,47 @@
+import copy
+
+from django.conf import settings
+from django.test import override_settings
+from django_redis import get_redis_connection
+
+from utils.cache import delete_local_caches
+
+
+def get_test_caches():
+    """测试使用的缓存配置: 单独的Redis数据库和键前缀"""
+    caches = copy.deepcopy(settings.CACHES)
+    caches['default']['LOCATION'] = settings.TEST_REDIS_LOCATION
+    caches['default']['KEY_PREFIX'] = 'test'
+    return caches
+
+
+class RedisTestMixin(object):
+    """
+    读写Redis的测试: 通过override_settings使用测试的Redis数据库,
+    每个测试结束后只删除测试中新建的键, 并清空进程内缓存
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.redis_settings = override_settings(CACHES=get_test_caches())
+        cls.redis_settings.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.redis_settings.disable()
+
+    def setUp(self):
+        super().setUp()
+        self.redis_conn = get_redis_connection()
+        # 测试开始前已经存在的键不删除
+        self.redis_keys = set(self.redis_conn.keys('*'))
+        delete_local_caches()
+        self.addCleanup(self.delete_redis_keys)
+
+    def delete_redis_keys(self):
+        keys = set(self.redis_conn.keys('*')) - self.redis_keys
+        if keys:
+            self.redis_conn.delete(*keys)
+        delete_local_caches()